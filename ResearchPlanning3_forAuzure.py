@@ -51,455 +51,2483 @@ client = AzureOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    max_retries=0,  # リトライは call_llm 側で行い、回数を計測する
 )
 DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
 
 
 # =========================
-# 古いセッションの自動クリーンアップ
+# LLM 呼び出しの共通ヘルパー（記録／再生対応）
 # =========================
-def cleanup_old_sessions(days: int = 1):
-    """
-    最終アクセスから days 日以上経過したセッションディレクトリを削除
-    """
-    if not BASE_ROOT.exists():
-        return
-
-    now = datetime.now()
-    for child in BASE_ROOT.iterdir():
-        if not child.is_dir():
-            continue
+import json
+import time
+import hashlib
+import threading
+import uuid
+from collections import deque
+from io import BytesIO
+import openai
+
+# LLM_CASSETTE_MODE
+#   off    : 通常どおり Azure OpenAI を呼び出す
+#   record : 呼び出し結果（リクエスト・応答・所要時間）をカセットファイルに記録する
+#   replay : カセットファイルから応答を再生する（ネットワーク通信なし）
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").strip().lower()
+LLM_CASSETTE_DIR = Path(os.getenv("LLM_CASSETTE_DIR", "/home/streamlit_workspace/_cassettes"))
+# 再生時の待ち時間 = 記録時の所要時間 × この倍率（0 なら即時に返す）
+LLM_REPLAY_LATENCY_SCALE = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+
+# 呼び出しごとの計測ログ（JSON Lines）
+LLM_TELEMETRY_LOG = Path(os.getenv("LLM_TELEMETRY_LOG", "/home/streamlit_workspace/_telemetry/llm_calls.jsonl"))
+LLM_TELEMETRY_KEEP = 5000  # メモリ上に保持する直近の記録件数
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+# max_tokens の自動調整（LLM_ADAPTIVE_MAX_TOKENS=0 で無効。記録／再生中はカセットの一致のため使わない）
+LLM_ADAPTIVE_MAX_TOKENS = os.getenv("LLM_ADAPTIVE_MAX_TOKENS", "1") != "0"
+LLM_ADAPTIVE_PERCENTILE = float(os.getenv("LLM_ADAPTIVE_PERCENTILE", "95"))
+LLM_ADAPTIVE_MARGIN_RATIO = 1.2
+LLM_ADAPTIVE_MARGIN_TOKENS = 50
+LLM_ADAPTIVE_MIN_SAMPLES = 10
+LLM_ADAPTIVE_WINDOW = 200  # 直近何回分の出力から分布を見るか
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "128000"))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "16384"))
+
+# max_tokens で打ち切られた場合に続きを依頼する回数と、その依頼文
+LLM_MAX_CONTINUATIONS = int(os.getenv("LLM_MAX_CONTINUATIONS", "2"))
+LLM_CONTINUATION_PROMPT = (
+    "出力が途中で切れました。直前の出力の最後の文字の直後から、続きだけをそのまま出力してください。"
+    "前置き・説明・繰り返し・コードブロック記号は書かないでください。"
+)
 
-        marker = child / ".last_access"
-        try:
-            if marker.exists():
-                ts = datetime.fromisoformat(marker.read_text(encoding="utf-8"))
-            else:
-                # マーカーがない場合はディレクトリの更新時刻を使う
-                ts = datetime.fromtimestamp(child.stat().st_mtime)
+# 一時的なエラーのみリトライする
+_RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # APITimeoutError を含む
+    openai.InternalServerError,
+)
 
-            if now - ts > timedelta(days=days):
-                shutil.rmtree(child, ignore_errors=True)
-        except Exception:
-            # 読み取り・削除で何かあってもアプリを落とさない
-            continue
+# 1,000トークンあたりの単価（USD）。LLM_PRICING_JSON で上書きできる
+LLM_PRICING = {
+    "gpt-4o": {"input": 0.0025, "output": 0.01},
+    "gpt-4o-mini": {"input": 0.00015, "output": 0.0006},
+}
+if os.getenv("LLM_PRICING_JSON"):
+    try:
+        LLM_PRICING.update(json.loads(os.getenv("LLM_PRICING_JSON")))
+    except Exception:
+        pass
 
 
+# モード別のルーティング表：デプロイメントと目標値（所要時間 p95・1回あたりの費用）
+#   抽出・分類のような短い処理は軽量モデル、統合・文章生成は大きいモデルに振り分ける
+#   hedge=True のモードは、期限を過ぎても応答がなければ別エンドポイントにも同じリクエストを投げる
+#   "*" は表にないモードの既定値。LLM_ROUTES_JSON を指定すると表全体を置き換える（ローカルの代替サーバーでの検証用）
+DEPLOYMENT_FAST = os.getenv("AZURE_OPENAI_DEPLOYMENT_FAST", "gpt-4o-mini")
+LLM_ROUTES = {
+    "*": {"deployment": DEPLOYMENT, "target_latency_s": 30.0, "target_cost_usd": 0.05},
+    "資料の一括抽出": {"deployment": DEPLOYMENT_FAST, "target_latency_s": 4.0, "target_cost_usd": 0.003, "hedge": True},
+    "対象者条件を検討": {"deployment": DEPLOYMENT_FAST, "target_latency_s": 8.0, "target_cost_usd": 0.005, "hedge": True},
+    "スケジュール案": {"deployment": DEPLOYMENT_FAST, "target_latency_s": 8.0, "target_cost_usd": 0.005, "hedge": True},
+    "調査仕様案": {"deployment": DEPLOYMENT_FAST, "target_latency_s": 10.0, "target_cost_usd": 0.005, "hedge": True},
+    "オリエン内容の整理": {"deployment": DEPLOYMENT, "target_latency_s": 20.0, "target_cost_usd": 0.03},
+    "brand_diagnosis/search": {"deployment": DEPLOYMENT, "target_latency_s": 20.0, "target_cost_usd": 0.02},
+    "brand_diagnosis/funnel": {"deployment": DEPLOYMENT, "target_latency_s": 40.0, "target_cost_usd": 0.04},
+    "キックオフノート": {"deployment": DEPLOYMENT, "target_latency_s": 20.0, "target_cost_usd": 0.03},
+    "問いの分解": {"deployment": DEPLOYMENT, "target_latency_s": 30.0, "target_cost_usd": 0.04},
+    "分析アプローチ/SQ": {"deployment": DEPLOYMENT, "target_latency_s": 15.0, "target_cost_usd": 0.02, "hedge": True},
+    "キックオフノート/項目": {"deployment": DEPLOYMENT, "target_latency_s": 6.0, "target_cost_usd": 0.01},
+    "調査仕様案/項目": {"deployment": DEPLOYMENT_FAST, "target_latency_s": 4.0, "target_cost_usd": 0.002, "hedge": True},
+    "調査項目案": {"deployment": DEPLOYMENT, "target_latency_s": 30.0, "target_cost_usd": 0.03},
+}
+if os.getenv("LLM_ROUTES_JSON"):
+    try:
+        LLM_ROUTES = json.loads(os.getenv("LLM_ROUTES_JSON"))
+    except Exception:
+        pass
 
-# =========================
-# セッション専用ディレクトリのヘルパーを作る
-# =========================
-import uuid
-import shutil
-from datetime import datetime, timedelta
 
-BASE_ROOT = Path("/home/streamlit_workspace")
+# 追加のエンドポイント（フェイルオーバー・ヘッジ用）。既定の AZURE_OPENAI_ENDPOINT が常に先頭になる
+#   例：[{"name": "eastus", "endpoint": "https://...", "api_key_env": "OPENAI_API_KEY_EASTUS",
+#         "api_version": "2024-06-01", "deployments": {"gpt-4o": "gpt-4o-eastus"}}]
+#   deployments はルーティング表のデプロイメント名 → そのエンドポイントでの名前（省略時は同名）
+LLM_ENDPOINTS = []
+if os.getenv("LLM_ENDPOINTS_JSON"):
+    try:
+        LLM_ENDPOINTS = json.loads(os.getenv("LLM_ENDPOINTS_JSON"))
+    except Exception:
+        pass
 
+# サーキットブレーカー：連続でこの回数失敗したエンドポイントは、クールダウンの間は使わない
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "3"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "60"))
+# ヘッジ：計測記録がこの件数以上あれば所要時間 p95 を期限にし、なければルートの目標所要時間を使う
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "10"))
+
+# 類似プロンプトの応答再利用（セマンティックキャッシュ）
+#   表にあるモードだけが対象。文字3-gramのコサイン類似度がしきい値以上の過去の応答を「再利用した下書き」として返す
+#   既定では無効（左ペイン「運用」で切り替え）。LLM_SEMANTIC_THRESHOLDS_JSON で表全体を置き換えられる
+LLM_SEMANTIC_CACHE = os.getenv("LLM_SEMANTIC_CACHE", "0") != "0"
+LLM_SEMANTIC_THRESHOLDS = {
+    "オリエン内容の整理": 0.97,
+    "キックオフノート": 0.95,
+    "問いの分解": 0.95,
+    # 「分析アプローチ/SQ」（サブクエスチョンごとの並列リクエスト）は対象外：
+    # 共通の前提が長く SQ の1行しか違わないため、別の SQ の応答を取り違える
+    "対象者条件を検討": 0.95,
+    "調査項目案": 0.95,
+    "調査仕様案": 0.95,
+}
+if os.getenv("LLM_SEMANTIC_THRESHOLDS_JSON"):
+    try:
+        LLM_SEMANTIC_THRESHOLDS = json.loads(os.getenv("LLM_SEMANTIC_THRESHOLDS_JSON"))
+    except Exception:
+        pass
+LLM_SEMANTIC_THRESHOLDS.pop("分析アプローチ/SQ", None)
+LLM_SEMANTIC_KEEP = 200  # モードごとに保持する応答の件数（全セッション合計。再利用は同じセッション内に限る）
 
-def get_session_dir() -> Path:
 
-    cleanup_old_sessions(days=1) 
-    """
-    セッションごとに一意の作業ディレクトリを返す。
-    例）/home/streamlit_workspace/20250201_120000_ab12cd34/
-    """
-    if "session_id" not in st.session_state:
-        sid = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:8]
-        st.session_state["session_id"] = sid
+def resolve_route(mode_name: str) -> dict:
+    """モード名からルート（deployment・目標値）を引く。表にないモードは "*"、それもなければ DEPLOYMENT"""
+    route = dict(LLM_ROUTES.get("*", {}))
+    route.update(LLM_ROUTES.get(mode_name, {}))
+    route.setdefault("deployment", DEPLOYMENT)
+    return route
 
-    session_dir = BASE_ROOT / st.session_state["session_id"]
-    session_dir.mkdir(parents=True, exist_ok=True)
 
-    # 最終アクセス時刻を記録しておく（自動クリーンアップ用）
-    (session_dir / ".last_access").write_text(datetime.now().isoformat(), encoding="utf-8")
+class CassetteMissError(RuntimeError):
+    """replay モードで該当するリクエストがカセットに記録されていない場合の例外"""
 
-    return session_dir
 
+@st.cache_resource(show_spinner=False)
+def _llm_runtime():
+    """
+    プロセス全体で共有する LLM 呼び出しの状態。
+    Streamlit の再実行ではモジュール変数が作り直されるため、cache_resource で保持する。
+    """
+    return {
+        "lock": threading.Lock(),
+        "replay_counters": {},  # カセットキー → 次に再生する応答の番号
+        "stream_usage": True,  # stream_options(include_usage) が使えるか
+        "telemetry": _load_telemetry_history(),
+        "breakers": {},  # エンドポイント名 → {"failures": 連続失敗数, "open_until": 再開時刻}
+        "semantic": {},  # モード名 → 類似判定用の過去の応答（deque）
+    }
 
-# =========================
-# ファイル読込関数
-# =========================
-def read_txt(path):
-    for enc in ("utf-8", "utf-8-sig", "cp932"):
-        try:
-            with open(path, "r", encoding=enc, errors="ignore") as f:
-                return f.read()
-        except Exception:
-            continue
-    return ""
 
-def read_pdf(path):
-    try:
-        doc = fitz.open(path)
-        return "\n".join(page.get_text("text") for page in doc)
-    except Exception:
-        return ""
+def _load_telemetry_history():
+    """起動時に計測ログを読み込み、直近の記録をメモリに復元する"""
+    records = deque(maxlen=LLM_TELEMETRY_KEEP)
+    if not LLM_TELEMETRY_LOG.exists():
+        return records
 
-def read_pptx_text(path):
+    by_id = {}
     try:
-        prs = Presentation(path)
-        texts = []
-        for slide in prs.slides:
-            for shp in slide.shapes:
-                if hasattr(shp, "text") and shp.text:
-                    texts.append(shp.text)
-        return "\n".join(texts)
+        with open(LLM_TELEMETRY_LOG, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                # パース結果は後から別行で追記されるので、元の記録に反映する
+                if rec.get("event") == "parse":
+                    target = by_id.get(rec.get("call_id"))
+                    if target is not None:
+                        target["parse_ok"] = rec.get("parse_ok")
+                    continue
+                records.append(rec)
+                by_id[rec.get("call_id")] = rec
     except Exception:
-        return ""
+        pass
+    return records
 
-# =========================
-# PPT → 画像変換関数
-# =========================
-from pptx import Presentation
-from pptx.enum.shapes import MSO_SHAPE_TYPE
-from PIL import Image, ImageDraw, ImageFont
-import io, os
 
-def pptx_to_images(pptx_path: Path) -> list[Image.Image]:
+def estimate_tokens(text: str) -> int:
     """
-    PowerPointファイルをスライドレイアウト通りに簡易描画して画像リストで返す。
-    - 日本語フォント対応
-    - テキスト・画像を元の位置(left, top, width, height)に再配置
+    トークン数のざっくり推定（usage が返らない場合の代替）
+    - 日本語などの非ASCII文字：1文字 ≒ 1トークン
+    - ASCII文字：4文字 ≒ 1トークン
     """
-    images: list[Image.Image] = []
-
-    # ---- 日本語フォント設定 ----
-    FONT_CANDIDATES = [
-        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
-        "C:/Windows/Fonts/meiryo.ttc",
-        "/System/Library/Fonts/ヒラギノ角ゴシック W4.ttc",
-        "/System/Library/Fonts/Helvetica.ttc",
-    ]
-    font_path = next((f for f in FONT_CANDIDATES if os.path.exists(f)), None)
-    if font_path:
-        font_small = ImageFont.truetype(font_path, 20)
-    else:
-        font_small = ImageFont.load_default()
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_count = len(text) - non_ascii
+    return non_ascii + (ascii_count + 3) // 4
 
-    try:
-        prs = Presentation(pptx_path)
-        for i, slide in enumerate(prs.slides):
-            # スライドサイズ（EMU → px換算）
-            width_px = int(prs.slide_width / 9525)
-            height_px = int(prs.slide_height / 9525)
 
-            # 白背景キャンバス
-            img = Image.new("RGB", (width_px, height_px), "white")
-            draw = ImageDraw.Draw(img)
+def estimate_cost_usd(model: str, prompt_tokens, completion_tokens) -> float:
+    price = LLM_PRICING.get(model)
+    if not price:
+        return 0.0
+    return (
+        (prompt_tokens or 0) / 1000.0 * price.get("input", 0.0)
+        + (completion_tokens or 0) / 1000.0 * price.get("output", 0.0)
+    )
 
-            # === スライド上の図形を順に描画 ===
-            for shp in slide.shapes:
-                left = int(shp.left / 9525)
-                top = int(shp.top / 9525)
-                width = int(shp.width / 9525)
-                height = int(shp.height / 9525)
 
-                # 図形タイプで分岐
-                stype = shp.shape_type
+def _append_telemetry_line(rec: dict):
+    try:
+        LLM_TELEMETRY_LOG.parent.mkdir(parents=True, exist_ok=True)
+        with open(LLM_TELEMETRY_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    except Exception:
+        # ログが書けなくても画面側の処理は止めない
+        pass
 
-                # 画像
-                if stype == MSO_SHAPE_TYPE.PICTURE:
-                    try:
-                        image_bytes = io.BytesIO(shp.image.blob)
-                        pic = Image.open(image_bytes).convert("RGB")
-                        pic = pic.resize((width, height))
-                        img.paste(pic, (left, top))
-                    except Exception:
-                        draw.rectangle([left, top, left + width, top + height], outline="gray")
-                        draw.text((left + 4, top + 4), "画像読み込み失敗", font=font_small, fill="red")
 
-                # テキスト付き図形
-                elif getattr(shp, "has_text_frame", False):
-                    text = shp.text.strip()
-                    if text:
-                        # テキスト枠（背景塗り）
-                        draw.rectangle([left, top, left + width, top + height], outline="lightgray", fill=None)
-                        # テキスト（簡易左寄せ）
-                        lines = text.replace("\r", "").split("\n")
-                        y = top + 5
-                        for line in lines:
-                            draw.text((left + 8, y), line[:40], font=font_small, fill="black")
-                            y += 24
+def _telemetry_record(rec: dict):
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        runtime["telemetry"].append(rec)
+        _append_telemetry_line(rec)
 
-                # 図形（塗りつぶしのみ）
-                else:
-                    draw.rectangle([left, top, left + width, top + height], outline="lightgray", fill=None)
 
-            # スライド番号
-            draw.text((20, height_px - 40), f"Slide {i+1}", font=font_small, fill="gray")
+def record_parse_outcome(response: dict, ok: bool):
+    """
+    call_llm の応答を呼び出し元でパースした結果（成功／失敗）を計測ログに残す
+    """
+    call_id = (response or {}).get("call_id")
+    if not call_id:
+        return
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        for rec in reversed(runtime["telemetry"]):
+            if rec.get("call_id") == call_id:
+                rec["parse_ok"] = bool(ok)
+                break
+        if not ok:
+            # 解釈できなかった応答は再利用しない
+            for entries in runtime["semantic"].values():
+                for entry in [e for e in entries if e["result"].get("call_id") == call_id]:
+                    entries.remove(entry)
+        _append_telemetry_line({"event": "parse", "call_id": call_id, "parse_ok": bool(ok)})
+
+
+def get_telemetry_records(mode_name: str = None) -> list:
+    """メモリ上の計測記録を返す（mode_name 指定時はそのモードのみ）"""
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        records = list(runtime["telemetry"])
+    if mode_name:
+        records = [r for r in records if r.get("mode") == mode_name]
+    return records
+
+
+def _telemetry_chains(mode_name: str) -> list:
+    """
+    成功した呼び出しを「1回分の出力」ごとにまとめる（続きの依頼 continuation_of で分割された出力は合算）。
+    戻り値：[{"completion_tokens"（1候補あたり）, "latency_s"}]（古い順）。
+    打ち切られたまま終わった出力は本来の長さがわからないので除く。
+    """
+    chains = {}
+    for r in get_telemetry_records(mode_name):
+        if r.get("outcome") != "ok":
+            continue
+        root = r.get("continuation_of") or r.get("call_id")
+        chain = chains.setdefault(root, {"completion_tokens": 0.0, "latency_s": 0.0, "truncated": False})
+        # 複数候補（n>1）の記録は1候補あたりに換算する
+        chain["completion_tokens"] += (r.get("completion_tokens") or 0) / (r.get("n") or 1)
+        chain["latency_s"] += r.get("latency_s") or 0.0
+        chain["truncated"] = r.get("finish_reason") == "length"
+    return [
+        {"completion_tokens": c["completion_tokens"], "latency_s": c["latency_s"]}
+        for c in chains.values()
+        if not c["truncated"]
+    ]
 
-            images.append(img)
 
-        return images
+def adaptive_max_tokens(mode_name: str, default: int, messages: list = None) -> int:
+    """
+    そのモードで実際に出力されたトークン数の分布から max_tokens を決める。
+    - 続きの依頼（continuation_of）で分割された出力は合算して1回分として数える
+    - 直近の記録が LLM_ADAPTIVE_MIN_SAMPLES 件未満なら default（呼び出し元の定数）をそのまま使う
+    - p{LLM_ADAPTIVE_PERCENTILE} × 余裕率 + 固定の余裕を、コンテキスト長の残り（入力トークンを差し引いた分）で上限を切る
+    """
+    samples = [c["completion_tokens"] for c in _telemetry_chains(mode_name)][-LLM_ADAPTIVE_WINDOW:]
+    if len(samples) < LLM_ADAPTIVE_MIN_SAMPLES:
+        return default
 
-    except Exception as e:
-        st.error(f"PPT変換エラー: {e}")
-        return []
-from pptx.enum.shapes import MSO_SHAPE_TYPE
-from pptx.dml.color import RGBColor
-import base64
+    value = percentile(samples, LLM_ADAPTIVE_PERCENTILE) * LLM_ADAPTIVE_MARGIN_RATIO + LLM_ADAPTIVE_MARGIN_TOKENS
+    value = int(-(-value // 50) * 50)  # 50トークン単位に切り上げ
 
-def emu_to_percent(val_emu, total_emu):
-    """EMU単位をスライド全体に対する%へ変換"""
-    try:
-        return float(val_emu) / float(total_emu) * 100.0
-    except Exception:
-        return 0.0
+    prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in (messages or []))
+    remaining = LLM_CONTEXT_TOKENS - prompt_tokens
+    return max(64, min(value, LLM_MAX_OUTPUT_TOKENS, remaining))
 
 
-def color_to_css(rgb):
-    """RGBColor → CSSカラーコード"""
-    if not rgb:
-        return None
-    if isinstance(rgb, RGBColor):
-        return f"#{rgb.rgb:06X}"
-    try:
-        return f"#{int(rgb):06X}"
-    except Exception:
-        return None
+# 呼び出し前の見込み（所要時間・費用）。計測記録がこの件数未満のモードは max_tokens と全体の出力速度から概算する
+LLM_FORECAST_MIN_SAMPLES = 3
+LLM_FORECAST_TOKENS_PER_S = 40.0  # 記録が全くないときの出力速度（トークン/秒）
+LLM_FORECAST_TTFT_S = 1.5
 
 
-def extract_slide_model(prs, slide_index=0):
+def forecast_llm_calls(mode_name: str, requests: list, max_tokens: int, n: int = 1, parallel: int = 1) -> dict:
     """
-    PowerPointスライド内の図形を走査し、
-    Streamlit用のHTML描画モデルに変換する。
-    - PICTURE：画像
-    - TEXT：テキストボックス
-    - TABLE：セルの文字を連結して1つのテキストブロックとして描画（★追加）
+    呼び出し前に、入力トークン・出力トークン・所要時間・費用の見込みを出す。
+    - requests：これから投げる messages のリスト（1要素＝1リクエスト。run_llm_fanout と同じ形）
+    - 入力はプロンプトから推定し、出力と所要時間はそのモードの計測記録の中央値（p95 も併記）を使う
+    - parallel 件ずつ同時に投げる前提で、所要時間は「波」の数だけ掛ける
+    戻り値：{"prompt_tokens", "completion_tokens", "latency_s", "latency_p95_s", "cost_usd", "samples", "calls"}
     """
-    slide = prs.slides[slide_index]
-    sw, sh = prs.slide_width, prs.slide_height
-    blocks = []
+    chains = _telemetry_chains(mode_name)[-LLM_ADAPTIVE_WINDOW:]
+    prompt_tokens = [sum(estimate_tokens(m.get("content", "")) for m in msgs) for msgs in requests] or [0]
+    calls = len(prompt_tokens)
+
+    if len(chains) >= LLM_FORECAST_MIN_SAMPLES:
+        output = percentile([c["completion_tokens"] for c in chains], 50) * n
+        latency = percentile([c["latency_s"] for c in chains], 50)
+        latency_p95 = percentile([c["latency_s"] for c in chains], 95)
+    else:
+        # 全モードの記録から出力速度を求め、上限の6割程度が出力される前提で概算する
+        speeds = [
+            r["completion_tokens"] / r["latency_s"]
+            for r in get_telemetry_records()
+            if r.get("outcome") == "ok" and r.get("completion_tokens") and (r.get("latency_s") or 0) > 0
+        ]
+        speed = percentile(speeds, 50) or LLM_FORECAST_TOKENS_PER_S
+        output = max_tokens * 0.6 * n
+        latency = LLM_FORECAST_TTFT_S + output / speed
+        latency_p95 = LLM_FORECAST_TTFT_S + max_tokens * n / speed
+
+    waves = -(-calls // max(1, parallel))
+    model = resolve_route(mode_name)["deployment"]
+    return {
+        "prompt_tokens": sum(prompt_tokens),
+        "completion_tokens": int(output * calls),
+        "latency_s": latency * waves,
+        "latency_p95_s": latency_p95 * waves,
+        "cost_usd": sum(estimate_cost_usd(model, p, output) for p in prompt_tokens),
+        "samples": len(chains),
+        "calls": calls,
+    }
 
-    def add_block(shape, offset_left=0, offset_top=0):
-        stype = shape.shape_type
-        name = getattr(shape, "name", "")
-        editable = name.startswith("Edit_") or name.startswith("EDIT_")
 
-        left = shape.left + offset_left
-        top = shape.top + offset_top
-        width = shape.width
-        height = shape.height
+def format_forecast(forecast: dict) -> str:
+    """右ペインのボタンの上に出す見込みの文言"""
+    basis = f"過去{forecast['samples']}回の記録から" if forecast["samples"] >= LLM_FORECAST_MIN_SAMPLES else "記録が少ないため概算"
+    text = (
+        f"⏱ 見込み：約{forecast['latency_s']:.0f}秒（長くても{forecast['latency_p95_s']:.0f}秒）"
+        f"・約${forecast['cost_usd']:.3f}・入力 約{forecast['prompt_tokens']:,}トークン"
+    )
+    if forecast["calls"] > 1:
+        text += f"・{forecast['calls']}回に分けて実行"
+    return f"{text}（{basis}）"
 
-        base = {
-            "name": name,
-            "editable": editable,
-            "left": emu_to_percent(left, sw),
-            "top": emu_to_percent(top, sh),
-            "width": emu_to_percent(width, sw),
-            "height": emu_to_percent(height, sh),
-        }
 
-        # グループ処理
-        if stype == MSO_SHAPE_TYPE.GROUP:
-            for child in shape.shapes:
-                add_block(child, offset_left=left, offset_top=top)
-            return
+def percentile(values, q: float):
+    """values の q パーセンタイル（0〜100、線形補間）。空なら None"""
+    vals = sorted(v for v in values if v is not None)
+    if not vals:
+        return None
+    if len(vals) == 1:
+        return float(vals[0])
+    pos = (len(vals) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(vals) - 1)
+    return float(vals[lo] + (vals[hi] - vals[lo]) * (pos - lo))
+
+
+def _cassette_path(mode_name: str, key: str) -> Path:
+    safe_mode = re.sub(r"[^\w\-]+", "_", mode_name) or "default"
+    return LLM_CASSETTE_DIR / safe_mode / f"{key}.json"
+
+
+def _cassette_key(model: str, messages: list, temperature: float, max_tokens: int, n: int = 1) -> str:
+    """リクエスト内容から決定的なキーを作る（同じ入力なら同じキー）"""
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    if n > 1:
+        request["n"] = n  # 既存のカセットのキーを変えないよう、複数候補のときだけ含める
+    payload = json.dumps(
+        request,
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-        # 画像処理
-        if stype == MSO_SHAPE_TYPE.PICTURE:
+
+def _cassette_record(mode_name: str, key: str, request: dict, result: dict):
+    """応答をカセットファイルに追記する（同じリクエストが複数回あれば順番に保持）"""
+    path = _cassette_path(mode_name, key)
+    with _llm_runtime()["lock"]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {"request": request, "interactions": []}
+        if path.exists():
             try:
-                content_type = getattr(shape.image, "content_type", "image/png")
-                b64 = base64.b64encode(shape.image.blob).decode("ascii")
-                base["type"] = "picture"
-                base["src"] = f"data:{content_type};base64,{b64}"
+                data = json.loads(path.read_text(encoding="utf-8"))
             except Exception:
                 pass
-            blocks.append(base)
-            return
+        data["interactions"].append(
+            {
+                "recorded_at": datetime.now().isoformat(),
+                "response": result,
+            }
+        )
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
 
-        # 塗り（背景色）
-        fill_css = None
-        try:
-            if shape.fill and shape.fill.type == 1:  # solid fill
-                fill_css = color_to_css(shape.fill.fore_color.rgb)
-        except Exception:
+
+def _cassette_replay(mode_name: str, key: str, control=None) -> dict:
+    """
+    カセットから応答を取り出す。
+    同じリクエストが複数回記録されている場合は記録順に返し、最後の応答以降は最後を繰り返す。
+    """
+    path = _cassette_path(mode_name, key)
+    if not path.exists():
+        raise CassetteMissError(f"カセットに記録がありません（mode={mode_name}, key={key[:12]}）")
+
+    data = json.loads(path.read_text(encoding="utf-8"))
+    interactions = data.get("interactions", [])
+    if not interactions:
+        raise CassetteMissError(f"カセットが空です（mode={mode_name}, key={key[:12]}）")
+
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        idx = runtime["replay_counters"].get(key, 0)
+        runtime["replay_counters"][key] = idx + 1
+    result = dict(interactions[min(idx, len(interactions) - 1)]["response"])
+
+    # 記録時の所要時間（倍率付き）だけ待ってから返す
+    wait = float(result.get("latency_s", 0.0)) * LLM_REPLAY_LATENCY_SCALE
+    if wait > 0:
+        if control is not None:
+            if control.event.wait(wait):
+                raise LLMCancelledError("生成をキャンセルしました。")
+        else:
+            time.sleep(wait)
+    result["replayed"] = True
+    return result
+
+
+def summarize_telemetry(records: list) -> list:
+    """
+    計測記録をモード別に集計する（診断ビュー用）
+    - 呼び出し数・エラー数・リトライ数
+    - 所要時間／TTFT の p50・p95
+    - 平均トークン数・費用合計・パース成功率・max_tokens 到達（length）件数・ヘッジ発生件数
+    - ルーティング表の目標値（所要時間 p95・1回あたりの費用）と達成状況
+    """
+    by_mode = {}
+    for rec in records:
+        by_mode.setdefault(rec.get("mode", "（不明）"), []).append(rec)
+
+    rows = []
+    for mode_name, recs in sorted(by_mode.items()):
+        ok = [r for r in recs if r.get("outcome") == "ok"]
+        parsed = [r for r in ok if r.get("parse_ok") is not None]
+        latencies = [r.get("latency_s") for r in ok]
+        ttfts = [r.get("ttft_s") for r in ok]
+        p50 = percentile(latencies, 50)
+        p95 = percentile(latencies, 95)
+        ttft50 = percentile(ttfts, 50)
+        ttft95 = percentile(ttfts, 95)
+        route = resolve_route(mode_name)
+        cost_per_call = sum(r.get("cost_usd") or 0.0 for r in ok) / len(ok) if ok else None
+        target_latency = route.get("target_latency_s")
+        target_cost = route.get("target_cost_usd")
+        rows.append(
+            {
+                "モード": mode_name,
+                "デプロイメント": route["deployment"],
+                "呼び出し数": len(recs),
+                "エラー数": len(recs) - len(ok),
+                "リトライ数": sum(r.get("retries", 0) or 0 for r in recs),
+                "所要時間p50(秒)": round(p50, 2) if p50 is not None else None,
+                "所要時間p95(秒)": round(p95, 2) if p95 is not None else None,
+                "TTFT p50(秒)": round(ttft50, 2) if ttft50 is not None else None,
+                "TTFT p95(秒)": round(ttft95, 2) if ttft95 is not None else None,
+                "平均入力トークン": round(sum(r.get("prompt_tokens") or 0 for r in ok) / len(ok)) if ok else None,
+                "平均出力トークン": round(sum(r.get("completion_tokens") or 0 for r in ok) / len(ok)) if ok else None,
+                "費用合計(USD)": round(sum(r.get("cost_usd") or 0.0 for r in ok), 4),
+                "パース成功率": (
+                    f"{sum(1 for r in parsed if r.get('parse_ok')) / len(parsed):.0%}" if parsed else "-"
+                ),
+                "length打ち切り": sum(1 for r in ok if r.get("finish_reason") == "length"),
+                "ヘッジ発生": sum(1 for r in ok if r.get("hedged")),
+                "目標p95(秒)": target_latency,
+                "目標費用/回(USD)": target_cost,
+                "目標達成": (
+                    "-" if p95 is None
+                    else "✅" if (target_latency is None or p95 <= target_latency)
+                    and (target_cost is None or cost_per_call <= target_cost)
+                    else "⚠️"
+                ),
+            }
+        )
+    return rows
+
+
+def _stream_completion(model: str, messages: list, temperature: float, max_tokens: int, control=None,
+                       llm_client=None, n: int = 1) -> dict:
+    """
+    ストリーミングで1回呼び出し、最初のトークンまでの時間（TTFT）と全体の所要時間を測る
+    - control（JobControl）が渡された場合は、キャンセル時にストリームを閉じて通信を中断する
+    - llm_client を省略した場合は既定のエンドポイント（client）を使う
+    - n > 1 のときは1回のリクエストで n 件の候補を受け取り、"choices" に候補ごとの本文を入れる
+    """
+    llm_client = llm_client or client
+    runtime = _llm_runtime()
+    kwargs = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    if n > 1:
+        kwargs["n"] = n
+    if runtime["stream_usage"]:
+        kwargs["stream_options"] = {"include_usage": True}
+
+    if control is not None:
+        control.raise_if_cancelled()
+
+    started = time.perf_counter()
+    try:
+        stream = llm_client.chat.completions.create(**kwargs)
+    except openai.BadRequestError:
+        # 古い API バージョンでは stream_options が使えないため外して再送する
+        if "stream_options" not in kwargs:
+            raise
+        runtime["stream_usage"] = False
+        kwargs.pop("stream_options")
+        stream = llm_client.chat.completions.create(**kwargs)
+
+    if control is not None:
+        control.register_stream(stream)
+
+    parts = [[] for _ in range(max(n, 1))]
+    ttft_s = None
+    finish_reasons = [None] * max(n, 1)
+    usage = None
+    try:
+        for chunk in stream:
+            if control is not None:
+                control.raise_if_cancelled()
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            # Azure はコンテンツフィルター結果だけのチャンク（choices が空）を返すことがある
+            if not chunk.choices:
+                continue
+            for choice in chunk.choices:
+                idx = getattr(choice, "index", 0) or 0
+                if idx >= len(parts):
+                    continue
+                delta = choice.delta.content if choice.delta else None
+                if delta:
+                    if ttft_s is None:
+                        ttft_s = time.perf_counter() - started
+                    parts[idx].append(delta)
+                    if control is not None:
+                        control.add_streamed_chars(len(delta))
+                if choice.finish_reason:
+                    finish_reasons[idx] = choice.finish_reason
+    except Exception:
+        # キャンセルでストリームを閉じた場合は通信エラーではなくキャンセルとして扱う
+        if control is not None and control.cancelled:
+            raise LLMCancelledError("生成をキャンセルしました。")
+        raise
+    finally:
+        if control is not None:
+            control.unregister_stream(stream)
+        try:
+            stream.close()
+        except Exception:
             pass
+    latency_s = time.perf_counter() - started
+
+    choices = ["".join(p) for p in parts]
+    content = choices[0]
+    # 候補のどれかが打ち切られていれば length として扱う
+    finish_reason = "length" if "length" in finish_reasons else finish_reasons[0]
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    result = {
+        "content": content,
+        "finish_reason": finish_reason,
+        "prompt_tokens": (
+            prompt_tokens if prompt_tokens is not None
+            else sum(estimate_tokens(m.get("content", "")) for m in messages)
+        ),
+        "completion_tokens": (
+            completion_tokens if completion_tokens is not None else sum(estimate_tokens(c) for c in choices)
+        ),
+        "usage_estimated": usage is None,
+        "ttft_s": ttft_s,
+        "latency_s": latency_s,
+        "model": model,
+    }
+    if n > 1:
+        result["choices"] = choices
+    return result
 
-        # ★ TABLE（表）の処理を追加：セルのテキストを連結して1ブロックとして描画
-        if stype == MSO_SHAPE_TYPE.TABLE:
+
+@st.cache_resource(show_spinner=False)
+def _llm_endpoints():
+    """既定のエンドポイントと LLM_ENDPOINTS_JSON の追加エンドポイント（クライアントは使い回す）"""
+    endpoints = [{"name": "default", "client": None, "deployments": {}}]
+    for i, conf in enumerate(LLM_ENDPOINTS):
+        try:
+            endpoint_client = AzureOpenAI(
+                api_key=conf.get("api_key") or os.getenv(conf.get("api_key_env", ""), os.getenv("OPENAI_API_KEY")),
+                azure_endpoint=conf["endpoint"],
+                api_version=conf.get("api_version") or os.getenv("AZURE_OPENAI_API_VERSION"),
+                max_retries=0,
+            )
+        except Exception:
+            continue
+        endpoints.append(
+            {
+                "name": conf.get("name") or f"endpoint{i + 1}",
+                "client": endpoint_client,
+                "deployments": conf.get("deployments", {}),
+            }
+        )
+    return endpoints
+
+
+def _healthy_endpoints() -> list:
+    """サーキットブレーカーが開いていないエンドポイント（すべて開いている場合は全件を返して試す）"""
+    runtime = _llm_runtime()
+    now = time.time()
+    endpoints = _llm_endpoints()
+    with runtime["lock"]:
+        healthy = [
+            ep for ep in endpoints
+            if runtime["breakers"].get(ep["name"], {}).get("open_until", 0) <= now
+        ]
+    return healthy or list(endpoints)
+
+
+def _breaker_report(endpoint_name: str, ok: bool):
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        state = runtime["breakers"].setdefault(endpoint_name, {"failures": 0, "open_until": 0})
+        if ok:
+            state["failures"] = 0
+            state["open_until"] = 0
+        else:
+            state["failures"] += 1
+            if state["failures"] >= LLM_BREAKER_THRESHOLD:
+                state["open_until"] = time.time() + LLM_BREAKER_COOLDOWN_S
+
+
+def hedge_deadline_s(mode_name: str) -> float:
+    """ヘッジを投げるまでの待ち時間：そのモードの所要時間 p95（記録が少なければルートの目標値）"""
+    latencies = [
+        r.get("latency_s") for r in get_telemetry_records(mode_name)
+        if r.get("outcome") == "ok" and not r.get("replayed")
+    ][-200:]
+    if len(latencies) >= LLM_HEDGE_MIN_SAMPLES:
+        deadline = percentile(latencies, 95)
+    else:
+        deadline = resolve_route(mode_name).get("target_latency_s") or 30.0
+    return max(float(deadline), 1.0)
+
+
+@st.cache_resource(show_spinner=False)
+def _hedge_executor():
+    return ThreadPoolExecutor(max_workers=LLM_JOB_WORKERS * 2, thread_name_prefix="llm-attempt")
+
+
+def _complete_with_failover(mode_name: str, model: str, messages: list, temperature: float, max_tokens: int,
+                            control=None, n: int = 1) -> dict:
+    """
+    エンドポイントを順に試して1回分の応答を得る。
+    - 一時的なエラーなら次のエンドポイントへ切り替え、失敗はサーキットブレーカーに記録する
+    - ルートが hedge=True なら、期限（hedge_deadline_s）を過ぎた時点で次のエンドポイントにも投げ、
+      先に返ってきた応答を採用して残りは通信を中断する
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    endpoints = _healthy_endpoints()
+    hedge = bool(resolve_route(mode_name).get("hedge")) and len(endpoints) > 1
+    deadline = hedge_deadline_s(mode_name) if hedge else None
+
+    attempts = []  # (endpoint, 子の JobControl, future)
+
+    def _attempt(ep, sub_control):
+        deployment = ep["deployments"].get(model, model)
+        try:
+            result = _stream_completion(
+                deployment, messages, temperature, max_tokens, control=sub_control, llm_client=ep["client"], n=n
+            )
+        except LLMCancelledError:
+            raise
+        except _RETRYABLE_ERRORS:
+            _breaker_report(ep["name"], False)
+            raise
+        _breaker_report(ep["name"], True)
+        result["endpoint"] = ep["name"]
+        return result
+
+    def _start(ep):
+        sub_control = control.child() if control is not None else JobControl()
+        attempts.append((ep, sub_control, _hedge_executor().submit(_attempt, ep, sub_control)))
+        return attempts[-1][2]
+
+    pending = {_start(endpoints[0])}
+    last_error = None
+    while pending:
+        timeout = deadline if (hedge and len(attempts) == 1) else None
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        if not done:
+            # 期限切れ：ヘッジとして次のエンドポイントにも投げる
+            if len(attempts) < len(endpoints):
+                pending.add(_start(endpoints[len(attempts)]))
+            continue
+
+        for future in done:
             try:
-                table = shape.table
-                rows_text = []
-                for row in table.rows:
-                    cells = [
-                        cell.text.replace("\n", " ").strip()
-                        for cell in row.cells
-                    ]
-                    # 全部空なら無視
-                    if any(cells):
-                        rows_text.append(" | ".join(cells))
-                text = "\n".join(rows_text).strip()
-                if text:
-                    blocks.append(
-                        {
-                            **base,
-                            "type": "text",
-                            "text": text,
-                            "fill": fill_css,
-                        }
-                    )
+                result = future.result()
+            except LLMCancelledError as e:
+                last_error = e
+            except _RETRYABLE_ERRORS as e:
+                last_error = e
             except Exception:
-                # 失敗したら単なるボックスとして描画
-                blocks.append({**base, "type": "box", "fill": fill_css})
-            return
+                for _, sub_control, _f in attempts:
+                    sub_control.cancel()
+                raise
+            else:
+                for _, sub_control, other in attempts:
+                    if other is not future:
+                        sub_control.cancel()
+                result["hedged"] = len(attempts) > 1
+                return result
 
-        # テキスト付き図形
-        if getattr(shape, "has_text_frame", False):
-            blocks.append({**base, "type": "text", "text": shape.text, "fill": fill_css})
-        else:
-            # 図形（塗りだけ）
-            blocks.append({**base, "type": "box", "fill": fill_css})
+        if control is not None:
+            control.raise_if_cancelled()
+        # 失敗したら未使用のエンドポイントに切り替える（フェイルオーバー）
+        if not pending and len(attempts) < len(endpoints):
+            pending.add(_start(endpoints[len(attempts)]))
 
-    for shape in slide.shapes:
-        add_block(shape, 0, 0)
+    raise last_error
 
-    return {"blocks": blocks}
 
+def _prompt_ngrams(messages: list, size: int = 3) -> dict:
+    """メッセージ全体の文字 n-gram の出現回数（表記ゆれ・空白の違いは正規化してから数える）"""
+    import unicodedata
 
-def render_slide_html(model, edited_texts):
+    text = "\n".join(f"{m.get('role')}:{m.get('content')}" for m in messages)
+    text = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).lower()
+    grams = {}
+    for i in range(max(len(text) - size + 1, 1)):
+        g = text[i:i + size]
+        grams[g] = grams.get(g, 0) + 1
+    return grams
+
+
+def _simhash(grams: dict) -> int:
+    """n-gram の出現回数から 64bit の SimHash を作る（候補の絞り込み用）"""
+    weights = [0] * 64
+    for g, count in grams.items():
+        h = int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += count if (h >> bit) & 1 else -count
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(v * b.get(k, 0) for k, v in a.items())
+    norm = (sum(v * v for v in a.values()) * sum(v * v for v in b.values())) ** 0.5
+    return dot / norm if norm else 0.0
+
+
+def semantic_cache_lookup(mode_name: str, messages: list, n: int = 1, owner: str = None):
     """
-    extract_slide_model()で抽出した構造をもとに、
-    Streamlit内でスライドの見た目を再現するHTMLを生成。
+    同じセッション・同じモードで入力が十分に似ている過去の応答を探す。見つかれば (result, similarity, saved_at)、なければ None。
+    SimHash のハミング距離で候補を絞り、n-gram のコサイン類似度をしきい値と比べる。
     """
-    blocks = model["blocks"]
+    threshold = LLM_SEMANTIC_THRESHOLDS.get(mode_name)
+    if not threshold:
+        return None
+    grams = _prompt_ngrams(messages)
+    fingerprint = _simhash(grams)
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        entries = list(runtime["semantic"].get(mode_name, ()))
+
+    best = None
+    for entry in entries:
+        if entry["owner"] != owner or entry["n"] != n or bin(entry["simhash"] ^ fingerprint).count("1") > 16:
+            continue
+        similarity = _cosine(grams, entry["grams"])
+        if similarity >= threshold and (best is None or similarity > best[1]):
+            best = (entry["result"], similarity, entry["saved_at"])
+    return best
 
-    html = """
-    <div style="position:relative; width:100%; padding-top:56.25%; background:#f8f9fb;
-                border-radius:14px; box-shadow:0 4px 16px rgba(0,0,0,0.08); overflow:hidden;">
-      <div style="position:absolute; inset:0; background:white;">
+
+def semantic_cache_store(mode_name: str, messages: list, result: dict, n: int = 1, owner: str = None):
+    if not LLM_SEMANTIC_THRESHOLDS.get(mode_name) or result.get("finish_reason") == "length":
+        return
+    grams = _prompt_ngrams(messages)
+    entry = {
+        "simhash": _simhash(grams),
+        "grams": grams,
+        "n": n,
+        "owner": owner,
+        "result": result,
+        "saved_at": time.time(),
+    }
+    runtime = _llm_runtime()
+    with runtime["lock"]:
+        runtime["semantic"].setdefault(mode_name, deque(maxlen=LLM_SEMANTIC_KEEP)).append(entry)
+
+
+def call_llm(
+    mode_name: str,
+    messages: list,
+    temperature: float = 0.6,
+    max_tokens: int = 900,
+    control=None,
+    max_continuations: int = None,
+    n: int = 1,
+) -> dict:
     """
+    すべての LLM 呼び出しの入口。
+    - mode_name：呼び出し元のモード名（カセットの振り分け・計測の集計単位）
+    - 戻り値：{"content", "finish_reason", "prompt_tokens", "completion_tokens",
+               "ttft_s", "latency_s", "retries", "model", "call_id", "segments"}
+    LLM_CASSETTE_MODE=record なら応答を記録し、replay なら記録から再生する。
+    呼び出しごとに計測記録（モード・トークン数・TTFT・所要時間・リトライ回数・finish_reason・費用）を残す。
+    パースの成否は呼び出し元で record_parse_outcome() を呼んで追記する。
+    control（JobControl）を渡すと、キャンセル時に通信を中断して LLMCancelledError を送出する。
+    max_tokens は呼び出し元の値を既定とし、計測記録が十分あれば adaptive_max_tokens() で調整する。
+    max_tokens で打ち切られた（finish_reason="length"）場合は、続きを最大 max_continuations 回
+    （既定は LLM_MAX_CONTINUATIONS）追加で依頼し、つなぎ合わせた結果を返す。
+    n > 1 なら1回のリクエストで n 件の候補を生成し、"choices" に候補の本文のリストを入れる
+    （入力トークンは1回分。候補ごとの続きの依頼は行わない）。
+    control.allow_reuse が True で、同じモードの過去の入力と十分に似ていれば、その応答を呼び出しなしで返す
+    （戻り値に "reused"、call_id は None。control.reused にも記録し、画面で再利用した下書きとして示す）。
+    """
+    if max_continuations is None:
+        max_continuations = LLM_MAX_CONTINUATIONS
+    semantic = LLM_CASSETTE_MODE == "off" and bool(LLM_SEMANTIC_THRESHOLDS.get(mode_name))
+    if semantic and control is not None and control.allow_reuse:
+        hit = semantic_cache_lookup(mode_name, messages, n, owner=control.owner)
+        if hit is not None:
+            cached, similarity, saved_at = hit
+            control.note_reuse(mode_name, similarity, saved_at)
+            return {
+                **cached,
+                "call_id": None,
+                "ttft_s": 0.0,
+                "latency_s": 0.0,
+                "reused": {"similarity": similarity, "saved_at": saved_at},
+            }
 
-    for b in blocks:
-        style = (
-            f"position:absolute; left:{b['left']}%; top:{b['top']}%; "
-            f"width:{b['width']}%; height:{b['height']}%;"
+    if LLM_ADAPTIVE_MAX_TOKENS and LLM_CASSETTE_MODE == "off":
+        max_tokens = adaptive_max_tokens(mode_name, max_tokens, messages)
+
+    if n > 1:
+        max_continuations = 0
+
+    result = _call_llm_once(mode_name, messages, temperature, max_tokens, control=control, n=n)
+    segments = 1
+    first_call_id = result["call_id"]
+    while result.get("finish_reason") == "length" and segments <= max_continuations:
+        followup = messages + [
+            {"role": "assistant", "content": result["content"]},
+            {"role": "user", "content": LLM_CONTINUATION_PROMPT},
+        ]
+        tail = _call_llm_once(
+            mode_name, followup, temperature, max_tokens, control=control, continuation_of=first_call_id
         )
-        content = ""
+        segments += 1
+        result = {
+            **tail,
+            "content": stitch_continuation(result["content"], tail["content"]),
+            "prompt_tokens": (result.get("prompt_tokens") or 0) + (tail.get("prompt_tokens") or 0),
+            "completion_tokens": (result.get("completion_tokens") or 0) + (tail.get("completion_tokens") or 0),
+            "ttft_s": result.get("ttft_s"),
+            "latency_s": (result.get("latency_s") or 0.0) + (tail.get("latency_s") or 0.0),
+            "retries": result.get("retries", 0) + tail.get("retries", 0),
+        }
+    result["segments"] = segments
+    if semantic:
+        semantic_cache_store(mode_name, messages, result, n, owner=control.owner if control is not None else None)
+    return result
 
-        # 画像
-        if b.get("type") == "picture" and b.get("src"):
-            content = (
-                f'<img src="{b["src"]}" style="width:100%;height:100%;object-fit:contain;">'
-            )
 
-        # テキスト
-        elif b.get("type") == "text":
-            text_val = edited_texts.get(b["name"], b.get("text", ""))
-            bg = f'background:{b["fill"]};' if b.get("fill") else ""
-            content = (
-                f'<div style="{bg}padding:6px;font-family:\'Noto Sans JP\',sans-serif;'
-                f'font-size:13px;color:#111;white-space:pre-wrap;">{text_val}</div>'
-            )
+def stitch_continuation(head: str, tail: str) -> str:
+    """
+    続きの出力をつなぐ。モデルが直前の末尾を繰り返して書き始めた場合は重複部分を取り除く。
+    コードブロックで包み直して返ってきた場合はその記号も外す。
+    JSON の出力なら、重複を取り除く／取り除かないの各案のうち JSON として解釈できる案を選ぶ
+    （1文字の重複も判定できる）。それ以外は8文字以上の重複だけを取り除く（短い一致は偶然のことが多い）。
+    """
+    tail = re.sub(r"^\s*```(?:json)?\s*\n", "", tail)
+    if not head.lstrip().startswith("```"):
+        tail = re.sub(r"\n?```\s*$", "", tail)
+    overlaps = [n for n in range(min(len(head), len(tail), 200), 0, -1) if head.endswith(tail[:n])]
+    options = [head + tail[n:] for n in overlaps] + [head + tail]
+
+    if _json_body(head)[:1] in ("[", "{"):
+        states = [_json_state(text) for text in options]
+        # 完結して解釈できる案 → まだ途中だが壊れていない案（さらに続きがある場合）の順に選ぶ
+        for wanted in ("complete", "prefix"):
+            for text, state in zip(options, states):
+                if state == wanted:
+                    return text
+
+    if overlaps and overlaps[0] >= 8:
+        return options[0]
+    return head + tail
+
+
+def _json_body(text: str) -> str:
+    """コードブロックの記号を外した本文"""
+    text = re.sub(r"^\s*```(?:json)?\s*", "", text)
+    return re.sub(r"```\s*$", "", text).strip()
+
+
+def _json_state(text: str) -> str:
+    """JSON として "complete"（解釈できる）／"prefix"（途中で切れているだけ）／"broken" のどれか"""
+    body = _json_body(text)
+    try:
+        json.loads(body)
+        return "complete"
+    except json.JSONDecodeError as e:
+        if e.pos >= len(body) or e.msg.startswith("Unterminated string"):
+            return "prefix"
+        return "broken"
+
+
+def _call_llm_once(
+    mode_name: str,
+    messages: list,
+    temperature: float,
+    max_tokens: int,
+    control=None,
+    continuation_of: str = None,
+    n: int = 1,
+) -> dict:
+    """call_llm の1リクエスト分（記録／再生・リトライ・計測を行う）"""
+    model = resolve_route(mode_name)["deployment"]
+    key = _cassette_key(model, messages, temperature, max_tokens, n)
+    call_id = uuid.uuid4().hex[:12]
+    retries = 0
+    started = time.perf_counter()
 
-        html += f'<div style="{style}">{content}</div>'
+    try:
+        if LLM_CASSETTE_MODE == "replay":
+            result = _cassette_replay(mode_name, key, control=control)
+        else:
+            while True:
+                try:
+                    result = _complete_with_failover(
+                        mode_name, model, messages, temperature, max_tokens, control=control, n=n
+                    )
+                    break
+                except openai.NotFoundError:
+                    # ルーティング先のデプロイメントが存在しない環境では既定のデプロイメントで呼び直す
+                    if model == DEPLOYMENT:
+                        raise
+                    model = DEPLOYMENT
+                except _RETRYABLE_ERRORS:
+                    if retries >= LLM_MAX_RETRIES:
+                        raise
+                    retries += 1
+                    backoff = min(2 ** retries, 10)
+                    if control is not None:
+                        if control.event.wait(backoff):
+                            raise LLMCancelledError("生成をキャンセルしました。")
+                    else:
+                        time.sleep(backoff)
+
+            if LLM_CASSETTE_MODE == "record":
+                request = {
+                    "mode": mode_name,
+                    "model": model,
+                    "messages": messages,
+                    "temperature": temperature,
+                    "max_tokens": max_tokens,
+                    "n": n,
+                }
+                try:
+                    _cassette_record(mode_name, key, request, result)
+                except Exception:
+                    # 記録に失敗しても画面側の処理は止めない
+                    pass
 
-    html += "</div></div>"
-    return html
+    except Exception as e:
+        _telemetry_record(
+            {
+                "ts": datetime.now().isoformat(timespec="seconds"),
+                "call_id": call_id,
+                "mode": mode_name,
+                "model": model,
+                "outcome": "cancelled" if isinstance(e, LLMCancelledError) else "error",
+                "error": f"{type(e).__name__}: {e}"[:300],
+                "retries": retries,
+                "latency_s": time.perf_counter() - started,
+                "max_tokens": max_tokens,
+                "continuation_of": continuation_of,
+            }
+        )
+        raise
+
+    result["call_id"] = call_id
+    result["retries"] = retries
+    _telemetry_record(
+        {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "call_id": call_id,
+            "mode": mode_name,
+            "model": result.get("model", model),
+            "outcome": "ok",
+            "prompt_tokens": result.get("prompt_tokens"),
+            "completion_tokens": result.get("completion_tokens"),
+            "ttft_s": result.get("ttft_s"),
+            "latency_s": result.get("latency_s"),
+            "retries": retries,
+            "finish_reason": result.get("finish_reason"),
+            "parse_ok": None,
+            "cost_usd": estimate_cost_usd(
+                result.get("model", model), result.get("prompt_tokens"), result.get("completion_tokens")
+            ),
+            "max_tokens": max_tokens,
+            "replayed": bool(result.get("replayed")),
+            "endpoint": result.get("endpoint"),
+            "hedged": bool(result.get("hedged")),
+            "continuation_of": continuation_of,
+            "n": n,
+        }
+    )
+    return result
 
-def parse_ai_output(text: str):
-    """AI出力を6項目に分割"""
-    sections = {
-        "目標": "",
-        "現状": "",
-        "ビジネス課題": "",
-        "調査目的": "",
-        "問い": "",
-        "仮説": "",
+
+# =========================
+# バックグラウンド生成ジョブ（再実行をまたいで実行・キャンセル可能）
+# =========================
+from concurrent.futures import ThreadPoolExecutor
+
+LLM_JOB_WORKERS = int(os.getenv("LLM_JOB_WORKERS", "8"))
+
+
+class LLMCancelledError(RuntimeError):
+    """ユーザーが生成ジョブをキャンセルした場合の例外"""
+
+
+class LLMOutputError(ValueError):
+    """AI出力を想定の形式として解釈できなかった場合の例外（detail に生テキストを持たせる）"""
+
+    def __init__(self, message: str, detail: str = ""):
+        super().__init__(message)
+        self.detail = detail
+
+
+class JobControl:
+    """
+    生成ジョブ1件ぶんのキャンセル制御。
+    cancel() で停止フラグを立て、通信中のストリームを閉じて HTTP リクエストを中断する。
+    """
+
+    def __init__(self, parent=None, allow_reuse: bool = False, owner: str = None):
+        self.event = threading.Event()
+        self.streamed_chars = 0  # これまでに受信した文字数（進捗表示用）
+        self.parent = parent
+        self.allow_reuse = allow_reuse  # 類似の入力に対する過去の応答を再利用してよいか
+        # 依頼したセッション（類似応答の再利用をセッション内に限るため）
+        self.owner = owner if owner is not None or parent is None else parent.owner
+        self.reused = []  # 再利用した応答 {"mode", "similarity", "saved_at"}
+        self._streams = set()
+        self._children = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+        with self._lock:
+            streams = list(self._streams) + list(self._children)
+        for stream in streams:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def register_stream(self, stream):
+        with self._lock:
+            self._streams.add(stream)
+        # 登録前にキャンセルされていた場合もすぐに閉じる
+        if self.cancelled:
+            self.cancel()
+
+    def unregister_stream(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise LLMCancelledError("生成をキャンセルしました。")
+
+    def add_streamed_chars(self, n: int):
+        self.streamed_chars += n
+        if self.parent is not None:
+            self.parent.add_streamed_chars(n)
+
+    def note_reuse(self, mode_name: str, similarity: float, saved_at: float):
+        with self._lock:
+            self.reused.append({"mode": mode_name, "similarity": similarity, "saved_at": saved_at})
+
+    def child(self):
+        """
+        個別のリクエスト（ヘッジの片方など）だけを止めるための子コントロール。
+        親をキャンセルすると子もキャンセルされる。
+        """
+        sub = JobControl(parent=self)
+        with self._lock:
+            self._children.add(sub)
+        if self.cancelled:
+            sub.cancel()
+        return sub
+
+    # 親の cancel() からストリームと同様に閉じられる
+    close = cancel
+
+
+@st.cache_resource(show_spinner=False)
+def _job_executor():
+    """全セッションで共有するワーカースレッド"""
+    return ThreadPoolExecutor(max_workers=LLM_JOB_WORKERS, thread_name_prefix="llm-job")
+
+
+def llm_input_key(*parts) -> str:
+    """生成ジョブの入力（プロンプト等）から重複判定用のハッシュを作る"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def submit_llm_job(mode_name: str, label: str, work, on_done=None, input_key: str = None,
+                   allow_reuse: bool = True, forecast: dict = None) -> str:
+    """
+    生成処理をバックグラウンドで実行し、ジョブIDを返す。
+    - work(control)：ワーカースレッドで実行する関数。戻り値がジョブの結果になる
+      （ワーカーからは session_state に触れないこと。必要な入力は呼び出し前に取り出しておく）
+    - on_done(result)：完了後の再実行時にスクリプト側で呼ばれ、結果を session_state に反映する。
+      戻り値の文字列があれば完了メッセージとして表示する。
+    - input_key：同じモード・同じ入力のジョブが実行中なら、新しく投げずにそのジョブのIDを返す（二重クリック対策）
+    - allow_reuse：False なら類似の入力に対する過去の応答を再利用せず、必ず新しく生成する
+    - forecast：forecast_llm_calls() の見込み。渡すと実行中に進捗バーと残り時間を表示する
+    """
+    jobs = st.session_state.setdefault("llm_jobs", {})
+    if input_key is not None:
+        for job in jobs.values():
+            if job["mode"] == mode_name and job.get("input_key") == input_key and not job["future"].done():
+                return job["id"]
+
+    job_id = uuid.uuid4().hex[:8]
+    control, future, started_at = None, None, time.time()
+
+    # 同じ入力の先読み（run_speculative_prefetch）があれば、それを引き継ぐ（完了済みなら即座に反映される）
+    prefetched = st.session_state.get("llm_prefetch", {}).pop(f"{mode_name}:{input_key}", None) if input_key else None
+    if prefetched is not None and not allow_reuse and prefetched["control"].allow_reuse:
+        prefetched["control"].cancel()  # 再利用ありで先読みした結果は、新しく生成する指示には使わない
+        prefetched = None
+    if prefetched is not None:
+        pf = prefetched["future"]
+        if not (pf.done() and pf.exception() is not None):
+            control, future, started_at = prefetched["control"], pf, prefetched["started_at"]
+            st.session_state["prefetch_hits"] = st.session_state.get("prefetch_hits", 0) + 1
+
+    if future is None:
+        control = JobControl(allow_reuse=allow_reuse and semantic_cache_enabled(), owner=get_session_dir().name)
+        future = _job_executor().submit(work, control)
+
+    jobs[job_id] = {
+        "id": job_id,
+        "mode": mode_name,
+        "label": label,
+        "input_key": input_key,
+        "control": control,
+        "future": future,
+        "work": work,
+        "on_done": on_done,
+        "started_at": started_at,
+        "forecast": forecast,
     }
-    for key in sections.keys():
-        pattern = rf"【{key}】(.*?)(?=【|$)"
-        m = re.search(pattern, text, re.DOTALL)
-        if m:
-            sections[key] = m.group(1).strip()
-    return sections
+    return job_id
 
 
+def semantic_cache_enabled() -> bool:
+    """このセッションで類似の入力に対する過去の応答を再利用するか（左ペイン「運用」の設定）"""
+    return bool(st.session_state.get("semantic_cache_enabled", LLM_SEMANTIC_CACHE))
 
-from pptx.enum.shapes import MSO_SHAPE_TYPE  # 既にインポート済みならこの行は重複していてもOK
 
-from pptx.enum.shapes import MSO_SHAPE_TYPE  # 既にインポート済みならこの行は重複していてもOK
-from pptx.dml.color import RGBColor         # ← これも上にあれば重複OK
+def find_running_job(mode_name: str):
+    """指定モードで実行中のジョブがあれば返す"""
+    for job in st.session_state.get("llm_jobs", {}).values():
+        if job["mode"] == mode_name and not job["future"].done():
+            return job
+    return None
 
-def set_text_to_named_shape(slide, shape_name: str, text: str) -> bool:
+
+def get_llm_job_outcome(mode_name: str, input_key: str):
     """
-    スライド内の図形（グループ内も含む）から name=shape_name を探し、
-    テキストを書き込む。見つかれば True、見つからなければ False を返す。
-    - オートシェイプ／プレースホルダー：.text に書き込む
-    - テーブル：全セルに同じテキストを書き込む（暫定）
-    - 書き込んだテキストの文字色は黒（RGB 0,0,0）に設定する
+    同じモード・同じ入力で完了したジョブの結果（"ok" / "failed"）を返す。未実行なら None。
+    自動実行する処理で、失敗した入力を再実行のたびに呼び直さないために使う。
     """
+    return st.session_state.get("llm_job_outcomes", {}).get(f"{mode_name}:{input_key}")
 
-    def _set_font_black_textframe(text_frame):
-        """text_frame 内の全 run のフォント色を黒にする"""
+
+def forget_llm_job_outcome(mode_name: str, input_key: str):
+    st.session_state.get("llm_job_outcomes", {}).pop(f"{mode_name}:{input_key}", None)
+
+
+def cancel_llm_job(job_id: str):
+    job = st.session_state.get("llm_jobs", {}).get(job_id)
+    if job:
+        job["control"].cancel()
+
+
+LLM_FANOUT_PARALLELISM = int(os.getenv("LLM_FANOUT_PARALLELISM", "4"))
+
+
+def run_llm_fanout(mode_name: str, requests, parse, control=None, retries: int = 1,
+                   max_workers: int = None, **llm_kwargs):
+    """
+    小さなリクエストを同時実行数を絞って並列に投げ、結果を入力と同じ順序で返す（ジョブのワーカー内で使う）。
+    - requests：messages のリスト（1要素＝1リクエスト）
+    - parse(response)：call_llm の戻り値を解釈して結果を返す。失敗時は例外を送出する
+    - 失敗した要素だけを retries 回まで再試行する
+    戻り値：(results, errors)　results[i] は parse の戻り値（失敗時 None）、errors[i] は失敗理由（成功時 None）
+    """
+    n = len(requests)
+    results = [None] * n
+    errors = [None] * n
+    pending = list(range(n))
+
+    def _one(i):
+        response = call_llm(mode_name, requests[i], control=control, **llm_kwargs)
         try:
-            for paragraph in text_frame.paragraphs:
-                for run in paragraph.runs:
-                    if run.font is not None:
-                        run.font.color.rgb = RGBColor(0, 0, 0)
+            value = parse(response)
         except Exception:
-            # フォーマット構造が想定外でも落ちないようにする
-            pass
+            record_parse_outcome(response, False)
+            raise
+        record_parse_outcome(response, True)
+        return value
+
+    workers = max(1, min(max_workers or LLM_FANOUT_PARALLELISM, n or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-fanout") as pool:
+        for _ in range(retries + 1):
+            if not pending:
+                break
+            futures = {i: pool.submit(_one, i) for i in pending}
+            pending = []
+            for i, future in futures.items():
+                try:
+                    results[i] = future.result()
+                    errors[i] = None
+                except LLMCancelledError:
+                    raise
+                except Exception as e:
+                    errors[i] = str(e) or type(e).__name__
+                    pending.append(i)
+            if control is not None:
+                control.raise_if_cancelled()
 
-    def _search(shapes):
-        for shp in shapes:
-            # グループ内なら再帰
-            if shp.shape_type == MSO_SHAPE_TYPE.GROUP:
-                if _search(shp.shapes):
-                    return True
-
-            # 名前一致チェック
-            if shp.name == shape_name:
-                # テキスト枠があるタイプ
-                if getattr(shp, "has_text_frame", False):
-                    shp.text = text
-                    _set_font_black_textframe(shp.text_frame)
-                    return True
-
-                # テーブルの場合
-                if shp.shape_type == MSO_SHAPE_TYPE.TABLE:
-                    try:
-                        for row in shp.table.rows:
-                            for cell in row.cells:
-                                cell.text = text
-                                _set_font_black_textframe(cell.text_frame)
-                        return True
-                    except Exception:
-                        pass
+    return results, errors
 
-        return False
 
-    return _search(slide.shapes)
+def harvest_llm_jobs():
+    """
+    完了したジョブの結果を session_state に反映する（毎回の再実行の冒頭で呼ぶ）。
+    ユーザーが別のモードに移動していても、結果はここで取り込まれる。
+    """
+    jobs = st.session_state.get("llm_jobs", {})
+    notices = st.session_state.setdefault("llm_job_notices", [])
+    outcomes = st.session_state.setdefault("llm_job_outcomes", {})
 
+    for job_id, job in list(jobs.items()):
+        future = job["future"]
+        if not future.done():
+            continue
+        del jobs[job_id]
+        outcome_key = f"{job['mode']}:{job.get('input_key')}" if job.get("input_key") else None
 
-def parse_ai_output(text: str):
-    """AI出力を6項目に分割"""
-    sections = {
-        "目標": "",
-        "現状": "",
-        "ビジネス課題": "",
-        "調査目的": "",
-        "問い": "",
-        "仮説": "",
-    }
-    for key in sections.keys():
-        pattern = rf"【{key}】(.*?)(?=【|$)"
-        m = re.search(pattern, text, re.DOTALL)
-        if m:
-            sections[key] = m.group(1).strip()
-    return sections
+        try:
+            result = future.result()
+        except LLMCancelledError:
+            notices.append(("info", f"{job['label']}をキャンセルしました。", ""))
+            continue
+        except LLMOutputError as e:
+            if outcome_key:
+                outcomes[outcome_key] = "failed"
+            notices.append(("error", f"{job['label']}：{e}", e.detail))
+            continue
+        except Exception as e:
+            if outcome_key:
+                outcomes[outcome_key] = "failed"
+            notices.append(("error", f"{job['label']}でAI呼び出しエラーが発生しました: {e}", ""))
+            continue
 
+        if outcome_key:
+            outcomes[outcome_key] = "ok"
 
-# ★ 調査仕様の項目（ラベルと session_state のキー）
-SPEC_ITEMS = [
-    ("調査手法", "spec_method"),
-    ("抽出方法", "spec_sampling"),
-    ("調査地域", "spec_region"),
-    ("対象者条件", "spec_target"),
-    ("サンプルサイズ", "spec_sample_size"),
-    ("調査ボリューム", "spec_volume"),
-    ("提示物", "spec_stimulus"),
+        try:
+            message = job["on_done"](result) if job["on_done"] else None
+        except Exception as e:
+            notices.append(("error", f"{job['label']}の結果を反映できませんでした: {e}", ""))
+        else:
+            if not isinstance(message, str) or not message:
+                message = f"{job['label']}が完了しました。"
+            notices.append(("success", message, ""))
+            # 前の工程の下書きが確定した合図（次の工程の先読みを待たずに始める）
+            st.session_state.setdefault("prefetch_finalized", set()).add(job["mode"])
+            if job["control"].reused:
+                # 再利用した下書きは、確認するか新しく生成し直すまで右ペインに表示し続ける
+                st.session_state.setdefault("llm_reused_jobs", {})[job_id] = {
+                    "mode": job["mode"],
+                    "label": job["label"],
+                    "input_key": job.get("input_key"),
+                    "work": job["work"],
+                    "on_done": job["on_done"],
+                    "forecast": job.get("forecast"),
+                    "similarity": min(r["similarity"] for r in job["control"].reused),
+                    "saved_at": min(r["saved_at"] for r in job["control"].reused),
+                }
+
+
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+# 部分再実行が使えない版では、ポーラーは通常の関数として1回だけ描画し、
+# スクリプト末尾で画面全体を1秒ごとに再実行して進捗を更新する
+LLM_POLL_WITH_FRAGMENT = _fragment is not None
+if _fragment is None:
+    def _fragment(run_every=None):
+        return lambda func: func
+
+
+@_fragment(run_every=1.0)
+def _llm_job_poller():
+    """実行中ジョブの状態を1秒ごとに更新し、完了したら画面全体を再実行する"""
+    jobs = st.session_state.get("llm_jobs", {})
+    if any(job["future"].done() for job in jobs.values()):
+        st.rerun()
+
+    for job_id, job in list(jobs.items()):
+        elapsed = time.time() - job["started_at"]
+        c1, c2 = st.columns([3, 1])
+        with c1:
+            status = f"⏳ {job['label']}（{elapsed:.0f}秒経過"
+            if job["control"].streamed_chars:
+                status += f"・{job['control'].streamed_chars}文字受信"
+            st.caption(status + "）")
+            if job.get("forecast"):
+                progress, text = _job_progress(job, elapsed)
+                st.progress(progress, text=text)
+        with c2:
+            if job["control"].cancelled:
+                st.caption("中止中…")
+            elif st.button("中止", key=f"cancel_job_{job_id}", use_container_width=True):
+                cancel_llm_job(job_id)
+
+
+def _job_progress(job: dict, elapsed: float):
+    """
+    見込みから進捗（0〜0.99）と残り時間の文言を出す。
+    受信が始まっていれば受信文字数（日本語は1文字≒1トークン）、それまでは経過時間で進める。
+    """
+    forecast = job["forecast"]
+    streamed = job["control"].streamed_chars
+    expected = forecast.get("completion_tokens") or 0
+    if streamed and expected:
+        fraction = streamed / expected
+        remaining = elapsed * (1 / fraction - 1) if fraction < 1 else 0.0
+    else:
+        fraction = elapsed / forecast["latency_s"] if forecast.get("latency_s") else 0.0
+        remaining = max(forecast.get("latency_s", 0.0) - elapsed, 0.0)
+
+    if fraction >= 1 or elapsed > forecast.get("latency_p95_s", float("inf")):
+        return 0.99, "見込みより時間がかかっています…"
+    return min(fraction, 0.99), f"残り 約{remaining:.0f}秒"
+
+
+def render_llm_job_panel():
+    """ジョブの完了メッセージと、実行中ジョブの進捗・中止ボタンを表示する"""
+    for kind, message, detail in st.session_state.get("llm_job_notices", []):
+        getattr(st, kind)(message)
+        if detail:
+            st.code(detail)
+    st.session_state["llm_job_notices"] = []
+
+    reused_jobs = st.session_state.get("llm_reused_jobs", {})
+    for job_id, info in list(reused_jobs.items()):
+        saved = datetime.fromtimestamp(info["saved_at"]).strftime("%m/%d %H:%M")
+        st.info(
+            f"♻ {info['label']}は、類似の入力（類似度 {info['similarity']:.0%}・{saved} に生成）に対する"
+            "過去の下書きを再利用しています。"
+        )
+        c1, c2 = st.columns(2)
+        with c1:
+            if st.button("新しく生成する", key=f"reused_fresh_{job_id}", use_container_width=True):
+                reused_jobs.pop(job_id)
+                submit_llm_job(
+                    info["mode"], info["label"], info["work"], info["on_done"],
+                    input_key=info["input_key"], allow_reuse=False, forecast=info["forecast"],
+                )
+                st.rerun()
+        with c2:
+            if st.button("このまま使う", key=f"reused_keep_{job_id}", use_container_width=True):
+                reused_jobs.pop(job_id)
+                st.rerun()
+
+    if st.session_state.get("llm_jobs"):
+        _llm_job_poller()
+
+
+def field_regen_messages(base_messages: list, current: dict, target: str, instruction: str = "") -> list:
+    """
+    1項目だけを再生成するためのメッセージを作る。
+    全体生成時と同じメッセージ（共通の前提）をそのまま先頭に置き、他の項目の現在値（編集済みを含む）を渡して、
+    対象項目の本文だけを出力させる。先頭が同一なのでプロンプトキャッシュも効く。
+    """
+    others = "\n".join(f"【{k}】\n{v}" for k, v in current.items() if k != target)
+    ask = f"""上記の依頼で作成した各項目の現在の内容は次のとおりです（担当者が編集している場合があります）。
+{others}
+
+【{target}】の内容だけを書き直してください。
+- 他の項目と矛盾しないようにしてください。
+- 本文のみを出力してください（見出し・前置き・コードブロックは不要）。"""
+    if current.get(target):
+        ask += f"\n\n▼現在の【{target}】\n{current[target]}"
+    if instruction:
+        ask += f"\n\n▼修正の方向性\n{instruction}"
+    return list(base_messages) + [{"role": "user", "content": ask}]
+
+
+def render_field_regenerator(mode_name: str, fields: list, context_key: str, max_tokens: int = 300):
+    """
+    右ペイン用：選んだ1項目だけをAIで再生成するUI。
+    - fields：[(ラベル, session_state のキー)]
+    - context_key：全体生成時のメッセージを保存した session_state のキー（未生成なら案内のみ表示）
+    """
+    base_messages = st.session_state.get(context_key)
+    st.markdown("#### 項目ごとに再生成")
+    if not base_messages:
+        st.caption("先に『下書きを作成』を実行すると、項目ごとに作り直せるようになります。")
+        return
+
+    labels = [label for label, _ in fields]
+    target = st.selectbox("再生成する項目", labels, key=f"{context_key}_regen_target")
+    instruction = st.text_input(
+        "修正の方向性（任意）", key=f"{context_key}_regen_instruction", placeholder="例：もっと具体的に"
+    )
+    if st.button("この項目だけ再生成", use_container_width=True, key=f"{context_key}_regen_button"):
+        state_key = dict(fields)[target]
+        current = {label: st.session_state.get(key, "") for label, key in fields}
+        messages = field_regen_messages(base_messages, current, target, instruction)
+
+        def _work(control, messages=messages, target=target):
+            response = call_llm(
+                f"{mode_name}/項目",
+                messages=messages,
+                temperature=0.6,
+                max_tokens=max_tokens,
+                control=control,
+            )
+            text = response["content"].strip()
+            text = re.sub(rf"^\s*【{re.escape(target)}】\s*", "", text).strip()
+            record_parse_outcome(response, bool(text))
+            if not text:
+                raise LLMOutputError(f"【{target}】の再生成結果が空でした。", response["content"])
+            return text
+
+        def _apply(text, state_key=state_key, target=target):
+            st.session_state[state_key] = text
+            return f"【{target}】を再生成しました。"
+
+        submit_llm_job(
+            f"{mode_name}/項目", f"【{target}】の再生成", _work, _apply, input_key=llm_input_key(messages)
+        )
+        st.rerun()
+
+
+# 1回のリクエストで生成する候補数の選択肢（n）
+LLM_CANDIDATE_CHOICES = [1, 2, 3]
+
+
+def render_candidate_picker(state_key: str, title: str, render_candidate, on_pick):
+    """
+    中央ペイン用：session_state[state_key] にある複数の候補を横並びで表示し、採用した1案を on_pick(候補) で反映する。
+    render_candidate(候補) は各列の中で候補の中身を表示する。
+    """
+    candidates = st.session_state.get(state_key)
+    if not candidates:
+        return
+
+    st.markdown(f"### 🔀 {title}（{len(candidates)}案）")
+    st.caption("採用する案を選ぶと、下の編集欄に反映されます。")
+    cols = st.columns(len(candidates))
+    for i, (col, candidate) in enumerate(zip(cols, candidates)):
+        with col:
+            st.markdown(f"**案{i + 1}**")
+            render_candidate(candidate)
+            if st.button("この案を採用", key=f"{state_key}_pick_{i}", use_container_width=True):
+                on_pick(candidate)
+                del st.session_state[state_key]
+                st.rerun()
+
+    if st.button("候補を閉じる", key=f"{state_key}_dismiss"):
+        del st.session_state[state_key]
+        st.rerun()
+    st.markdown("---")
+
+
+# =========================
+# 古いセッションの自動クリーンアップ
+# =========================
+def cleanup_old_sessions(days: int = 1):
+    """
+    最終アクセスから days 日以上経過したセッションディレクトリを削除
+    """
+    if not BASE_ROOT.exists():
+        return
+
+    now = datetime.now()
+    for child in BASE_ROOT.iterdir():
+        if not child.is_dir():
+            continue
+        # "_" で始まるディレクトリ（カセット・共有キャッシュなど）はセッションではないので対象外
+        if child.name.startswith("_"):
+            continue
+
+        marker = child / ".last_access"
+        try:
+            if marker.exists():
+                ts = datetime.fromisoformat(marker.read_text(encoding="utf-8"))
+            else:
+                # マーカーがない場合はディレクトリの更新時刻を使う
+                ts = datetime.fromtimestamp(child.stat().st_mtime)
+
+            if now - ts > timedelta(days=days):
+                shutil.rmtree(child, ignore_errors=True)
+        except Exception:
+            # 読み取り・削除で何かあってもアプリを落とさない
+            continue
+
+
+
+# =========================
+# セッション専用ディレクトリのヘルパーを作る
+# =========================
+import shutil
+from datetime import datetime, timedelta
+
+BASE_ROOT = Path("/home/streamlit_workspace")
+# セッションIDの形式（URL のクエリから受け取るので、この形以外は使わない）
+SESSION_ID_PATTERN = re.compile(r"\d{8}_\d{6}_[0-9a-f]{8}")
+
+
+def get_session_dir() -> Path:
+
+    cleanup_old_sessions(days=1) 
+    """
+    セッションごとに一意の作業ディレクトリを返す。
+    例）/home/streamlit_workspace/20250201_120000_ab12cd34/
+    IDは URL のクエリ（?sid=）にも持たせ、プロセスの再起動後も同じディレクトリに戻れるようにする。
+    """
+    if "session_id" not in st.session_state:
+        sid = st.query_params.get("sid", "")
+        if not (SESSION_ID_PATTERN.fullmatch(sid) and (BASE_ROOT / sid).is_dir()):
+            sid = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:8]
+        st.session_state["session_id"] = sid
+        st.query_params["sid"] = sid
+
+    session_dir = BASE_ROOT / st.session_state["session_id"]
+    session_dir.mkdir(parents=True, exist_ok=True)
+
+    # 最終アクセス時刻を記録しておく（自動クリーンアップ用）
+    (session_dir / ".last_access").write_text(datetime.now().isoformat(), encoding="utf-8")
+
+    return session_dir
+
+
+# =========================
+# テンプレートの共有ストア（内容のハッシュで1ファイルだけ保存し、セッション間で共有する）
+# =========================
+# "_" 始まりなので cleanup_old_sessions の対象外
+TEMPLATE_STORE_DIR = BASE_ROOT / "_templates"
+# どのセッションからも参照されなくなったテンプレートを消すまでの猶予（アップロード直後の競合を避ける）
+TEMPLATE_STORE_GRACE_S = 3600
+# ストアの掃除はこの間隔で1回まで
+TEMPLATE_STORE_GC_INTERVAL_S = 600
+# セッションが参照しているテンプレートの sha256 を書いておくファイル
+TEMPLATE_REF_MARKER = ".template"
+
+
+@st.cache_resource(show_spinner=False)
+def _template_store():
+    return {"lock": threading.Lock(), "last_gc": 0.0}
+
+
+def store_template(data: bytes):
+    """
+    テンプレートを内容の SHA-256 で保存し、(sha256, パス) を返す。
+    同じ内容がすでにあれば書き込まず、更新時刻だけ進める（掃除の猶予をリセット）。書き込みは一時ファイル → os.replace。
+    このファイルは読み取り専用として扱い、編集はメモリ上の作業中デッキとセッションのディレクトリで行う。
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = TEMPLATE_STORE_DIR / f"{sha256}.pptx"
+    if path.is_file():
+        os.utime(path)
+        return sha256, path
+
+    TEMPLATE_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    return sha256, path
+
+
+def acquire_template(sha256: str):
+    """このセッションがテンプレートを参照していることを記録する（以前の参照は置き換わる）"""
+    (get_session_dir() / TEMPLATE_REF_MARKER).write_text(sha256, encoding="utf-8")
+
+
+def template_refcounts(days: int = 1) -> dict:
+    """有効なセッション（cleanup_old_sessions で消されない範囲）ごとの参照を数える {sha256: セッション数}"""
+    counts = {}
+    if not BASE_ROOT.exists():
+        return counts
+    cutoff = datetime.now() - timedelta(days=days)
+    for child in BASE_ROOT.iterdir():
+        if not child.is_dir() or child.name.startswith("_"):
+            continue
+        try:
+            marker = child / TEMPLATE_REF_MARKER
+            if not marker.is_file():
+                continue
+            last_access = child / ".last_access"
+            if last_access.exists() and datetime.fromisoformat(last_access.read_text(encoding="utf-8")) < cutoff:
+                continue
+            sha256 = marker.read_text(encoding="utf-8").strip()
+            counts[sha256] = counts.get(sha256, 0) + 1
+        except Exception:
+            continue
+    return counts
+
+
+def gc_template_store(force: bool = False) -> int:
+    """どのセッションからも参照されず、猶予を過ぎたテンプレート（と書きかけの一時ファイル）を消す。消した数を返す。"""
+    store = _template_store()
+    with store["lock"]:
+        if not force and time.time() - store["last_gc"] < TEMPLATE_STORE_GC_INTERVAL_S:
+            return 0
+        store["last_gc"] = time.time()
+
+    if not TEMPLATE_STORE_DIR.exists():
+        return 0
+    refs = template_refcounts()
+    removed = 0
+    for path in TEMPLATE_STORE_DIR.iterdir():
+        try:
+            if time.time() - path.stat().st_mtime < TEMPLATE_STORE_GRACE_S:
+                continue
+            if path.suffix == ".tmp" or (path.suffix == ".pptx" and refs.get(path.stem, 0) == 0):
+                path.unlink(missing_ok=True)
+                removed += 1
+        except Exception:
+            continue
+    return removed
+
+
+# =========================
+# ファイル読込関数
+# =========================
+def read_txt(path):
+    for enc in ("utf-8", "utf-8-sig", "cp932"):
+        try:
+            with open(path, "r", encoding=enc, errors="ignore") as f:
+                return f.read()
+        except Exception:
+            continue
+    return ""
+
+def read_pdf(path):
+    try:
+        doc = fitz.open(path)
+        return "\n".join(page.get_text("text") for page in doc)
+    except Exception:
+        return ""
+
+def read_pptx_text(path):
+    try:
+        prs = Presentation(path)
+        texts = []
+        for slide in prs.slides:
+            for shp in slide.shapes:
+                if hasattr(shp, "text") and shp.text:
+                    texts.append(shp.text)
+        return "\n".join(texts)
+    except Exception:
+        return ""
+
+# =========================
+# PPT → 画像変換関数
+# =========================
+from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE
+from PIL import Image, ImageDraw, ImageFont
+import io, os
+
+def pptx_to_images(pptx_path: Path) -> list[Image.Image]:
+    """
+    PowerPointファイル（または読み込み済みの Presentation）をスライドレイアウト通りに簡易描画して画像リストで返す。
+    - 日本語フォント対応
+    - テキスト・画像を元の位置(left, top, width, height)に再配置
+    """
+    images: list[Image.Image] = []
+
+    # ---- 日本語フォント設定 ----
+    FONT_CANDIDATES = [
+        "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+        "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+        "C:/Windows/Fonts/meiryo.ttc",
+        "/System/Library/Fonts/ヒラギノ角ゴシック W4.ttc",
+        "/System/Library/Fonts/Helvetica.ttc",
+    ]
+    font_path = next((f for f in FONT_CANDIDATES if os.path.exists(f)), None)
+    if font_path:
+        font_small = ImageFont.truetype(font_path, 20)
+    else:
+        font_small = ImageFont.load_default()
+
+    try:
+        prs = pptx_path if hasattr(pptx_path, "slides") else Presentation(pptx_path)
+        for i, slide in enumerate(prs.slides):
+            # スライドサイズ（EMU → px換算）
+            width_px = int(prs.slide_width / 9525)
+            height_px = int(prs.slide_height / 9525)
+
+            # 白背景キャンバス
+            img = Image.new("RGB", (width_px, height_px), "white")
+            draw = ImageDraw.Draw(img)
+
+            # === スライド上の図形を順に描画 ===
+            for shp in slide.shapes:
+                left = int(shp.left / 9525)
+                top = int(shp.top / 9525)
+                width = int(shp.width / 9525)
+                height = int(shp.height / 9525)
+
+                # 図形タイプで分岐
+                stype = shp.shape_type
+
+                # 画像
+                if stype == MSO_SHAPE_TYPE.PICTURE:
+                    try:
+                        image_bytes = io.BytesIO(shp.image.blob)
+                        pic = Image.open(image_bytes).convert("RGB")
+                        pic = pic.resize((width, height))
+                        img.paste(pic, (left, top))
+                    except Exception:
+                        draw.rectangle([left, top, left + width, top + height], outline="gray")
+                        draw.text((left + 4, top + 4), "画像読み込み失敗", font=font_small, fill="red")
+
+                # テキスト付き図形
+                elif getattr(shp, "has_text_frame", False):
+                    text = shp.text.strip()
+                    if text:
+                        # テキスト枠（背景塗り）
+                        draw.rectangle([left, top, left + width, top + height], outline="lightgray", fill=None)
+                        # テキスト（簡易左寄せ）
+                        lines = text.replace("\r", "").split("\n")
+                        y = top + 5
+                        for line in lines:
+                            draw.text((left + 8, y), line[:40], font=font_small, fill="black")
+                            y += 24
+
+                # 図形（塗りつぶしのみ）
+                else:
+                    draw.rectangle([left, top, left + width, top + height], outline="lightgray", fill=None)
+
+            # スライド番号
+            draw.text((20, height_px - 40), f"Slide {i+1}", font=font_small, fill="gray")
+
+            images.append(img)
+
+        return images
+
+    except Exception as e:
+        st.error(f"PPT変換エラー: {e}")
+        return []
+
+
+# =========================
+# 作業中のPowerPoint（セッションごとに1つだけ読み込み、反映はメモリ上で行う）
+# =========================
+def get_working_presentation():
+    """
+    セッションで作業中の Presentation を返す。テンプレート未アップロードなら None。
+    プレビューと『…に反映』ボタンはこのオブジェクトを直接読み書きし、毎回ファイルを読み直さない。
+    まだ読み込んでいない場合や pptx_path（テンプレート）が差し替えられた場合は、
+    テンプレートを読み込んで反映履歴を現在の版まで当て直す。
+    """
+    path = st.session_state.get("pptx_path")
+    if not path:
+        return None
+    deck = st.session_state.get("working_deck")
+    if deck is None or deck["source"] != str(path):
+        if not Path(path).is_file():
+            return None
+        deck = {"prs": Presentation(str(path)), "source": str(path)}
+        st.session_state["working_deck"] = deck
+        replay_revisions(deck["prs"], revision_log()["head"])
+    return deck["prs"]
+
+
+def restore_session_template() -> bool:
+    """
+    プロセスの再起動などでセッションの状態が消えたとき、このセッションのテンプレートを読み込み直す。
+    セッションのディレクトリの TEMPLATE_REF_MARKER に書いた sha256 で共有ストアからテンプレートを探し、
+    内容のハッシュと反映履歴（revisions.jsonl）の base が一致すれば pptx_path に戻す。
+    作業中デッキは get_working_presentation がテンプレートと履歴から作り直す。戻せたら True。
+    """
+    try:
+        sha256 = (get_session_dir() / TEMPLATE_REF_MARKER).read_text(encoding="utf-8").strip()
+    except OSError:
+        return False
+    path = TEMPLATE_STORE_DIR / f"{sha256}.pptx"
+    if not path.is_file() or template_file_sha256(path) != sha256:
+        return False
+    log = revision_log()
+    if log.get("base") not in (None, sha256):
+        return False
+
+    os.utime(path)  # 掃除の猶予をリセット
+    st.session_state["pptx_path"] = str(path)
+    st.session_state["template_loaded"] = True
+    try:
+        manifest = compile_template(path, sha256=sha256)
+        st.session_state["template_manifest"] = manifest
+        st.session_state["template_problems"] = validate_template_manifest(manifest)
+    except Exception:
+        st.session_state["template_manifest"] = None
+        st.session_state["template_problems"] = {}
+
+    # プレビュー用の編集内容も現在の版にそろえる
+    edited = st.session_state.setdefault("edited_texts", {})
+    for patch in log["patches"][:log["head"]]:
+        if patch["slot"] != SCHEDULE_SLOT:
+            edited[patch["slot"]] = patch["new"]
+    discard_working_presentation()
+    return True
+
+
+def discard_working_presentation():
+    """作業中の Presentation を捨てる（次の get_working_presentation でテンプレートと履歴から作り直す）"""
+    st.session_state.pop("working_deck", None)
+
+
+def export_presentation(prefix: str = "proposal_final") -> str:
+    """
+    作業中の Presentation（反映履歴の現在の版）をセッションのディレクトリに保存し、そのパスを返す。
+    同じ prefix で前に書き出したファイルは消す（セッションのディスク使用量を増やさない）。
+    """
+    prs = get_working_presentation()
+    session_dir = get_session_dir()
+    for previous in session_dir.glob(f"{prefix}_*.pptx"):
+        previous.unlink(missing_ok=True)
+    out_path = session_dir / f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
+    prs.save(out_path)
+    return str(out_path)
+
+
+# =========================
+# 図形名の索引（name → スライド番号・図形パス）
+# =========================
+def _index_slide_shapes(index: dict, slide_index: int, slide):
+    """
+    1枚分の図形を索引に登録する。グループ内の図形も含め、同名があれば先に見つかった方（グループ内優先）を使う。
+    path はスライド直下からの位置の並び。表はセルも「表名[行,列]」で登録し、path の末尾に (行, 列) を付ける。
+    値は (path, 図形, XML要素)。XML要素は削除済みかどうかの判定に使う。
+    """
+    for names in index.values():
+        names.pop(slide_index, None)
+
+    def _walk(shapes, prefix):
+        for pos, shp in enumerate(shapes):
+            path = prefix + (pos,)
+            if shp.shape_type == MSO_SHAPE_TYPE.GROUP:
+                _walk(shp.shapes, path)
+            index.setdefault(shp.name, {}).setdefault(slide_index, (path, shp, shp._element))
+            if getattr(shp, "has_table", False):
+                for r, row in enumerate(shp.table.rows):
+                    for c, cell in enumerate(row.cells):
+                        index.setdefault(f"{shp.name}[{r},{c}]", {}).setdefault(slide_index, (path + ((r, c),), cell, cell._tc))
+
+    _walk(slide.shapes, ())
+
+
+def build_shape_index(prs) -> dict:
+    """デッキ全体の図形名索引 {name: {スライド番号(0始まり): (path, 図形, XML要素)}} を作る"""
+    index = {}
+    for slide_index, slide in enumerate(prs.slides):
+        _index_slide_shapes(index, slide_index, slide)
+    return index
+
+
+def get_shape_index(prs) -> dict:
+    """
+    作業中の Presentation なら読み込みごとに1回だけ作った索引を使い回す。それ以外はその場で作る。
+    テンプレートの manifest があれば、そのスロットの図形パスから索引を作る（全スライドは走査しない）。
+    """
+    deck = st.session_state.get("working_deck")
+    if deck is None or deck["prs"] is not prs:
+        return build_shape_index(prs)
+    if deck.get("shape_index") is None:
+        manifest = st.session_state.get("template_manifest")
+        if manifest and manifest["slide_count"] == len(prs.slides):
+            deck["shape_index"] = _shape_index_from_manifest(prs, manifest)
+        else:
+            deck["shape_index"] = build_shape_index(prs)
+    return deck["shape_index"]
+
+
+def refresh_shape_index(prs, slide_index: int):
+    """図形を追加・削除したスライドの索引だけを作り直す"""
+    if 0 <= slide_index < len(prs.slides):
+        _index_slide_shapes(get_shape_index(prs), slide_index, prs.slides[slide_index])
+
+
+def find_named_shape(prs, slide_index: int, shape_name: str):
+    """
+    索引から図形（表のセル名ならセル）を返す。見つからなければ None。
+    索引にない・図形が削除済みのときは、そのスライドだけ索引を作り直してもう一度引く。
+    """
+    index = get_shape_index(prs)
+    hit = index.get(shape_name, {}).get(slide_index)
+    if hit is None or hit[2].getparent() is None:
+        refresh_shape_index(prs, slide_index)
+        hit = index.get(shape_name, {}).get(slide_index)
+    return hit[1] if hit else None
+
+
+# =========================
+# テンプレートのコンパイル（編集スロットの一覧をテンプレートの SHA-256 ごとに保存）
+# =========================
+TEMPLATE_MANIFEST_DIR = Path(os.getenv("TEMPLATE_MANIFEST_DIR", "/home/streamlit_workspace/_template_manifests"))
+# スロットの拾い方や manifest の形を変えたら上げる（古い manifest は作り直す）
+TEMPLATE_MANIFEST_VERSION = 1
+# 編集スロットとして拾う図形名
+TEMPLATE_SLOT_PATTERN = re.compile(r"^(Edit|EDIT)|^schedule\d+$")
+
+# モード → (スロットが見つからないときのスライド番号（0始まり）, 書き込むスロット)
+# 調査仕様案のスロットは SPEC_LABEL_TO_SHAPE（後ろで定義）から実行時に引く
+TEMPLATE_MODE_SLOTS = {
+    "表紙": (0, ["Edit_client", "Edit_title", "Edit_date"]),
+    "キックオフノート": (1, ["EDIT_TO_BE", "EDIT_AS_IS", "EDIT_PROBLEM", "EDIT_PURPOSE", "EDIT_QUESTION", "EDIT_HYPOTHESIS"]),
+    "問いの分解": (2, ["EDIT1_subQ"]),
+    "分析アプローチ": (3, [f"EDIT1_subQ1_{k}" for k in range(1, 6)]),
+    "対象者条件を検討": (12, ["EDIT1_taisyosya"]),
+    "調査項目案": (13, ["EDIT1_Qimg"]),
+    "調査仕様案": (14, None),
+    "スケジュール案": (15, ["schedule1", "schedule2", "schedule3"]),
+    "概算見積": (16, [f"EDIT_amount{k}" for k in range(1, 6)]),
+}
+
+
+@st.cache_resource(show_spinner=False)
+def _template_manifests():
+    """プロセス全体で共有する manifest（sha256 → manifest）"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def template_file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def template_mode_slots(mode: str) -> list:
+    slots = TEMPLATE_MODE_SLOTS[mode][1]
+    return list(SPEC_LABEL_TO_SHAPE.values()) if slots is None else slots
+
+
+def _slot_type(shp) -> str:
+    if shp.shape_type == MSO_SHAPE_TYPE.GROUP:
+        return "group"
+    if getattr(shp, "has_table", False):
+        return "table"
+    if getattr(shp, "has_text_frame", False):
+        return "text"
+    if shp.shape_type == MSO_SHAPE_TYPE.PICTURE:
+        return "picture"
+    return "other"
+
+
+def _compile_template(prs, sha256: str) -> dict:
+    """テンプレートを1回だけ走査して、編集スロット（名前・スライド・図形パス・種類）を集める"""
+    slots, duplicates = {}, {}
+    for name, found in build_shape_index(prs).items():
+        if not TEMPLATE_SLOT_PATTERN.match(name):
+            continue
+        # 表のセル（path の末尾が (行, 列)）はスロットにしない
+        found = {i: hit for i, hit in found.items() if isinstance(hit[0][-1], int)}
+        if not found:
+            continue
+        slide_index = min(found)
+        path, shp, _ = found[slide_index]
+        slots[name] = {"slide": slide_index, "path": list(path), "type": _slot_type(shp)}
+        if len(found) > 1:
+            duplicates[name] = sorted(found)
+    return {
+        "version": TEMPLATE_MANIFEST_VERSION,
+        "sha256": sha256,
+        "compiled_at": time.time(),
+        "slide_count": len(prs.slides),
+        "slots": slots,
+        "duplicates": duplicates,
+    }
+
+
+def compile_template(path, sha256: str = None) -> dict:
+    """
+    テンプレートの manifest を返す。同じ SHA-256 のテンプレートは（他のユーザーの分も含めて）1回だけコンパイルする。
+    プロセス内 → ディスク（TEMPLATE_MANIFEST_DIR）の順に探し、なければ読み込んでコンパイルし保存する。
+    sha256 が分かっていれば渡す（省略時はファイルから計算する）。
+    """
+    sha256 = sha256 or template_file_sha256(path)
+    cache = _template_manifests()
+    with cache["lock"]:
+        manifest = cache["entries"].get(sha256)
+    if manifest is not None:
+        return manifest
+
+    disk_path = TEMPLATE_MANIFEST_DIR / f"{sha256}.json"
+    try:
+        manifest = json.loads(disk_path.read_text(encoding="utf-8"))
+        if manifest.get("version") != TEMPLATE_MANIFEST_VERSION:
+            manifest = None
+    except Exception:
+        manifest = None
+
+    if manifest is None:
+        manifest = _compile_template(Presentation(str(path)), sha256)
+        try:
+            TEMPLATE_MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = disk_path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+            tmp.write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, disk_path)
+        except Exception:
+            # 保存できなくてもこのプロセスでは使える
+            pass
+
+    with cache["lock"]:
+        cache["entries"][sha256] = manifest
+    return manifest
+
+
+def validate_template_manifest(manifest: dict) -> dict:
+    """モードごとに、足りないスロット・書き込めない種類のスロットを挙げる（問題のないモードは含めない）"""
+    problems = {}
+    for mode in TEMPLATE_MODE_SLOTS:
+        issues = []
+        for name in template_mode_slots(mode):
+            slot = manifest["slots"].get(name)
+            if slot is None:
+                issues.append(f"『{name}』がありません")
+            elif mode != "スケジュール案" and slot["type"] not in ("text", "table"):
+                issues.append(f"『{name}』がテキストを書き込めない図形です（{slot['type']}）")
+        if issues:
+            problems[mode] = issues
+    return problems
+
+
+def template_slot_slide(slot_name: str, default: int) -> int:
+    """アップロード済みテンプレートの manifest からスロットのスライド番号を引く（なければ default）"""
+    manifest = st.session_state.get("template_manifest")
+    slot = (manifest or {}).get("slots", {}).get(slot_name)
+    return slot["slide"] if slot else default
+
+
+def template_mode_slide(mode: str) -> int:
+    """モードの書き込み先スライド。最初に見つかったスロットのスライド、なければ従来の位置"""
+    default = TEMPLATE_MODE_SLOTS[mode][0]
+    for name in template_mode_slots(mode):
+        slide_index = template_slot_slide(name, None)
+        if slide_index is not None:
+            return slide_index
+    return default
+
+
+def _shape_index_from_manifest(prs, manifest: dict) -> dict:
+    """manifest の図形パスをたどって索引を作る（スライドを走査しない）。名前が一致しないスロットは載せない。"""
+    index = {}
+    for name, slot in manifest["slots"].items():
+        try:
+            shp = prs.slides[slot["slide"]]
+            shapes = shp.shapes
+            for pos in slot["path"]:
+                shp = shapes[pos]
+                shapes = getattr(shp, "shapes", None)
+        except Exception:
+            continue
+        if shp.name == name:
+            index.setdefault(name, {})[slot["slide"]] = (tuple(slot["path"]), shp, shp._element)
+    return index
+
+
+from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.dml.color import RGBColor
+import base64
+
+def emu_to_percent(val_emu, total_emu):
+    """EMU単位をスライド全体に対する%へ変換"""
+    try:
+        return float(val_emu) / float(total_emu) * 100.0
+    except Exception:
+        return 0.0
+
+
+def color_to_css(rgb):
+    """RGBColor → CSSカラーコード"""
+    if not rgb:
+        return None
+    if isinstance(rgb, RGBColor):
+        return f"#{rgb.rgb:06X}"
+    try:
+        return f"#{int(rgb):06X}"
+    except Exception:
+        return None
+
+
+def extract_slide_model(prs, slide_index=0):
+    """
+    PowerPointスライド内の図形を走査し、
+    Streamlit用のHTML描画モデルに変換する。
+    - PICTURE：画像
+    - TEXT：テキストボックス
+    - TABLE：セルの文字を連結して1つのテキストブロックとして描画（★追加）
+    """
+    slide = prs.slides[slide_index]
+    sw, sh = prs.slide_width, prs.slide_height
+    blocks = []
+
+    def add_block(shape, offset_left=0, offset_top=0):
+        stype = shape.shape_type
+        name = getattr(shape, "name", "")
+        editable = name.startswith("Edit_") or name.startswith("EDIT_")
+
+        left = shape.left + offset_left
+        top = shape.top + offset_top
+        width = shape.width
+        height = shape.height
+
+        base = {
+            "name": name,
+            "editable": editable,
+            "left": emu_to_percent(left, sw),
+            "top": emu_to_percent(top, sh),
+            "width": emu_to_percent(width, sw),
+            "height": emu_to_percent(height, sh),
+        }
+
+        # グループ処理
+        if stype == MSO_SHAPE_TYPE.GROUP:
+            for child in shape.shapes:
+                add_block(child, offset_left=left, offset_top=top)
+            return
+
+        # 画像処理
+        if stype == MSO_SHAPE_TYPE.PICTURE:
+            try:
+                content_type = getattr(shape.image, "content_type", "image/png")
+                b64 = base64.b64encode(shape.image.blob).decode("ascii")
+                base["type"] = "picture"
+                base["src"] = f"data:{content_type};base64,{b64}"
+            except Exception:
+                pass
+            blocks.append(base)
+            return
+
+        # 塗り（背景色）
+        fill_css = None
+        try:
+            if shape.fill and shape.fill.type == 1:  # solid fill
+                fill_css = color_to_css(shape.fill.fore_color.rgb)
+        except Exception:
+            pass
+
+        # ★ TABLE（表）の処理を追加：セルのテキストを連結して1ブロックとして描画
+        if stype == MSO_SHAPE_TYPE.TABLE:
+            try:
+                table = shape.table
+                rows_text = []
+                for row in table.rows:
+                    cells = [
+                        cell.text.replace("\n", " ").strip()
+                        for cell in row.cells
+                    ]
+                    # 全部空なら無視
+                    if any(cells):
+                        rows_text.append(" | ".join(cells))
+                text = "\n".join(rows_text).strip()
+                if text:
+                    blocks.append(
+                        {
+                            **base,
+                            "type": "text",
+                            "text": text,
+                            "fill": fill_css,
+                        }
+                    )
+            except Exception:
+                # 失敗したら単なるボックスとして描画
+                blocks.append({**base, "type": "box", "fill": fill_css})
+            return
+
+        # テキスト付き図形
+        if getattr(shape, "has_text_frame", False):
+            blocks.append({**base, "type": "text", "text": shape.text, "fill": fill_css})
+        else:
+            # 図形（塗りだけ）
+            blocks.append({**base, "type": "box", "fill": fill_css})
+
+    for shape in slide.shapes:
+        add_block(shape, 0, 0)
+
+    return {"blocks": blocks}
+
+
+def render_slide_html(model, edited_texts):
+    """
+    extract_slide_model()で抽出した構造をもとに、
+    Streamlit内でスライドの見た目を再現するHTMLを生成。
+    """
+    blocks = model["blocks"]
+
+    html = """
+    <div style="position:relative; width:100%; padding-top:56.25%; background:#f8f9fb;
+                border-radius:14px; box-shadow:0 4px 16px rgba(0,0,0,0.08); overflow:hidden;">
+      <div style="position:absolute; inset:0; background:white;">
+    """
+
+    for b in blocks:
+        style = (
+            f"position:absolute; left:{b['left']}%; top:{b['top']}%; "
+            f"width:{b['width']}%; height:{b['height']}%;"
+        )
+        content = ""
+
+        # 画像
+        if b.get("type") == "picture" and b.get("src"):
+            content = (
+                f'<img src="{b["src"]}" style="width:100%;height:100%;object-fit:contain;">'
+            )
+
+        # テキスト
+        elif b.get("type") == "text":
+            text_val = edited_texts.get(b["name"], b.get("text", ""))
+            bg = f'background:{b["fill"]};' if b.get("fill") else ""
+            content = (
+                f'<div style="{bg}padding:6px;font-family:\'Noto Sans JP\',sans-serif;'
+                f'font-size:13px;color:#111;white-space:pre-wrap;">{text_val}</div>'
+            )
+
+        html += f'<div style="{style}">{content}</div>'
+
+    html += "</div></div>"
+    return html
+
+def parse_ai_output(text: str):
+    """AI出力を6項目に分割"""
+    sections = {
+        "目標": "",
+        "現状": "",
+        "ビジネス課題": "",
+        "調査目的": "",
+        "問い": "",
+        "仮説": "",
+    }
+    for key in sections.keys():
+        pattern = rf"【{key}】(.*?)(?=【|$)"
+        m = re.search(pattern, text, re.DOTALL)
+        if m:
+            sections[key] = m.group(1).strip()
+    return sections
+
+
+
+from pptx.enum.shapes import MSO_SHAPE_TYPE  # 既にインポート済みならこの行は重複していてもOK
+
+from pptx.enum.shapes import MSO_SHAPE_TYPE  # 既にインポート済みならこの行は重複していてもOK
+from pptx.dml.color import RGBColor         # ← これも上にあれば重複OK
+
+def set_text_to_named_shape(prs, slide_index: int, shape_name: str, text: str):
+    """
+    図形名の索引から slide_index 枚目の name=shape_name（グループ内も含む）を引き、
+    テキストを書き込む。書き込めたらその図形、見つからなければ None を返す。
+    - オートシェイプ／プレースホルダー：.text に書き込む
+    - テーブル：全セルに同じテキストを書き込む（暫定）
+    - 書き込んだテキストの文字色は黒（RGB 0,0,0）に設定する
+    """
+
+    def _set_font_black_textframe(text_frame):
+        """text_frame 内の全 run のフォント色を黒にする"""
+        try:
+            for paragraph in text_frame.paragraphs:
+                for run in paragraph.runs:
+                    if run.font is not None:
+                        run.font.color.rgb = RGBColor(0, 0, 0)
+        except Exception:
+            # フォーマット構造が想定外でも落ちないようにする
+            pass
+
+    shp = find_named_shape(prs, slide_index, shape_name)
+    if shp is None:
+        return None
+
+    # テキスト枠があるタイプ
+    if getattr(shp, "has_text_frame", False):
+        shp.text = text
+        _set_font_black_textframe(shp.text_frame)
+        return shp
+
+    # テーブルの場合
+    if getattr(shp, "has_table", False):
+        try:
+            for row in shp.table.rows:
+                for cell in row.cells:
+                    cell.text = text
+                    _set_font_black_textframe(cell.text_frame)
+            return shp
+        except Exception:
+            pass
+
+    return None
+
+
+def parse_ai_output(text: str):
+    """AI出力を6項目に分割"""
+    sections = {
+        "目標": "",
+        "現状": "",
+        "ビジネス課題": "",
+        "調査目的": "",
+        "問い": "",
+        "仮説": "",
+    }
+    for key in sections.keys():
+        pattern = rf"【{key}】(.*?)(?=【|$)"
+        m = re.search(pattern, text, re.DOTALL)
+        if m:
+            sections[key] = m.group(1).strip()
+    return sections
+
+
+def extract_md_table(md_text: str, header: str):
+    """
+    Markdown の見出し header 直後にある「|項目|内容|」形式の表を DataFrame にする
+    （ブランド診断の検索結果用）
+    """
+    import pandas as pd
+
+    if header in md_text:
+        section = md_text.split(header, 1)[1]
+        table_part = section.split("#")[0]
+        rows = [
+            ln.strip()
+            for ln in table_part.splitlines()
+            if "|" in ln and not ln.startswith("|項目|----|")
+        ]
+        data = []
+        for ln in rows:
+            cols = [c.strip() for c in ln.strip("|").split("|")]
+            if len(cols) >= 2:
+                data.append(cols[:2])
+        if data:
+            df = pd.DataFrame(data[1:], columns=data[0])
+            return df
+    return pd.DataFrame(columns=["項目", "内容"])
+
+
+def _brand_tables_found(md_text: str) -> bool:
+    """ブランド診断の検索結果から表を1つ以上読み取れたか"""
+    return any(
+        not extract_md_table(md_text, header).empty
+        for header in ("# カテゴリーに関する検索項目", "# カテゴリーの消費行動特性")
+    )
+
+
+# ★ 調査項目案のバージョン（問数）
+SURVEY_ITEM_VERSIONS = [10, 20, 30, 40]
+# マスターリスト1件あたりの出力トークン
+# 短いキーの1行 {"i": "ブランド認知（助成）", "p": 1, "s": "SQ1"} は実測で平均約14トークン
+# （項目名の平均7文字・40件で約575トークン）。全角15文字の項目名でも収まるよう25とする
+SURVEY_MASTER_TOKENS_PER_ITEM = 25
+# 40件ぶん＋配列の前後の余裕（超えた場合は続きの依頼でつなぐ）
+SURVEY_MASTER_MAX_TOKENS = SURVEY_ITEM_VERSIONS[-1] * SURVEY_MASTER_TOKENS_PER_ITEM + 100
+
+
+def parse_survey_master(text: str) -> list:
+    """
+    調査項目案のマスターリスト（JSON配列）を解釈する。
+    出力は短いキー {"i": 項目名, "p": 優先度, "s": "SQ1"}（長いキー item/priority/sq も受け付ける）。
+    各要素は {"item": 項目名, "priority": 1〜4, "sq": "SQ1"} に正規化し、出力順（＝調査票の並び）を保つ。
+    """
+    ai_text = text.strip()
+    if ai_text.startswith("```"):
+        ai_text = ai_text.strip("`")
+        ai_text = ai_text.replace("json", "", 1).strip()
+
+    data = json.loads(ai_text)
+    if not isinstance(data, list):
+        raise ValueError("JSON配列ではありません。")
+
+    master = []
+    for row in data:
+        if not isinstance(row, dict):
+            continue
+        item = str(row.get("i", row.get("item", ""))).strip()
+        if not item:
+            continue
+        try:
+            priority = int(row.get("p", row.get("priority", len(SURVEY_ITEM_VERSIONS))))
+        except (TypeError, ValueError):
+            priority = len(SURVEY_ITEM_VERSIONS)
+        priority = min(max(priority, 1), len(SURVEY_ITEM_VERSIONS))
+        master.append({"item": item, "priority": priority, "sq": str(row.get("s", row.get("sq", ""))).strip()})
+    return master
+
+
+def derive_survey_versions(master: list) -> dict:
+    """
+    マスターリストから 10/20/30/40問バージョンを決定的に作る。
+    優先度（同じなら出力順）の上位N件を選び、調査票としての並び（出力順）に戻して番号を振る。
+    小さいバージョンは必ず大きいバージョンに含まれる。
+    """
+    ranked = sorted(range(len(master)), key=lambda i: (master[i]["priority"], i))
+    versions = {}
+    for n in SURVEY_ITEM_VERSIONS:
+        chosen = sorted(ranked[:n])
+        versions[f"{n}問"] = "\n".join(
+            f"{no}. {master[i]['item']}" for no, i in enumerate(chosen, 1)
+        )
+    return versions
+
+
+# ★ 調査仕様の項目（ラベルと session_state のキー）
+SPEC_ITEMS = [
+    ("調査手法", "spec_method"),
+    ("抽出方法", "spec_sampling"),
+    ("調査地域", "spec_region"),
+    ("対象者条件", "spec_target"),
+    ("サンプルサイズ", "spec_sample_size"),
+    ("調査ボリューム", "spec_volume"),
+    ("提示物", "spec_stimulus"),
     ("集計・分析仕様", "spec_analysis"),
     ("自由回答データの処理", "spec_openend"),
     ("業務範囲", "spec_scope"),
@@ -509,111 +2537,1981 @@ SPEC_ITEMS = [
     ("備考", "spec_notes"),
 ]
 
-# ★ 調査仕様スライド（スライド6）の shape 名との対応
-SPEC_LABEL_TO_SHAPE = {
-    "調査手法": "Edit_SYUHO",
-    "抽出方法": "Edit_Sampling",
-    "調査地域": "Edit_Area",
-    "対象者条件": "Edit_Joken",
-    "サンプルサイズ": "Edit_Samplesize",
-    "調査ボリューム": "Edit_Qvolume",
-    "提示物": "Edit_review",
-    "集計・分析仕様": "Edit_Analitics",
-    "自由回答データの処理": "Edit_OAcdg",
-    "業務範囲": "Edit_Hani",
-    "納品物": "Edit_Nohin",
-    "インスペクションの方法": "Edit_Inspection",
-    "謝礼の種類": "Edit_Syarei",
-    "備考": "Edit_Biko",
-}
+# ★ 調査仕様スライド（スライド6）の shape 名との対応
+SPEC_LABEL_TO_SHAPE = {
+    "調査手法": "Edit_SYUHO",
+    "抽出方法": "Edit_Sampling",
+    "調査地域": "Edit_Area",
+    "対象者条件": "Edit_Joken",
+    "サンプルサイズ": "Edit_Samplesize",
+    "調査ボリューム": "Edit_Qvolume",
+    "提示物": "Edit_review",
+    "集計・分析仕様": "Edit_Analitics",
+    "自由回答データの処理": "Edit_OAcdg",
+    "業務範囲": "Edit_Hani",
+    "納品物": "Edit_Nohin",
+    "インスペクションの方法": "Edit_Inspection",
+    "謝礼の種類": "Edit_Syarei",
+    "備考": "Edit_Biko",
+}
+
+from pptx.enum.text import PP_ALIGN
+from pptx.dml.color import RGBColor
+from pptx.util import Pt
+
+def apply_text_format(shape, font_name="Arial", font_size=12, color=RGBColor(0, 0, 0)):
+    """
+    shape.text_frame の paragraph/run に書式を統一的に適用する
+    """
+    if not shape.has_text_frame:
+        return
+
+    text_frame = shape.text_frame
+    for paragraph in text_frame.paragraphs:
+        paragraph.alignment = PP_ALIGN.LEFT  # 左寄せ
+        for run in paragraph.runs:
+            run.font.name = font_name
+            run.font.size = Pt(font_size)
+            run.font.color.rgb = color
+
+import re
+
+def parse_subquestions(ai_text: str):
+    """
+    『問いの分解』モードのAI出力をパースして、
+    [
+      {"subq": "...", "axis": "...", "metric": "..."},
+      ...
+    ]
+    のリストに変換する
+    """
+    if not ai_text:
+        return []
+
+    # 「- サブクエスチョン...」でブロックごとに分割
+    blocks = re.split(r"\n(?=-\s*サブクエスチョン)", ai_text.strip())
+    results = []
+
+    for blk in blocks:
+        # サブクエスチョン本体
+        m_q = re.search(r"-\s*サブクエスチョン[0-9０-９]*[:：]\s*(.+)", blk)
+        if not m_q:
+            continue
+
+        # 分析軸
+        m_axis = re.search(r"分析軸[:：]\s*(.+)", blk)
+        # 評価項目
+        m_metric = re.search(r"評価項目[:：]\s*(.+)", blk)
+
+        results.append(
+            {
+                "subq": m_q.group(1).strip(),
+                "axis": m_axis.group(1).strip() if m_axis else "",
+                "metric": m_metric.group(1).strip() if m_metric else "",
+            }
+        )
+
+    return results
+
+
+
+from pptx.util import Pt
+from pptx.dml.color import RGBColor
+from pptx.enum.text import PP_ALIGN
+
+def apply_text_style(shape):
+    """
+    指定した図形内テキストの書式を統一するヘルパー
+    - フォント：Arial
+    - サイズ：12pt
+    - 色：黒
+    - 配置：左揃え
+    """
+    if not getattr(shape, "has_text_frame", False):
+        return
+
+    try:
+        for paragraph in shape.text_frame.paragraphs:
+            paragraph.alignment = PP_ALIGN.LEFT
+            for run in paragraph.runs:
+                if run.font is None:
+                    continue
+                run.font.name = "Arial"
+                run.font.size = Pt(12)
+                run.font.color.rgb = RGBColor(0, 0, 0)
+    except Exception:
+        # 万一フォーマット構造が想定外でも、ここでは落とさない
+        pass
+
+
+# =========================
+# スライド7にスケジュール表を反映する
+# =========================
+def reflect_schedule_to_slide7(prs, calendar_df):
+    """
+    スライド7にスケジュール表を3分割して挿入
+    - calendar_df: 「日付」「曜日」「マイルストン」「非営業日」を含む DataFrame を想定
+    - スライド上の Shape名 schedule1 / schedule2 / schedule3 の位置・サイズに表を配置
+    - 非営業日(True)の行は薄いグレーでハイライト
+    """
+    import math
+
+    slide_index = template_mode_slide("スケジュール案")
+    if slide_index >= len(prs.slides):
+        st.error("スライド7がテンプレートに存在しません。")
+        return prs
+
+    slide = prs.slides[slide_index]
+
+    # 既存の Table/Schedule（先に作った表など）を削除
+    for shp in list(slide.shapes):
+        name = getattr(shp, "name", "")
+        # ここは Table*, Schedule*（大文字）だけ消すので、schedule1〜3 は消さない
+        if name.startswith("Table") or name.startswith("Schedule"):
+            try:
+                slide.shapes._spTree.remove(shp._element)
+            except Exception:
+                pass
+
+    # === schedule1 / schedule2 / schedule3 のプレースホルダ図形を取得 ===
+    placeholders = {}
+    for shp in slide.shapes:
+        name = getattr(shp, "name", "")
+        if name in ["schedule1", "schedule2", "schedule3"]:
+            placeholders[name] = shp
+
+    # 3つともなくても動くようにする（ある分だけ使う）
+    # DataFrameインデックスを整理
+    df = calendar_df.reset_index(drop=True)
+    total_rows = len(df)
+    if total_rows == 0:
+        return prs
+
+    # 3ブロックに分割
+    rows_per_block = math.ceil(total_rows / 3)
+
+    # ===== カラー設定 =====
+    header_fill_color   = RGBColor(230, 230, 230)  # ヘッダー：薄いグレー
+    body_fill_color     = RGBColor(255, 255, 255)  # 平日：白
+    holiday_fill_color  = RGBColor(240, 240, 240)  # 非営業日：さらに薄いグレー
+    text_color          = RGBColor(0, 0, 0)        # 黒
+    headers = ["日付", "曜日", "マイルストン"]
+
+    # 各ブロック（1〜3）を、それぞれ schedule1〜3 の位置に描画
+    for block_idx in range(3):
+        start_idx = block_idx * rows_per_block
+        end_idx = min(start_idx + rows_per_block, total_rows)
+        block_df = df.iloc[start_idx:end_idx]
+
+        if block_df.empty:
+            continue
+
+        placeholder_name = f"schedule{block_idx + 1}"
+        ph = placeholders.get(placeholder_name)
+        if ph is None:
+            # schedule1/2/3 のどれかが無い場合、そのブロックはスキップ
+            continue
+
+        # プレースホルダ図形の位置とサイズを取得
+        left   = ph.left
+        top    = ph.top
+        width  = ph.width
+        height = ph.height
+
+        # プレースホルダを削除（同じ位置に表を置く）
+        try:
+            slide.shapes._spTree.remove(ph._element)
+        except Exception:
+            pass
+
+        rows = len(block_df) + 1  # ヘッダー行 + データ行
+        cols = 3
+
+        table = slide.shapes.add_table(rows, cols, left, top, width, height).table
+
+        # --- ヘッダー行 ---
+        for j, h in enumerate(headers):
+            cell = table.cell(0, j)
+            cell.text = h
+
+            cell.fill.solid()
+            cell.fill.fore_color.rgb = header_fill_color
+
+            for p in cell.text_frame.paragraphs:
+                p.font.bold = True
+                p.font.size = Pt(12)
+                p.alignment = PP_ALIGN.CENTER
+                p.font.name = "Meiryo UI"
+                p.font.color.rgb = text_color
+
+        # --- データ行 ---
+        for i, (_, row) in enumerate(block_df.iterrows()):
+            table.cell(i + 1, 0).text = str(row.get("日付", ""))
+            table.cell(i + 1, 1).text = str(row.get("曜日", ""))
+            table.cell(i + 1, 2).text = str(row.get("マイルストン", ""))
+
+            is_holiday = bool(row.get("非営業日", False))
+
+            for j in range(3):
+                cell = table.cell(i + 1, j)
+
+                # 非営業日は薄いグレー、それ以外は白
+                cell.fill.solid()
+                cell.fill.fore_color.rgb = holiday_fill_color if is_holiday else body_fill_color
+
+                for p in cell.text_frame.paragraphs:
+                    p.font.size = Pt(11)
+                    p.font.name = "Meiryo UI"
+                    p.font.color.rgb = text_color
+
+    # schedule1〜3 を表に置き換えたので、このスライドの図形名索引を作り直す
+    refresh_shape_index(prs, slide_index)
+    return prs
+
+
+# =========================
+# 反映履歴（テンプレートに対するスロット単位のパッチ）
+# =========================
+# 『…に反映』ボタンはデッキを保存せず、(スロット, 変更前, 変更後) をこの履歴に追記する。
+# 作業中デッキ = テンプレート + 履歴の先頭 head 件。ファイルにするのは出力のときだけ。
+REVISION_LOG_FILE = "revisions.jsonl"
+# 定期的に書き出す履歴のスナップショット（再読み込みはここから先のログだけを畳み込む）
+REVISION_CHECKPOINT_FILE = "revisions.checkpoint.json"
+# スナップショットを書き出す間隔（ログの行数）
+REVISION_CHECKPOINT_EVERY = 20
+# スケジュール表は表全体を1つのスロットとして扱う（値は行のリスト）
+SCHEDULE_SLOT = "schedule"
+
+
+def revision_log() -> dict:
+    """
+    セッションの反映履歴 {"patches": [...], "head": 現在の版, "version": 変更のたびに増える番号, "base": テンプレートの sha256}。
+    patches[:head] が作業中デッキに反映されている。
+    セッションの状態にまだなければ（プロセスの再起動後など）、ディスクのログから作り直す。
+    """
+    if "revision_log" not in st.session_state:
+        st.session_state["revision_log"] = load_revision_log(get_session_dir() / REVISION_LOG_FILE)
+    return st.session_state["revision_log"]
+
+
+def load_revision_log(path) -> dict:
+    """
+    追記のみのログ（revisions.jsonl）を畳み込み、revision_log() と同じ形の履歴を返す。
+    同じディレクトリにスナップショット（REVISION_CHECKPOINT_FILE）があれば、そこから先の行だけを畳み込む。
+    reset は履歴を空にし、patch は rev 番目の版として置き（それより後ろは捨てる）、move は現在の版を動かす。
+    書きかけの行など読めない行は飛ばす。ファイルがなければ空の履歴を返す。
+    """
+    path = Path(path)
+    log = {"patches": [], "head": 0, "version": 0, "base": None}
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return log
+
+    try:
+        checkpoint = json.loads((path.parent / REVISION_CHECKPOINT_FILE).read_text(encoding="utf-8"))
+        # ログが作り直されて短くなっていたら、古いスナップショットは使わない
+        if checkpoint["offset"] <= len(data):
+            log, data = checkpoint["log"], data[checkpoint["offset"]:]
+    except Exception:
+        pass
+
+    for line in data.decode("utf-8", errors="ignore").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        op = record.get("op")
+        if op == "reset":
+            # reset_revision_log と同じく版の番号も0に戻す
+            log.update(patches=[], head=0, version=0, base=record.get("base"))
+            continue
+        if op == "patch":
+            patch = {k: v for k, v in record.items() if k not in ("op", "rev", "at")}
+            del log["patches"][record["rev"] - 1:]
+            log["patches"].append(patch)
+            log["head"] = len(log["patches"])
+        elif op == "move":
+            log["head"] = max(0, min(record.get("to", 0), len(log["patches"])))
+        else:
+            continue
+        log["version"] += 1
+    return log
+
+
+def _append_revision_record(record: dict):
+    """
+    履歴の操作をセッションのディレクトリのログに1行追記する（追記のみで書き換えない）。
+    REVISION_CHECKPOINT_EVERY 行ごとに、その時点の履歴をスナップショットとして書き出す。
+    メモリ上の履歴を更新してから呼ぶこと。
+    """
+    try:
+        session_dir = get_session_dir()
+        with open(session_dir / REVISION_LOG_FILE, "ab") as f:
+            f.write((json.dumps({**record, "at": time.time()}, ensure_ascii=False) + "\n").encode("utf-8"))
+            offset = f.tell()
+    except Exception:
+        # 書けなくてもメモリ上の履歴で元に戻す・やり直すはできる
+        return
+
+    pending = st.session_state.get("revision_records_pending", 0) + 1
+    if pending >= REVISION_CHECKPOINT_EVERY and "revision_log" in st.session_state:
+        try:
+            path = session_dir / REVISION_CHECKPOINT_FILE
+            tmp = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+            tmp.write_text(json.dumps({"offset": offset, "log": st.session_state["revision_log"]}, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+            pending = 0
+        except Exception:
+            # 書けなければ次の追記でもう一度試す（ログだけでも読み込み直せる）
+            pass
+    st.session_state["revision_records_pending"] = pending
+
+
+def reset_revision_log(base: str):
+    """テンプレートを読み込み直したら履歴を空にする（base はテンプレートの sha256）"""
+    st.session_state["revision_log"] = {"patches": [], "head": 0, "version": 0, "base": base}
+    _append_revision_record({"op": "reset", "base": base})
+
+
+def _record_patch(patch: dict):
+    log = revision_log()
+    # 元に戻した版より後ろは捨て、現在の版の次に追加する
+    del log["patches"][log["head"]:]
+    log["patches"].append(patch)
+    log["head"] = len(log["patches"])
+    log["version"] += 1
+    _append_revision_record({"op": "patch", "rev": log["head"], **patch})
+
+
+def _shape_text(shp) -> str:
+    if getattr(shp, "has_text_frame", False):
+        return shp.text_frame.text
+    if getattr(shp, "has_table", False):
+        return shp.table.cell(0, 0).text
+    return ""
+
+
+def _write_slot_text(prs, slide_index: int, slot: str, text: str, style: str):
+    """
+    スロットにテキストを書き込み、図形（なければ None）を返す。style は書式の当て方:
+    "plain"（テキストのみ）/ "format"（apply_text_format）/ "amount"（apply_text_format 10pt）/ "style"（apply_text_style）
+    """
+    if style == "plain":
+        shp = find_named_shape(prs, slide_index, slot)
+        if shp is not None:
+            shp.text = text
+        return shp
+
+    shp = set_text_to_named_shape(prs, slide_index, slot, text)
+    if shp is not None and getattr(shp, "has_text_frame", False):
+        try:
+            if style == "amount":
+                apply_text_format(shp, font_size=10)
+            elif style == "style":
+                apply_text_style(shp)
+            else:
+                apply_text_format(shp)
+        except Exception:
+            # 書式の適用に失敗してもテキストは反映済み
+            pass
+    return shp
+
+
+def apply_slot_text(prs, slide_index: int, slot: str, text: str, style: str = "format", label: str = ""):
+    """作業中デッキのスロットにテキストを反映し、変わっていれば履歴に残す。書き込んだ図形（なければ None）を返す"""
+    shp = find_named_shape(prs, slide_index, slot)
+    if shp is None:
+        return None
+    old = _shape_text(shp)
+    shp = _write_slot_text(prs, slide_index, slot, text, style)
+    if shp is not None and old != text:
+        _record_patch({"slot": slot, "slide": slide_index, "old": old, "new": text, "style": style, "label": label})
+    return shp
+
+
+def apply_schedule_table(prs, calendar_df, label: str = "スケジュール案"):
+    """
+    スケジュール表を作業中デッキに反映し、履歴に残す。反映後の Presentation を返す。
+    すでに表を反映済みなら（schedule1〜3 が表に置き換わっているため）テンプレートから当て直す。
+    """
+    previous = applied_schedule_rows()
+    _record_patch({
+        "slot": SCHEDULE_SLOT,
+        "slide": template_mode_slide("スケジュール案"),
+        "old": previous,
+        "new": schedule_rows(calendar_df),
+        "style": "table",
+        "label": label,
+    })
+    if previous is not None:
+        discard_working_presentation()
+        return get_working_presentation()
+    return reflect_schedule_to_slide7(prs, calendar_df)
+
+
+def schedule_rows(calendar_df) -> list:
+    """カレンダー表を履歴に残す形（行ごとの dict）にする"""
+    return [
+        {col: (bool(row[col]) if col == "非営業日" else str(row[col])) for col in ("日付", "曜日", "マイルストン", "非営業日") if col in row}
+        for _, row in calendar_df.iterrows()
+    ]
+
+
+def applied_schedule_rows():
+    """現在の版で反映されているスケジュール表の行（未反映なら None）"""
+    log = revision_log()
+    applied = [p for p in log["patches"][:log["head"]] if p["slot"] == SCHEDULE_SLOT]
+    return applied[-1]["new"] if applied else None
+
+
+def replay_revisions(prs, head: int):
+    """テンプレートから読み込んだ prs に履歴の先頭 head 件を当てる（スケジュール表は最後の1件だけ）"""
+    patches = revision_log()["patches"][:head]
+    last_schedule = max((i for i, p in enumerate(patches) if p["slot"] == SCHEDULE_SLOT), default=None)
+    for i, patch in enumerate(patches):
+        if patch["slot"] != SCHEDULE_SLOT:
+            _write_slot_text(prs, patch["slide"], patch["slot"], patch["new"], patch["style"])
+        elif i == last_schedule:
+            import pandas as pd
+            reflect_schedule_to_slide7(prs, pd.DataFrame(patch["new"]))
+
+
+def move_revision_head(target: int) -> bool:
+    """
+    元に戻す・やり直す・任意の版への移動。作業中デッキとプレビュー用の edited_texts を target の版に合わせる。
+    テキストだけの移動はその場で書き換え、スケジュール表やテンプレートの値に戻るスロットを含むときは
+    書式ごと戻すためテンプレートから当て直す。
+    """
+    log = revision_log()
+    target = max(0, min(target, len(log["patches"])))
+    head = log["head"]
+    if target == head:
+        return False
+
+    edited = st.session_state.setdefault("edited_texts", {})
+    if target < head:
+        span = log["patches"][target:head]
+        steps = [(p, p["old"]) for p in reversed(span)]
+        touched = {p["slot"] for p in log["patches"][:target]}
+        rebuild = any(p["slot"] == SCHEDULE_SLOT or p["slot"] not in touched for p in span)
+    else:
+        span = log["patches"][head:target]
+        steps = [(p, p["new"]) for p in span]
+        rebuild = any(p["slot"] == SCHEDULE_SLOT for p in span)
+
+    deck = st.session_state.get("working_deck")
+    if deck is not None and rebuild:
+        discard_working_presentation()
+    for patch, value in steps:
+        if patch["slot"] == SCHEDULE_SLOT:
+            continue
+        edited[patch["slot"]] = value
+        if deck is not None and not rebuild:
+            _write_slot_text(deck["prs"], patch["slide"], patch["slot"], value, patch["style"])
+
+    log["head"] = target
+    log["version"] += 1
+    _append_revision_record({"op": "move", "from": head, "to": target})
+    return True
+
+
+# =========================
+# 一括反映と出力（全工程のスロットを1回で反映し、1回だけ保存する）
+# =========================
+# はみ出しの目安に使う文字サイズ（pt）。plain はテンプレートの書式のままなので本文の既定値で見積もる
+SLOT_STYLE_FONT_PT = {"plain": 18, "format": 12, "style": 12, "amount": 10}
+# 行の高さ = 文字サイズ × この倍率
+SLOT_LINE_SPACING = 1.2
+SURVEY_VERSION_LABELS = [f"{n}問" for n in SURVEY_ITEM_VERSIONS]
+KICKOFF_SLOT_KEYS = [
+    ("EDIT_TO_BE", "ai_目標"),
+    ("EDIT_AS_IS", "ai_現状"),
+    ("EDIT_PROBLEM", "ai_ビジネス課題"),
+    ("EDIT_PURPOSE", "ai_調査目的"),
+    ("EDIT_QUESTION", "ai_問い"),
+    ("EDIT_HYPOTHESIS", "ai_仮説"),
+]
+ANALYSIS_SLOT_FIELDS = ["subq", "axis", "metric", "approach", "hypothesis"]
+
+
+def estimate_text_overflow(shp, text: str, font_pt: float) -> float:
+    """
+    テキストが図形の枠の何割を使うかの目安（1.0 を超えたらはみ出し）。
+    全角1文字 = font_pt、半角 = その半分として折り返し行数を数え、枠の高さに入る行数と比べる。
+    """
+    import math
+    import unicodedata
+
+    if not getattr(shp, "has_text_frame", False) or not shp.width or not shp.height:
+        return 0.0
+    tf = shp.text_frame
+    width_pt = (shp.width - (tf.margin_left or 0) - (tf.margin_right or 0)) / 12700
+    height_pt = (shp.height - (tf.margin_top or 0) - (tf.margin_bottom or 0)) / 12700
+    chars_per_line = max(1.0, width_pt / font_pt)
+    capacity = max(1.0, height_pt / (font_pt * SLOT_LINE_SPACING))
+
+    lines = 0
+    for paragraph in text.split("\n"):
+        width = sum(1.0 if unicodedata.east_asian_width(ch) in "FWA" else 0.5 for ch in paragraph)
+        lines += max(1, math.ceil(width / chars_per_line))
+    return lines / capacity
+
+
+def collect_project_slots(survey_version: str = "10問") -> list:
+    """
+    現在の入力内容から、反映するテキストスロットを (工程, スライド番号, スロット, テキスト, style) の並びで返す。
+    各モードの『…に反映』ボタンと同じ値・書式を使う。空のスロットも含める（レポートで未入力と出す）。
+    """
+    ss = st.session_state
+    slots = []
+
+    def _add(mode, slot, text, style="format", default_slide=None):
+        default_slide = template_mode_slide(mode) if default_slide is None else default_slide
+        slots.append((mode, template_slot_slide(slot, default_slide), slot, text or "", style))
+
+    for slot in TEMPLATE_MODE_SLOTS["表紙"][1]:
+        _add("表紙", slot, ss.get(slot), style="plain")
+    for slot, key in KICKOFF_SLOT_KEYS:
+        _add("キックオフノート", slot, ss.get(key))
+    _add("問いの分解", "EDIT1_subQ", ss.get("subq_tree_text"), style="style")
+    for i, blk in enumerate((ss.get("analysis_blocks") or [])[:9], 1):
+        for k, field in enumerate(ANALYSIS_SLOT_FIELDS, 1):
+            text = ss.get(f"analysis_{field}_{i}") or blk.get(field)
+            _add("分析アプローチ", f"EDIT1_subQ{i}_{k}", text, default_slide=3 + (i - 1))
+    _add("対象者条件を検討", "EDIT1_taisyosya", ss.get("target_condition_textarea") or ss.get("ai_target_condition"))
+    survey_items = ss.get("ai_survey_items") or {}
+    _add("調査項目案", "EDIT1_Qimg", ss.get(f"survey_items_{survey_version}") or survey_items.get(survey_version))
+    for label, key in SPEC_ITEMS:
+        _add("調査仕様案", SPEC_LABEL_TO_SHAPE[label], ss.get(key))
+    for idx in range(1, 6):
+        _add("概算見積", f"EDIT_amount{idx}", ss.get(f"estimate_summary{idx}"), style="amount")
+    return slots
+
+
+def apply_project_and_export(survey_version: str = "10問") -> dict:
+    """
+    全工程の内容を作業中デッキに1回で反映し（履歴には『一括反映』として残る）、出力ファイルを1回だけ保存する。
+    戻り値 {"path": 保存先, "report": [{"工程", "スロット", "状態", "備考"}]}。
+    状態は 反映 / 未入力 / スロットなし / はみ出し。
+    """
+    prs = get_working_presentation()
+    report = []
+
+    def _report(mode, slot, status, note=""):
+        report.append({"工程": mode, "スロット": slot, "状態": status, "備考": note})
+
+    # スケジュール表（変わっていなければ当て直さない）
+    calendar = st.session_state.get("schedule_calendar")
+    manifest = st.session_state.get("template_manifest")
+    if manifest and "schedule1" not in manifest["slots"]:
+        _report("スケジュール案", "schedule1〜3", "スロットなし")
+    elif calendar is None or len(calendar) == 0:
+        _report("スケジュール案", "schedule1〜3", "未入力", "スケジュール案で日程を入力してください")
+    else:
+        if applied_schedule_rows() != schedule_rows(calendar):
+            prs = apply_schedule_table(prs, calendar, label="一括反映")
+        _report("スケジュール案", "schedule1〜3", "反映", f"{len(calendar)}日分")
+
+    edited = st.session_state.setdefault("edited_texts", {})
+    for mode, slide_index, slot, text, style in collect_project_slots(survey_version):
+        if not text.strip():
+            _report(mode, slot, "未入力")
+            continue
+        shp = apply_slot_text(prs, slide_index, slot, text, style=style, label="一括反映") if slide_index < len(prs.slides) else None
+        if shp is None:
+            _report(mode, slot, "スロットなし", f"スライド{slide_index + 1}")
+            continue
+        edited[slot] = text
+        usage = estimate_text_overflow(shp, text, SLOT_STYLE_FONT_PT.get(style, 12))
+        if usage > 1.0:
+            _report(mode, slot, "はみ出し", f"枠の約{usage:.0%}")
+        else:
+            _report(mode, slot, "反映")
+
+    return {"path": export_presentation(), "report": report}
+
+
+# =========================
+# ルールベースの事前抽出（AIを呼ぶ前に資料から直接読み取る）
+# =========================
+from datetime import date as _date
+
+# 自社名は顧客名の候補から除く
+SELF_COMPANY_NAMES = [n for n in os.getenv("SELF_COMPANY_NAMES", "インテージ").split(",") if n]
+
+_COMPANY_SUFFIX = r"(?:株式会社|有限会社|合同会社|合資会社|合名会社|一般社団法人|一般財団法人|公益社団法人|公益財団法人|（株）|\(株\)|㈱)"
+_COMPANY_BODY = r"[^\s　、。,，・:：「」『』（）()【】\[\]/／]{1,30}?"
+_COMPANY_PATTERNS = [
+    re.compile(rf"{_COMPANY_SUFFIX}[ 　]*({_COMPANY_BODY})(?=[\s　、。,，様御殿:：」』）)]|$|の|が|は|に|と|へ|より)", re.M),
+    re.compile(rf"({_COMPANY_BODY})[ 　]*{_COMPANY_SUFFIX}", re.M),
+    re.compile(r"([A-Za-z][A-Za-z0-9&.\- ]{1,40}?)\s*(?:Co\.,?\s*Ltd\.?|Inc\.|Corporation|Corp\.)"),
+]
+
+_TITLE_LABEL = re.compile(r"^\s*[・●■□◆◇\-\*]*\s*(?:調査名|件名|案件名|タイトル|プロジェクト名|テーマ)\s*[:：]\s*(.+?)\s*$", re.M)
+_TITLE_HEADING = re.compile(r"^\s*[「『【]?\s*(.{4,40}?(?:調査|リサーチ|分析|検証)(?:の?(?:ご依頼|ご相談|について|企画|概要|オリエンテーション|オリエン))?)\s*[」』】]?\s*$", re.M)
+
+_ERA_BASE = {"令和": 2018, "平成": 1988}
+_DATE_PATTERNS = [
+    # 2025年2月10日 / 2025/2/10 / 2025-02-10 / 2025.2.10
+    (re.compile(r"(\d{4})\s*[年/\-.]\s*(\d{1,2})\s*[月/\-.]\s*(\d{1,2})\s*日?"), "ymd"),
+    # 令和7年2月10日（令和元年も可）
+    (re.compile(r"(令和|平成)\s*(\d{1,2}|元)\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日"), "era"),
+    # 2月10日
+    (re.compile(r"(?<![\d/年.\-])(\d{1,2})\s*月\s*(\d{1,2})\s*日"), "md"),
+    # 2/10（月）。「1/3」のような分数と区別するため、曜日が続くか行に日程の語があるときだけ日付とみなす
+    (re.compile(r"(?<![\d/年.\-])(\d{1,2})/(\d{1,2})(?![\d/])"), "slash"),
+]
+_WEEKDAY_AFTER = re.compile(r"\s*[（(][月火水木金土日][)）]")
+_DATE_CONTEXT = re.compile(r"日程|スケジュール|納品|納期|締切|締め切り|〆切|期限|期日|予定|実施|開始|終了|提出|報告|キックオフ|オリエン|プレゼン|提案|まで|から|迄|〜|～")
+
+# 社名の本体として拾ってしまう敬称・助詞（「株式会社 御中」「〇〇株式会社様と株式会社△△」など）
+_COMPANY_NON_NAME = re.compile(r"^(?:御中|様|殿|各位|宛|と|の|が|は|に|へ|や|を|より|および|及び)+$")
+
+
+def _normalize_company(name: str) -> str:
+    # 日本語の前後の空白は詰め、英字社名の単語間の空白は1つに
+    name = re.sub(r"(?<=[^\x00-\x7F])\s+|\s+(?=[^\x00-\x7F])", "", name.strip())
+    return re.sub(r"\s+", " ", name).strip("・-_ ")
+
+
+def extract_company_names(text: str) -> list:
+    """
+    会社の表記（株式会社〇〇・〇〇株式会社・（株）など）を出現回数の多い順（同数なら出現順）に返す（自社名は除く）。
+    前株と後株の両方に読める箇所は後株（〇〇株式会社）を優先する。
+    """
+    counts = {}
+    names = {}  # 社名本体 → 最初に見つかった表記（前株・後株の違いは同じ会社として数える）
+    first_pos = {}
+    suffix_last_spans = []
+    # 後株 → 英字 → 前株 の順に読み、後株と重なる前株の一致は捨てる
+    for pattern in (_COMPANY_PATTERNS[1], _COMPANY_PATTERNS[2], _COMPANY_PATTERNS[0]):
+        for m in pattern.finditer(text):
+            full = _normalize_company(m.group(0))
+            body = _normalize_company(m.group(1))
+            if len(body) < 2 or re.search(r"\d+\s*[年月日/]", body) or _COMPANY_NON_NAME.match(body):
+                continue
+            if any(own in full for own in SELF_COMPANY_NAMES):
+                continue
+            if pattern is _COMPANY_PATTERNS[0] and any(s < m.end() and m.start() < e for s, e in suffix_last_spans):
+                continue
+            if pattern is _COMPANY_PATTERNS[1]:
+                suffix_last_spans.append(m.span())
+            # （株）〇〇 のような略記は「株式会社〇〇」にそろえる
+            full = re.sub(r"[（(]株[)）]|㈱", "株式会社", full)
+            names.setdefault(body, full)
+            first_pos[body] = min(first_pos.get(body, m.start()), m.start())
+            counts[body] = counts.get(body, 0) + 1
+    return [names[body] for body, _ in sorted(counts.items(), key=lambda kv: (-kv[1], first_pos[kv[0]]))]
+
+
+def extract_title_candidates(text: str) -> list:
+    """「調査名：〇〇」のようなラベル付きの行、次に資料冒頭の調査名らしい見出しを候補として返す"""
+    candidates = [m.group(1) for m in _TITLE_LABEL.finditer(text)]
+    # ラベル付きの行は見出しとしては数えない（「調査名：〇〇調査」がラベルごと候補になるのを防ぐ）
+    head = "\n".join(line for line in text.splitlines()[:40] if not _TITLE_LABEL.match(line))
+    candidates += [m.group(1) for m in _TITLE_HEADING.finditer(head) if not m.group(1).endswith("。")]
+    seen = []
+    for c in candidates:
+        c = c.strip().strip("「」『』【】")
+        if c and c not in seen:
+            seen.append(c)
+    return seen
+
+
+def parse_japanese_dates(text: str, base_date=None, date_context: bool = False) -> list:
+    """
+    日本語の日付表現を読み取り、[(date, 行テキスト, 日付部分)] を出現順に返す。
+    年のない表記（2/10（月）など）は base_date（既定は今日）以降の最も近い日付とみなす。
+    「2/10」のような月/日は、曜日が続くか行に日程の語（納品・締切・〜など）があるときだけ読む。
+    日程の項目の値など、日付と分かっている文字列なら date_context=True で常に読む。
+    """
+    base_date = base_date or _date.today()
+    found = []
+    for line in text.splitlines():
+        taken = []
+        in_line = []
+        for pattern, kind in _DATE_PATTERNS:
+            for m in pattern.finditer(line):
+                if any(s <= m.start() < e for s, e in taken):
+                    continue
+                if kind == "slash" and not (
+                    date_context or _WEEKDAY_AFTER.match(line, m.end()) or _DATE_CONTEXT.search(line)
+                ):
+                    continue
+                try:
+                    if kind == "ymd":
+                        d = _date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+                    elif kind == "era":
+                        year = 1 if m.group(2) == "元" else int(m.group(2))
+                        d = _date(_ERA_BASE[m.group(1)] + year, int(m.group(3)), int(m.group(4)))
+                    else:
+                        month = int(m.group(1))
+                        day = int(m.group(2))
+                        d = _date(base_date.year, month, day)
+                        # 2か月以上前の日付は翌年の予定とみなす
+                        if (base_date - d).days > 60:
+                            d = _date(base_date.year + 1, month, day)
+                except ValueError:
+                    continue
+                taken.append((m.start(), m.end()))
+                in_line.append((m.start(), d, line.strip(), m.group(0)))
+        found += [(d, ln, raw) for _, d, ln, raw in sorted(in_line, key=lambda x: x[0])]
+    return found
+
+
+def extract_schedule_dates(text: str, base_date=None) -> list:
+    """
+    日付を含む行からマイルストン（name・fixed_date）を作る。schedule_phase_draft と同じ形式で日付順に返す。
+    行から日付・曜日・記号を取り除いた残りを工程名にする（残りが空の行は除く）。
+    """
+    phases = []
+    seen = set()
+    for d, line, raw in parse_japanese_dates(text, base_date):
+        name = line.replace(raw, " ")
+        name = re.sub(r"[（(][月火水木金土日]?[)）]|[（(]\s*[)）]", " ", name)
+        name = re.sub(r"^[\s・●■□◆◇\-\*\d.)）]+", "", name)
+        name = re.sub(r"[\s:：、,，〜～\-]+$", "", name)
+        name = re.sub(r"\s+", " ", name).strip(" :：")[:30]
+        # 日付だけの行（資料の作成日など）はマイルストンとみなさない
+        if not name or (name, d) in seen:
+            continue
+        seen.add((name, d))
+        phases.append({"name": name, "fixed_date": d.isoformat()})
+    phases.sort(key=lambda p: p["fixed_date"])
+    return phases
+
+
+# =========================
+# 資料からの一括抽出（表紙・ブランド診断・オリエン整理で共用）
+# =========================
+# 同じ資料（先頭4,000文字）に対する短い抽出を1回の呼び出しにまとめる：(キー, 見出し)
+DOC_EXTRACTION_FIELDS = [
+    ("client", "顧客名"),
+    ("title", "調査名"),
+    ("company", "企業名"),
+    ("category", "カテゴリー（市場）"),
+    ("brand", "ブランド"),
+]
+
+
+@st.cache_resource(show_spinner=False)
+def _doc_extraction_cache():
+    """資料のハッシュ → 抽出結果（全セッションで共有。同じ資料を別の担当者が読み込んでも呼び直さない）"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def doc_corpus_key(ori_texts: str) -> str:
+    return llm_input_key(ori_texts[:4000])
+
+
+def cached_doc_extraction(corpus_key: str):
+    cache = _doc_extraction_cache()
+    with cache["lock"]:
+        return cache["entries"].get(corpus_key)
+
+
+def parse_doc_extraction(text: str) -> dict:
+    """
+    一括抽出の出力（JSONオブジェクト）を {"client", "title", "company", "category", "brand"} にする。
+    JSON として読めない場合は「見出し：値」の行から拾う。1項目も読み取れなければ空の dict。
+    """
+    ai_text = text.strip()
+    if ai_text.startswith("```"):
+        ai_text = ai_text.strip("`")
+        ai_text = ai_text.replace("json", "", 1).strip()
+    try:
+        data = json.loads(ai_text)
+    except Exception:
+        data = {}
+        for key, label in DOC_EXTRACTION_FIELDS:
+            m = re.search(rf"{re.escape(label)}[:：]\s*(.*)", ai_text)
+            if m:
+                data[key] = m.group(1)
+    if not isinstance(data, dict):
+        return {}
+
+    fields = {}
+    for key, _ in DOC_EXTRACTION_FIELDS:
+        value = str(data.get(key) or "").strip().strip("「」\"")
+        fields[key] = "" if value in ("なし", "不明", "-") else value
+    return fields if any(fields.values()) else {}
+
+
+def build_doc_extraction_job(ori_texts: str, overwrite_brand: bool = False) -> dict:
+    """
+    顧客名・調査名・企業名・カテゴリー・ブランドを1回の呼び出しで抽出するジョブを組み立てる。
+    結果は資料のハッシュで共有キャッシュに保存し、次の session_state に振り分ける：
+      ai_client_name / ai_project_title（表紙）、orien_company_text、target_category / target_brand
+    入力済みの項目は残す（overwrite_brand=True ならカテゴリー・ブランドは上書きする：ブランド診断の推測ボタン用）。
+    戻り値：{"label", "work", "on_done", "input_key"}
+    """
+    corpus_key = doc_corpus_key(ori_texts)
+    field_lines = "\n".join(f'  "{key}": "{label}"' for key, label in DOC_EXTRACTION_FIELDS)
+    prompt = f"""
+あなたは市場調査の専門家です。
+以下のオリエン資料から、次の項目を抽出・推定してください。
+
+【項目】
+- client：顧客企業名（調査の依頼元）
+- title：調査タイトル（資料に明記がなければ内容から簡潔に名付ける）
+- company：資料に登場する調査対象の企業名（依頼元と同じなら同じ値）
+- category：今回の調査対象となるカテゴリー（市場）
+- brand：今回の調査対象となるブランド名
+
+【出力形式】
+- 必ず JSON オブジェクト1つのみを出力してください（余計な文章やコードブロックは書かないこと）
+- 該当がなければ空文字にしてください。
+{{
+{field_lines}
+}}
+
+資料内容：
+{ori_texts[:4000]}
+"""
+
+    def _work(control, prompt=prompt, corpus_key=corpus_key):
+        fields = cached_doc_extraction(corpus_key)
+        if fields is not None:
+            return fields
+        response = call_llm(
+            "資料の一括抽出",
+            messages=[
+                {"role": "system", "content": "あなたは市場調査の専門家です。"},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.3,
+            max_tokens=300,
+            control=control,
+        )
+        fields = parse_doc_extraction(response["content"])
+        record_parse_outcome(response, bool(fields))
+        if not fields:
+            raise LLMOutputError("AI出力から顧客名・調査名・カテゴリー・ブランドを読み取れませんでした。", response["content"])
+        cache = _doc_extraction_cache()
+        with cache["lock"]:
+            cache["entries"][corpus_key] = fields
+        return fields
+
+    def _apply(fields):
+        apply_doc_extraction(fields, overwrite_brand=overwrite_brand)
+        if overwrite_brand:
+            return "カテゴリーとブランドを抽出しました。下の欄で確認・編集できます。"
+        return "資料から顧客名・調査名・カテゴリー・ブランドを推測しました。"
+
+    return {
+        "label": "資料からの項目抽出",
+        "work": _work,
+        "on_done": _apply,
+        # 上書きの有無で分ける（表紙の自動推測が実行中でも、推測ボタンの上書きが合流して消えないように）
+        "input_key": f"{corpus_key}:overwrite" if overwrite_brand else corpus_key,
+    }
+
+
+def apply_doc_extraction(fields: dict, overwrite_brand: bool = False):
+    """一括抽出の結果を各モードの session_state に振り分ける（スクリプト側で呼ぶ）"""
+    # 表紙：ルールで読み取れた項目・入力済みの項目はそのまま残す
+    for field, ai_key, edit_key in [
+        ("client", "ai_client_name", "Edit_client"),
+        ("title", "ai_project_title", "Edit_title"),
+    ]:
+        if fields.get(field) and not st.session_state.get(ai_key):
+            st.session_state[ai_key] = fields[field]
+            if not st.session_state.get(edit_key):
+                st.session_state[edit_key] = fields[field]
+
+    if fields.get("company") and not st.session_state.get("orien_company_text"):
+        st.session_state["orien_company_text"] = fields["company"]
+
+    for field, key in [("category", "target_category"), ("brand", "target_brand")]:
+        if overwrite_brand or not st.session_state.get(key):
+            st.session_state[key] = fields.get(field, "")
+
+
+# =========================
+# オリエン内容の整理の構造化（スケジュール・調査仕様・概算見積で直接参照する）
+# =========================
+# 「下書き開始」の出力形式の見出し（右ペインのプロンプトと対応）
+ORIEN_SPEC_REQUEST_LABELS = [
+    "調査エリア",
+    "スクリーニング調査有無",
+    "対象者条件",
+    "質問数",
+    "サンプルサイズ",
+    "調査画面で画像や動画の提示",
+    "ウェイトバック集計の有無",
+    "自由回答のコーディング処理の有無",
+    "調査票作成（クライアントがやるか当社がやるか）",
+    "報告書は必要か",
+]
+ORIEN_SCHEDULE_REQUEST_LABELS = [
+    "企画提案予定日",
+    "調査票や画像に関する提供可能日",
+    "希望する納期",
+    "請求日/月",
+    "クライアントの重要な会議日",
+    "その他スケジュールに関する要望",
+]
+# 調査仕様の項目（SPEC_ITEMS のラベル）← オリエンの要望の見出し
+SPEC_FROM_ORIEN = {
+    "調査地域": "調査エリア",
+    "サンプルサイズ": "サンプルサイズ",
+}
+
+_EMPTY_VALUES = {"", "なし", "特になし", "不明", "記載なし", "言及なし", "-", "ー"}
+
+
+def _outline_label(label: str) -> str:
+    return re.sub(r"[\s　]+", "", label)
+
+
+def _parse_yen(text: str):
+    """「500万円」「3,000,000円」「1.5億円」などを円の整数にする。読み取れなければ None"""
+    m = re.search(r"(\d[\d,]*(?:\.\d+)?)\s*(億|千万|百万|万)?\s*円", text or "")
+    if not m:
+        return None
+    unit = {"億": 100_000_000, "千万": 10_000_000, "百万": 1_000_000, "万": 10_000}.get(m.group(2), 1)
+    return int(float(m.group(1).replace(",", "")) * unit)
+
+
+def _parse_count(text: str, minimum: int = 1):
+    """「1,000ss」「n=300」「20問程度」などから最初の整数（minimum 以上）を取り出す"""
+    for m in re.finditer(r"\d[\d,]*", text or ""):
+        value = int(m.group(0).replace(",", ""))
+        if value >= minimum:
+            return value
+    return None
+
+
+def parse_orien_outline(text: str) -> dict:
+    """
+    「オリエン内容の整理」の下書き（・見出し：内容 の形式）を構造化する。
+    戻り値：{"company", "brand", "category",
+             "spec_requests": {見出し: 内容}, "schedule_requests": {見出し: 内容},
+             "budget_cap_yen": 円 or None, "budget_cap_text", "multiple_estimates",
+             "question_count", "sample_size"}
+    「なし」など記載のない項目は空文字（数値は None）にする。
+    """
+    values = {}
+    for line in (text or "").splitlines():
+        m = re.match(r"^\s*[・\-\*●■]?\s*([^：:]{1,40}?)\s*[：:]\s*(.*)$", line)
+        if not m:
+            continue
+        value = m.group(2).strip()
+        values.setdefault(_outline_label(m.group(1)), "" if value in _EMPTY_VALUES else value)
+
+    def _get(label):
+        return values.get(_outline_label(label), "")
+
+    spec_requests = {label: _get(label) for label in ORIEN_SPEC_REQUEST_LABELS}
+    budget_text = _get("見積金額上限")
+    return {
+        "company": _get("企業名"),
+        "brand": _get("ブランド名"),
+        "category": _get("カテゴリー（市場）名"),
+        "spec_requests": spec_requests,
+        "schedule_requests": {label: _get(label) for label in ORIEN_SCHEDULE_REQUEST_LABELS},
+        "budget_cap_yen": _parse_yen(budget_text),
+        "budget_cap_text": budget_text,
+        "multiple_estimates": _get("複数パターンの見積を希望しているか"),
+        "question_count": _parse_count(spec_requests["質問数"]),
+        "sample_size": _parse_count(spec_requests["サンプルサイズ"], minimum=10),
+    }
+
+
+def get_orien_record() -> dict:
+    """
+    現在の orien_outline_text を構造化したもの（テキストが変わったときだけ解析し直す）。
+    下書きの生成直後・中央ペインでの編集後のどちらでも最新の内容を返す。
+    """
+    text = st.session_state.get("orien_outline_text", "")
+    key = llm_input_key(text)
+    record = st.session_state.get("orien_record")
+    if record is None or record.get("source_key") != key:
+        record = parse_orien_outline(text)
+        record["source_key"] = key
+        st.session_state["orien_record"] = record
+    return record
+
+
+def schedule_phases_from_record(record: dict, base_date=None) -> list:
+    """オリエンのスケジュール要望のうち日付が読み取れる項目を、見出しを工程名にしたマイルストンにする"""
+    phases = []
+    for label, value in record.get("schedule_requests", {}).items():
+        dates = parse_japanese_dates(value, base_date, date_context=True) if value else []
+        if dates:
+            phases.append({"name": label, "fixed_date": dates[0][0].isoformat()})
+    phases.sort(key=lambda p: p["fixed_date"])
+    return phases
+
+
+def format_orien_requests(requests: dict) -> str:
+    """要望の dict をプロンプトに埋め込む行にする（記載のない項目は省く）"""
+    return "\n".join(f"- {label}：{value}" for label, value in requests.items() if value)
+
+
+# =========================
+# 下書き生成ジョブの組み立て（右ペインのボタンと先読みで共用）
+# =========================
+def build_kickoff_job(selected_purpose: str, matrix_text: str, n_candidates: int = 1) -> dict:
+    """
+    『キックオフノート』の下書きジョブを組み立てる（右ペインのボタン用）。
+    selected_purpose / matrix_text：調査目的マトリクスで選んだテーマとその説明。
+    戻り値は build_subquestion_job と同じ形式に、項目ごとの再生成で使う "messages" を加えたもの。
+    """
+    ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
+    orien_outline_text = st.session_state.get("orien_outline_text", "")
+    cat_df = st.session_state.get("df_category_structure")
+    beh_df = st.session_state.get("df_behavior_traits")
+    funnel_text = st.session_state.get("funnel_text", "")
+
+    if not ori_texts.strip():
+        return {"warning": "オリエン資料をアップロードしてください。"}
+
+    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
+    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
+
+    prompt = f"""
+    あなたは市場調査設計の専門家です。
+    以下のオリエン資料、ブランド診断結果、調査目的マトリクスをもとに、
+    調査設計の初期段階で用いる「キックオフノート」を作成してください。
+
+    【出力形式】
+    【目標】
+    【現状】
+    【ビジネス課題】
+    【調査目的】
+    【問い】
+    【仮説】
+    【ポイント】
+
+    
+    【条件】
+    - 各項目は80〜120字以内
+    - オリエン資料にある固有名詞や文脈を十分に生かしてください。
+    - 【目標】や【現状】は経営課題や社会問題など、調査では解決できない抽象課題は避けてください。
+      あくまで「消費者・市場・ブランド・広告・顧客体験」など、市場調査で仮説検証できる範囲に課題を限定してください。
+    - 【問い】はオリエンシートやブランド診断を踏まえた現在の対象ブランドの"リサーチクエスチョン"のことです。
+      ブランド全体について問う場合と広告やプロダクト/サービス、顧客接点など施策について問う場合があります。
+    - 【ポイント】にはなぜキックオフノートの各項目にそう記載したのか、特に注意すべき点や補足説明を簡潔に記載してください。
+      
+    【入力データ】
+    ▼オリエン内容の整理（抜粋）
+    {orien_outline_text[:2000]}
+
+    ▼ブランド診断：カテゴリー構造
+    {cat_text}
+
+    ▼ブランド診断：消費行動特性
+    {beh_text}
+
+    ▼マーケティングファネル
+    {funnel_text}
+
+    ▼選択した調査目的
+    {selected_purpose}：{matrix_text}
+
+
+    【禁止事項】
+    - ###、** などの記号は使わないでください。
+    """
+
+    messages = [
+        {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+        {"role": "user", "content": prompt},
+    ]
+
+    def _work(control, messages=messages, n=n_candidates):
+        response = call_llm(
+            "キックオフノート",
+            messages=messages,
+            temperature=0.6 if n == 1 else 0.9,  # 複数案のときは案どうしの違いを出す
+            max_tokens=900,
+            control=control,
+            n=n,
+        )
+
+        candidates = [parse_ai_output(text) for text in response.get("choices", [response["content"]])]
+        candidates = [c for c in candidates if any(c.values())]
+        record_parse_outcome(response, bool(candidates))
+        if n > 1:
+            if not candidates:
+                # 空の候補一覧を返すと中央ペインに何も出ないため、失敗として通知する
+                raise LLMOutputError(
+                    "どの候補からもキックオフノートの項目を読み取れませんでした。",
+                    "\n\n---\n\n".join(response.get("choices", [response["content"]])),
+                )
+            return {"candidates": candidates}
+        return candidates[0] if candidates else parse_ai_output(response["content"])
+
+    def _apply(sections):
+        if "candidates" in sections:
+            # 中央ペインで1案を選んでもらう
+            st.session_state["kickoff_candidates"] = sections["candidates"]
+            return f"キックオフノートの候補を{len(sections['candidates'])}案生成しました。中央ペインで採用する案を選んでください。"
+        # セッションに保存
+        for key in sections:
+            st.session_state[f"ai_{key}"] = sections[key]
+        return "キックオフノートの下書きを生成しました！中央ペインに反映されます。"
+
+    return {
+        "label": "キックオフノートの下書き",
+        "work": _work,
+        "on_done": _apply,
+        "messages": messages,
+        "input_key": llm_input_key(prompt, n_candidates),
+        "est_tokens": estimate_tokens(prompt) + 900 * n_candidates,
+        "forecast": forecast_llm_calls("キックオフノート", [messages], 900, n=n_candidates),
+    }
+
+
+def build_subquestion_job(n_candidates: int = 1) -> dict:
+    """
+    『問いの分解』の下書きジョブを組み立てる（右ペインのボタンと先読みで共用）。
+    戻り値：{"label", "work", "on_done", "input_key", "est_tokens", "forecast"}。入力が足りなければ {"warning": 案内文}
+    """
+    ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
+    orien_outline_text = st.session_state.get("orien_outline_text", "")
+    cat_df = st.session_state.get("df_category_structure")
+    beh_df = st.session_state.get("df_behavior_traits")
+    main_question = st.session_state.get("ai_問い", "")
+
+    if not main_question.strip():
+        return {"warning": "キックオフノート⑤『問い』が生成または入力されていません。"}
+    if not ori_texts.strip():
+        return {"warning": "オリエン資料をアップロードしてください。"}
+
+    cat_text = (
+        cat_df.to_markdown(index=False)
+        if cat_df is not None and not cat_df.empty
+        else ""
+    )
+    beh_text = (
+        beh_df.to_markdown(index=False)
+        if beh_df is not None and not beh_df.empty
+        else ""
+    )
+
+    prompt = f"""
+あなたは市場調査設計の専門家です。
+以下の情報をもとに、キックオフノート⑤『問い』（リサーチクエスチョン）を深掘りするための
+【サブクエスチョン】を提案してください。サブクエスチョンへのアプローチは分析軸、評価項目、主な分析アプローチ、
+読み方・示唆例を含めて具体的に示してください。
+
+クロス集計分析の場合の例を示します。
+【出力形式】
+- サブクエスチョン1：認知度に影響を与える要因は何か？   
+  - 分析軸：性年代など
+  - 評価項目：認知度、利用率など
+  - 主な分析アプローチ：性年代ごとに認知度の違いを比較する
+  - 読み方・示唆例：若年層で認知度が低い場合、若年層向けの広告強化が必要など
+- サブクエスチョン2：購入者タイプごとに主に利用する情報源は何か？
+  - 分析軸：ヘビー層、ライト層など
+  - 評価項目：購入タイプ
+  - 主な分析アプローチ：ヘビー層ライト層ごとに情報源の違いを比較する
+  - 読み方・示唆例：ヘビー層はSNS、ライト層は店頭広告が主な情報源など
+
+
+【キックオフノート⑤ 問い】
+{main_question}
+
+▼オリエン内容の整理（抜粋）
+ {orien_outline_text[:2000]}
+
+【ブランド診断：カテゴリー構造】
+{cat_text}
+
+【ブランド診断：消費行動特性】
+{beh_text}
+
+【禁止事項】
+ - ###、** などの記号は使わないでください。
+ - サブクエスチョンはどの問い（リサーチクエスチョン）にも対応しているのかが分かるように具体的に記載してください。
+ - 1つの問いに対して、最大3つのサブクエスチョンを提案してください。
+"""
+
+    messages = [
+        {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+        {"role": "user", "content": prompt},
+    ]
+
+    def _work(control, messages=messages, n=n_candidates):
+        response = call_llm(
+            "問いの分解",
+            messages=messages,
+            temperature=0.6 if n == 1 else 0.9,  # 複数案のときは案どうしの違いを出す
+            max_tokens=2000,
+            control=control,
+            n=n,
+        )
+        candidates = [
+            {"ai_text": text, "subq_list": parse_subquestions(text)}
+            for text in response.get("choices", [response["content"]])
+        ]
+        record_parse_outcome(response, all(c["subq_list"] for c in candidates))
+        if n > 1:
+            return {"candidates": [c for c in candidates if c["subq_list"]] or candidates}
+        return candidates[0]
+
+    def _apply(result):
+        if "candidates" in result:
+            # 中央ペインで1案を選んでもらう
+            st.session_state["subq_candidates"] = result["candidates"]
+            return f"サブクエスチョンの候補を{len(result['candidates'])}案生成しました。中央ペインで採用する案を選んでください。"
+
+        # ★ 生テキストを保存（中央ペインのテキストエリア用）
+        st.session_state["ai_subquestions"] = result["ai_text"]
+
+        # ★ パースして構造化データも保存（問いの分解ビュー & 分析アプローチ用）
+        st.session_state["subq_list"] = result["subq_list"]
+        return "下書きを生成しました！中央ペインおよび分析アプローチで利用できます。"
+
+    return {
+        "label": "サブクエスチョンの下書き",
+        "work": _work,
+        "on_done": _apply,
+        "input_key": llm_input_key(prompt, n_candidates),
+        "est_tokens": estimate_tokens(prompt) + 2000 * n_candidates,
+        "forecast": forecast_llm_calls("問いの分解", [messages], 2000, n=n_candidates),
+    }
+
+
+def build_analysis_job(fanout: bool = True) -> dict:
+    """
+    『分析アプローチ』の下書きジョブを組み立てる（右ペインのボタンと先読みで共用）。
+    fanout=True ならサブクエスチョンごとの小さなリクエストを並列に投げる。
+    戻り値は build_subquestion_job と同じ形式。
+    """
+    subq_list = st.session_state.get("subq_list", [])
+    if not subq_list:
+        return {"warning": "先に『問いの分解』モードでサブクエスチョンを生成してください。"}
+
+    orien_outline_text = st.session_state.get("orien_outline_text", "")
+    cat_df = st.session_state.get("df_category_structure")
+    beh_df = st.session_state.get("df_behavior_traits")
+
+    kickoff = {
+        "目標": st.session_state.get("ai_目標", ""),
+        "現状": st.session_state.get("ai_現状", ""),
+        "ビジネス課題": st.session_state.get("ai_ビジネス課題", ""),
+        "調査目的": st.session_state.get("ai_調査目的", ""),
+        "問い": st.session_state.get("ai_問い", ""),
+        "仮説": st.session_state.get("ai_仮説", ""),
+    }
+
+    # サブクエスチョン一覧（AIに渡す用）
+    subq_text_lines = []
+    for i, sq in enumerate(subq_list, 1):
+        subq_text_lines.append(f"SQ{i}: {sq.get('subq', '')}")
+    subq_text = "\n".join(subq_text_lines)
+
+    # 参考情報
+    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
+    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
+
+    import json
+
+    prompt = f"""
+あなたは市場調査設計の専門家です。
+以下のサブクエスチョンそれぞれについて、次の6項目の観点から分析アプローチの下書きを作成してください。
+
+【対象となる6項目】
+- id: "SQ1" のようなID
+- subq: サブクエスチョン本文
+- axis: 分析軸（セグメント）
+- metric: 評価項目
+- approach: 主な分析アプローチ（どのような切り口で分析するか）
+- hypothesis: 検証する仮説（どのような結果が出ると何が言えるのか）
+
+▼オリエン内容の整理（抜粋）
+ {orien_outline_text[:2000]}
+
+▼ブランド診断：カテゴリー構造
+{cat_text}
+
+▼ブランド診断：消費行動特性
+{beh_text}
+
+▼キックオフノート
+{kickoff}
+
+【サブクエスチョン一覧】
+{subq_text}
+
+【出力形式】
+- 必ず JSON 配列のみを出力してください（余計な文章やコードブロックは書かないこと）
+- 形式の例：
+
+[
+  {{
+    "id": "SQ1",
+    "subq": "・・・",
+    "axis": "・・・",
+    "metric": "・・・",
+    "approach": "・・・",
+    "hypothesis": "・・・"
+  }},
+  {{
+    "id": "SQ2",
+    "subq": "・・・",
+    "axis": "・・・",
+    "metric": "・・・",
+    "approach": "・・・",
+    "hypothesis": "・・・"
+  }}
+]
+
+- 配列の要素数は、入力されたサブクエスチョンの数と同じにしてください。
+- axis: 分析軸（セグメント）の案が複数ある場合は最も優先度の高いもの1つを提示してください。　
+  また、分析軸案の後に（）で具体的な項目を記載してください。
+- metric: 評価項目の案が複数ある場合は最も重要なもの1つを提示してください。
+- metric: 評価項目案の後に（）で具体的な項目を記載してください。
+  例：評価指標の場合は（あてはまる、ややあてはまる）など尺度の項目、イメージ項目の場合は（自分らしい、新しい）など
+- approach: 主な分析アプローチ（どのような切り口で分析するか）は、以下の形式で記載してください。
+  例：「性年代ごとに認知度の違いを比較する」「購入タイプ別に情報源の違いを分析する」など
+- hypothesis: 検証する仮説（どのような結果が出ると何が言えるのか）の語尾に「～の可能性が高い（ある）」を用いないでください。
+"""
+
+    messages = [
+        {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+        {"role": "user", "content": prompt},
+    ]
+
+    def _work(control, messages=messages):
+        response = call_llm(
+            "分析アプローチ",
+            messages=messages,
+            temperature=0.6,
+            max_tokens=2000,
+            control=control,
+        )
+        ai_text = response["content"].strip()
+
+        # ```json ... ``` で返ってきた場合のガード
+        if ai_text.startswith("```"):
+            ai_text = ai_text.strip("`")
+            ai_text = ai_text.replace("json", "", 1).strip()
+
+        try:
+            blocks = json.loads(ai_text)
+            if not isinstance(blocks, list):
+                raise ValueError("JSON配列ではありません。")
+        except Exception:
+            record_parse_outcome(response, False)
+            raise LLMOutputError(
+                "AI出力をJSON配列として解釈できませんでした。出力内容を確認してください。", ai_text
+            )
+        record_parse_outcome(response, True)
+        return blocks
+
+    def _apply(blocks):
+        # セッションに保存：中央ペインで参照する
+        st.session_state["analysis_blocks"] = blocks
+        # 以前の表示テキストもリセットしておく
+        if "analysis_block_texts" in st.session_state:
+            del st.session_state["analysis_block_texts"]
+        return "サブクエスチョン別の分析アプローチ案を作成しました。中央ペインに表示します。"
+
+    if not fanout:
+        return {
+            "label": "分析アプローチ案",
+            "work": _work,
+            "on_done": _apply,
+            "input_key": llm_input_key(prompt),
+            "est_tokens": estimate_tokens(prompt) + 2000,
+            "forecast": forecast_llm_calls("分析アプローチ", [messages], 2000),
+        }
+
+    # 共通の前提（全SQで同一）を先頭に置き、SQごとの指示だけを差し替える
+    common_context = f"""
+あなたは市場調査設計の専門家です。
+以下の前提を踏まえ、指定されたサブクエスチョン1件について分析アプローチの下書きを作成してください。
+
+▼オリエン内容の整理（抜粋）
+ {orien_outline_text[:2000]}
+
+▼ブランド診断：カテゴリー構造
+{cat_text}
+
+▼ブランド診断：消費行動特性
+{beh_text}
+
+▼キックオフノート
+{kickoff}
+
+【サブクエスチョン一覧（参考）】
+{subq_text}
+
+【出力形式】
+- 必ず JSON オブジェクト1つのみを出力してください（余計な文章やコードブロックは書かないこと）
+- キーは id, subq, axis, metric, approach, hypothesis の6つです。
+- axis: 分析軸（セグメント）の案が複数ある場合は最も優先度の高いもの1つを提示し、後に（）で具体的な項目を記載してください。
+- metric: 評価項目の案が複数ある場合は最も重要なもの1つを提示し、後に（）で具体的な項目を記載してください。
+  例：評価指標の場合は（あてはまる、ややあてはまる）など尺度の項目、イメージ項目の場合は（自分らしい、新しい）など
+- approach: 「性年代ごとに認知度の違いを比較する」「購入タイプ別に情報源の違いを分析する」のような形式で記載してください。
+- hypothesis: 語尾に「～の可能性が高い（ある）」を用いないでください。
+"""
+    sq_requests = []
+    for i, sq in enumerate(subq_list, 1):
+        sq_requests.append([
+            {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+            {"role": "user", "content": common_context + f"""
+【対象のサブクエスチョン】
+id: SQ{i}
+subq: {sq.get('subq', '')}
+"""},
+        ])
+
+    def _parse_block(response):
+        ai_text = response["content"].strip()
+        if ai_text.startswith("```"):
+            ai_text = ai_text.strip("`")
+            ai_text = ai_text.replace("json", "", 1).strip()
+        block = json.loads(ai_text)
+        if isinstance(block, list) and len(block) == 1:
+            block = block[0]
+        if not isinstance(block, dict):
+            raise ValueError("JSONオブジェクトではありません。")
+        return block
+
+    def _work_fanout(control, sq_requests=sq_requests, subq_list=list(subq_list)):
+        blocks, errors = run_llm_fanout(
+            "分析アプローチ/SQ",  # SQ単位の短い呼び出しは一括生成と分けて計測する
+            sq_requests,
+            _parse_block,
+            control=control,
+            temperature=0.6,
+            max_tokens=500,
+        )
+        if all(b is None for b in blocks):
+            raise RuntimeError(errors[0] if errors else "サブクエスチョンがありません。")
+        # SQ順に並べ直し、失敗したSQは空欄の行として残す
+        merged, failed = [], []
+        for i, (sq, block) in enumerate(zip(subq_list, blocks), 1):
+            if block is None:
+                failed.append(f"SQ{i}")
+                block = {"axis": "", "metric": "", "approach": "", "hypothesis": ""}
+            block["id"] = f"SQ{i}"
+            block.setdefault("subq", sq.get("subq", ""))
+            merged.append(block)
+        return {"blocks": merged, "failed": failed}
+
+    def _apply_fanout(result):
+        message = _apply(result["blocks"])
+        if result["failed"]:
+            message += f"（{'・'.join(result['failed'])} は生成に失敗したため空欄です）"
+        return message
+
+    return {
+        "label": "分析アプローチ案",
+        "work": _work_fanout,
+        "on_done": _apply_fanout,
+        "input_key": llm_input_key(sq_requests),
+        "est_tokens": sum(estimate_tokens(m[-1]["content"]) + 500 for m in sq_requests),
+        "forecast": forecast_llm_calls("分析アプローチ/SQ", sq_requests, 500, parallel=LLM_FANOUT_PARALLELISM),
+    }
+
+
+def build_survey_items_job() -> dict:
+    """
+    『調査項目案』の下書きジョブを組み立てる（右ペインのボタン用）。
+    戻り値は build_subquestion_job と同じ形式。
+    """
+    # 「オリエン内容の整理」で作成したテキストを参照
+    orien_outline_text = st.session_state.get("orien_outline_text", "")
+    if not orien_outline_text.strip():
+        return {"warning": "先に『オリエン内容の整理』で下書きを作成してください。"}
+
+    cat_df = st.session_state.get("df_category_structure")
+    beh_df = st.session_state.get("df_behavior_traits")
+    kickoff = {
+        "目標": st.session_state.get("ai_目標", ""),
+        "現状": st.session_state.get("ai_現状", ""),
+        "ビジネス課題": st.session_state.get("ai_ビジネス課題", ""),
+        "調査目的": st.session_state.get("ai_調査目的", ""),
+        "問い": st.session_state.get("ai_問い", ""),
+        "仮説": st.session_state.get("ai_仮説", ""),
+    }
+    subquestions = st.session_state.get("ai_subquestions", "")
+    target_condition = st.session_state.get("ai_target_condition", "")
+
+    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
+    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
+
+    prompt = f"""
+    あなたは市場調査設計の専門家です。
+    以下の情報をもとに、この調査で実施すべき調査項目案を提案してください。
+
+    【出力条件】
+    - 選択肢は不要（設問文のみ）
+    - 設問文は質問文形式でなく、調査項目名として簡潔に表現する
+      例：過去3年以内にキッザニアを訪れた経験はありますか？の場合、「キッザニア訪問経験」など
+    - 調査項目を「ちょうど40件」、調査票として実務的な順序（スクリーニング→本調査→属性）で並べる
+    - 各項目に優先度 p を付ける（1〜4の整数、各10件ずつ）
+      1：10問の調査でも必ず聞くべき項目 ／ 2：20問なら追加 ／ 3：30問なら追加 ／ 4：40問なら追加
+    - 各項目に、主に対応するサブクエスチョンのID（例："SQ1"）を s として付ける（該当がなければ空文字）
+    - 各項目名 i は簡潔に（目安：全角15文字以内）
+
+    【出力形式】
+    - 必ず JSON 配列のみを1行1項目で出力してください（余計な文章・空白・コードブロックは書かないこと）
+    [
+    {{"i":"・・・","p":1,"s":"SQ1"}},
+    {{"i":"・・・","p":3,"s":""}}
+    ]
+
+    【オリエン内容の整理（抜粋）】
+    {orien_outline_text[:2000]}
+
+    【ブランド診断：カテゴリー構造】
+    {cat_text}
+
+    【ブランド診断：消費行動特性】
+    {beh_text}
+
+    【キックオフノート】
+    {kickoff}
+
+    【問いの要因分解】
+    {subquestions}
+
+    【対象者条件】
+    {target_condition}
+
+   """
+
+    messages = [
+        {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+        {"role": "user", "content": prompt},
+    ]
+
+    def _work(control, messages=messages):
+        response = call_llm(
+            "調査項目案",
+            messages=messages,
+            temperature=0.6,
+            max_tokens=SURVEY_MASTER_MAX_TOKENS,  # 40項目のマスターリスト1本ぶん
+            control=control,
+        )
+        ai_text = response["content"].strip()
+
+        # ---- マスターリストを解釈し、10/20/30/40問バージョンを手元で作る ----
+        try:
+            master = parse_survey_master(ai_text)
+        except Exception:
+            master = []
+        record_parse_outcome(response, len(master) >= SURVEY_ITEM_VERSIONS[-1])
+        if not master:
+            raise LLMOutputError(
+                "AI出力を調査項目のJSON配列として解釈できませんでした。出力内容を確認してください。", ai_text
+            )
+        return {"raw": ai_text, "master": master, "versions": derive_survey_versions(master)}
+
+    def _apply(result):
+        # デバッグ用に生テキストも一応保存しておくと便利
+        st.session_state["ai_survey_items_raw"] = result["raw"]
+        st.session_state["ai_survey_items_master"] = result["master"]
+        st.session_state["ai_survey_items"] = result["versions"]
+        # 以前の編集内容をクリアして新しいバージョンを表示する
+        for n in SURVEY_ITEM_VERSIONS:
+            st.session_state.pop(f"survey_items_{n}問", None)
+        return "調査項目案を生成しました！中央ペインに反映されます。"
+
+    return {
+        "label": "調査項目案",
+        "work": _work,
+        "on_done": _apply,
+        "input_key": llm_input_key(prompt),
+        "est_tokens": estimate_tokens(prompt) + SURVEY_MASTER_MAX_TOKENS,
+        "forecast": forecast_llm_calls("調査項目案", [messages], SURVEY_MASTER_MAX_TOKENS),
+    }
+
+
+def build_spec_job() -> dict:
+    """
+    『調査仕様案』の下書きジョブを組み立てる（右ペインのボタン用）。
+    戻り値は build_kickoff_job と同じ形式。
+    """
+    # 入力ソースを取得
+    orien_outline_text = st.session_state.get("orien_outline_text", "")
+    target_condition = st.session_state.get("ai_target_condition", "")
+    survey_items_selected = st.session_state.get("edited_texts", {}).get("EDIT1", "")
+
+    if not orien_outline_text.strip():
+        return {"warning": "先に『オリエン内容の整理』で下書きを作成してください。"}
+
+    cat_df = st.session_state.get("df_category_structure")
+    beh_df = st.session_state.get("df_behavior_traits")
+
+    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
+    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
+
+    # オリエンで指定された仕様の要望は構造化した値をそのまま使う
+    spec_requests = get_orien_record()["spec_requests"]
+    spec_requests_text = format_orien_requests(spec_requests) or "（指定なし）"
+
+    # JSON形式で返すように指示してパースしやすくする
+    prompt = f"""
+    あなたは市場調査設計の専門家です。
+    以下の情報をもとに、この調査の「調査仕様案」を項目ごとに整理してください。
+
+    【入力情報】
+    ▼オリエン内容の整理
+    {orien_outline_text[:2000]}
+
+    ▼オリエンで指定された調査仕様の要望（記載がある項目はこの内容を優先すること）
+    {spec_requests_text}
+
+    ▼対象者条件
+    {target_condition}
+
+    ▼調査項目案（採用版：PPT EDIT1に反映した内容）
+    {survey_items_selected}
+
+    ▼参考情報：カテゴリー構造
+    {cat_text}
+
+    ▼参考情報：消費行動特性
+    {beh_text}
+
+    【出力する項目】
+    - 調査手法
+    - 抽出方法
+    - 調査地域
+    - 対象者条件
+    - サンプルサイズ
+    - 調査ボリューム
+    - 提示物
+    - 集計・分析仕様
+    - 自由回答データの処理
+    - 業務範囲
+    - 納品物
+    - インスペクションの方法
+    - 謝礼の種類
+    - 備考
+
+    【出力形式】
+    次のキーを持つ JSON オブジェクト「だけ」を出力してください。
+    余計な説明文やコードブロック（```）は出力しないでください。
+
+    {{
+      "調査手法": "...",
+      "抽出方法": "...",
+      "調査地域": "...",
+      "対象者条件": "...",
+      "サンプルサイズ": "...",
+      "調査ボリューム": "...",
+      "提示物": "...",
+      "集計・分析仕様": "...",
+      "自由回答データの処理": "...",
+      "業務範囲": "...",
+      "納品物": "...",
+      "インスペクションの方法": "...",
+      "謝礼の種類": "...",
+      "備考": "..."
+    }}
+
+    - 調査手法は特に明記がなければ「インターネット調査」を基本としてください。
+      対象者条件の検討の中で、属性以外の条件がある場合は（スクリーニングあり）と付記してください。
+    - 抽出方法は特に明記がなければ「割付抽出」としてください。
+    - 対象者条件は、前述の対象者条件案を参考に、調査仕様として適切な形式に整えてください。
+    - 調査ボリュームはスクリーニング調査と本調査を2行に分けて記載してください。
+      本調査のボリュームは、調査項目案の選択結果を記載してください。
+    - 自由回答データの処理は、オリエン内容のテキストに記載がなければ「なし」を基本としてください。
+    - インスペクションの方法は、オリエン内容のテキストに記載がなければ「性別・年齢（2歳以上）のアンマッチの場合は、対象除外とする。」を基本としてください。
+    - 謝礼の種類は、オリエン内容のテキストに記載がなければ「ポイント謝礼」を基本としてください。
+    """
+
+    messages = [
+        {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+        {"role": "user", "content": prompt},
+    ]
+
+    def _work(control, messages=messages):
+        response = call_llm(
+            "調査仕様案",
+            messages=messages,
+            temperature=0.5,
+            max_tokens=1000,
+            control=control,
+        )
+
+        ai_text = response["content"].strip()
 
-from pptx.enum.text import PP_ALIGN
-from pptx.dml.color import RGBColor
-from pptx.util import Pt
+        # 念のため ```json ... ``` で返ってきた場合も対応
+        if ai_text.startswith("```"):
+            ai_text = ai_text.strip("`")
+            ai_text = ai_text.replace("json", "", 1).strip()
 
-def apply_text_format(shape, font_name="Arial", font_size=12, color=RGBColor(0, 0, 0)):
+        try:
+            spec_obj = json.loads(ai_text)
+        except Exception:
+            record_parse_outcome(response, False)
+            raise LLMOutputError(
+                "AI出力をJSONとして解釈できませんでした。出力内容を確認してください。", ai_text
+            )
+        record_parse_outcome(response, True)
+        return spec_obj
+
+    def _apply(spec_obj, spec_requests=spec_requests):
+        # SPEC_ITEMS に従って session_state に保存
+        for label, key in SPEC_ITEMS:
+            st.session_state[key] = spec_obj.get(label, "")
+        # オリエンで指定されている項目は指定どおりの値にそろえる
+        for label, key in SPEC_ITEMS:
+            if spec_requests.get(SPEC_FROM_ORIEN.get(label, "")):
+                st.session_state[key] = spec_requests[SPEC_FROM_ORIEN[label]]
+        return "調査仕様の下書きを作成しました。中央ペインに表示します。"
+
+    return {
+        "label": "調査仕様の下書き",
+        "work": _work,
+        "on_done": _apply,
+        "messages": messages,
+        "input_key": llm_input_key(prompt),
+        "est_tokens": estimate_tokens(prompt) + 1000,
+        "forecast": forecast_llm_calls("調査仕様案", [messages], 1000),
+    }
+
+
+# =========================
+# 次の工程の先読み生成（オプトイン）
+# =========================
+# 先読みに使えるトークン数の上限（セッションごと・推定値）
+LLM_PREFETCH_TOKEN_BUDGET = int(os.getenv("LLM_PREFETCH_TOKEN_BUDGET", "20000"))
+# 入力が変わってから先読みを始めるまでの待ち時間（秒）。入力中の再実行ごとに投げ直さないため
+LLM_PREFETCH_DEBOUNCE_S = float(os.getenv("LLM_PREFETCH_DEBOUNCE_S", "5"))
+
+
+def _prefetch_targets():
     """
-    shape.text_frame の paragraph/run に書式を統一的に適用する
+    先読みの対象：(モード名, ジョブを組み立てる関数, 先読みを始めてよいか, 入力の session_state キー, 前の工程のモード名)
+    前の工程が確定していて（生成中でない）、この工程の下書きがまだない場合だけ先読みする。
     """
-    if not shape.has_text_frame:
-        return
+    return [
+        (
+            "問いの分解",
+            lambda: build_subquestion_job(1),
+            lambda: not st.session_state.get("subq_list") and not find_running_job("キックオフノート"),
+            ("ai_問い", "uploaded_docs", "orien_outline_text", "df_category_structure", "df_behavior_traits"),
+            "キックオフノート",
+        ),
+        (
+            "分析アプローチ",
+            lambda: build_analysis_job(st.session_state.get("analysis_fanout", True)),
+            lambda: not st.session_state.get("analysis_blocks") and not find_running_job("問いの分解"),
+            (
+                "subq_list", "analysis_fanout", "orien_outline_text", "df_category_structure", "df_behavior_traits",
+                "ai_目標", "ai_現状", "ai_ビジネス課題", "ai_調査目的", "ai_問い", "ai_仮説",
+            ),
+            "問いの分解",
+        ),
+    ]
 
-    text_frame = shape.text_frame
-    for paragraph in text_frame.paragraphs:
-        paragraph.alignment = PP_ALIGN.LEFT  # 左寄せ
-        for run in paragraph.runs:
-            run.font.name = font_name
-            run.font.size = Pt(font_size)
-            run.font.color.rgb = color
 
-import re
+def _prefetch_fingerprint(keys) -> str:
+    """先読みの入力の指紋（プロンプトを組み立てずに、入力が変わったかだけを安く判定する）"""
+    h = hashlib.sha256()
+    for key in keys:
+        value = st.session_state.get(key)
+        if hasattr(value, "to_csv"):
+            value = value.to_csv(index=False)
+        h.update(f"{key}={value!r}\x00".encode("utf-8"))
+    return h.hexdigest()
 
-def parse_subquestions(ai_text: str):
+
+def run_speculative_prefetch():
     """
-    『問いの分解』モードのAI出力をパースして、
-    [
-      {"subq": "...", "axis": "...", "metric": "..."},
-      ...
-    ]
-    のリストに変換する
+    次の工程の下書きをバックグラウンドで先に生成しておく（結果は入力のハッシュごとに保持し、まだ反映しない）。
+    ユーザーが同じ入力で『下書きを作成』を押すと submit_llm_job がこの結果を引き継ぐ。
+    ジョブは入力の指紋が変わったときだけ組み立て直し、前の工程の生成が完了した直後か、
+    入力が LLM_PREFETCH_DEBOUNCE_S 秒変わらなかったあとの再実行で始める（入力中の再実行では投げない）。
     """
-    if not ai_text:
-        return []
+    finalized = st.session_state.setdefault("prefetch_finalized", set())
+    if not st.session_state.get("prefetch_enabled"):
+        finalized.clear()
+        return
 
-    # 「- サブクエスチョン...」でブロックごとに分割
-    blocks = re.split(r"\n(?=-\s*サブクエスチョン)", ai_text.strip())
-    results = []
+    prefetch = st.session_state.setdefault("llm_prefetch", {})
+    inputs = st.session_state.setdefault("prefetch_inputs", {})
+    now = time.time()
+    for mode_name, build, ready, keys, upstream in _prefetch_targets():
+        if not ready() or find_running_job(mode_name):
+            continue
+        fingerprint = _prefetch_fingerprint(keys)
+        seen = inputs.get(mode_name)
+        if seen is None or seen["fingerprint"] != fingerprint:
+            seen = inputs[mode_name] = {"fingerprint": fingerprint, "since": now, "done": False}
+        if seen["done"]:
+            continue
+        if upstream not in finalized and now - seen["since"] < LLM_PREFETCH_DEBOUNCE_S:
+            continue
+        seen["done"] = True
 
-    for blk in blocks:
-        # サブクエスチョン本体
-        m_q = re.search(r"-\s*サブクエスチョン[0-9０-９]*[:：]\s*(.+)", blk)
-        if not m_q:
+        job = build()
+        if "warning" in job:
+            continue
+        slot = f"{mode_name}:{job['input_key']}"
+        if slot in prefetch:
             continue
 
-        # 分析軸
-        m_axis = re.search(r"分析軸[:：]\s*(.+)", blk)
-        # 評価項目
-        m_metric = re.search(r"評価項目[:：]\s*(.+)", blk)
+        # 入力が変わって使われなくなった同じモードの先読みは止める
+        for old_slot in [k for k in prefetch if k.startswith(f"{mode_name}:")]:
+            prefetch.pop(old_slot)["control"].cancel()
 
-        results.append(
-            {
-                "subq": m_q.group(1).strip(),
-                "axis": m_axis.group(1).strip() if m_axis else "",
-                "metric": m_metric.group(1).strip() if m_metric else "",
-            }
-        )
+        used = st.session_state.get("prefetch_tokens_used", 0)
+        if used + job["est_tokens"] > LLM_PREFETCH_TOKEN_BUDGET:
+            continue
+        st.session_state["prefetch_tokens_used"] = used + job["est_tokens"]
 
-    return results
+        control = JobControl(allow_reuse=semantic_cache_enabled(), owner=get_session_dir().name)
+        prefetch[slot] = {
+            "control": control,
+            "future": _job_executor().submit(job["work"], control),
+            "started_at": time.time(),
+        }
+    # 完了の合図は、完了を取り込んだ直後の再実行でだけ使う
+    finalized.clear()
 
 
+# =========================
+# ブランド診断結果の共有キャッシュ（全セッション共通・ディスクにも保存）
+# =========================
+import unicodedata
+from concurrent.futures import Future
 
-from pptx.util import Pt
-from pptx.dml.color import RGBColor
-from pptx.enum.text import PP_ALIGN
+BRAND_CACHE_DIR = Path(os.getenv("BRAND_CACHE_DIR", "/home/streamlit_workspace/_brand_cache"))
+# 有効期限（秒）。既定は7日。0 でキャッシュを使わない
+BRAND_CACHE_TTL_S = float(os.getenv("BRAND_CACHE_TTL_S", str(7 * 24 * 3600)))
+# プロンプトや保存形式を変えたら上げる（古いキャッシュを読まないように）
+BRAND_CACHE_VERSION = 1
 
-def apply_text_style(shape):
+
+@st.cache_resource(show_spinner=False)
+def _brand_cache():
     """
-    指定した図形内テキストの書式を統一するヘルパー
-    - フォント：Arial
-    - サイズ：12pt
-    - 色：黒
-    - 配置：左揃え
+    メモリ上のキャッシュと、実行中の検索（同じキーの依頼を1回の呼び出しにまとめる）。
+    Streamlit の再実行・別セッションをまたいで共有する。
     """
-    if not getattr(shape, "has_text_frame", False):
-        return
+    return {"lock": threading.Lock(), "entries": {}, "inflight": {}}
+
 
+def _normalize_brand_term(text: str) -> str:
+    # 全角・半角、大文字・小文字、空白の違いは同じものとして扱う
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def brand_cache_key(category: str, brand: str) -> str:
+    return llm_input_key(BRAND_CACHE_VERSION, _normalize_brand_term(category), _normalize_brand_term(brand))
+
+
+def _brand_cache_path(key: str) -> Path:
+    return BRAND_CACHE_DIR / f"{key}.json"
+
+
+def _brand_cache_lookup(key: str):
+    """有効期限内のエントリを返す（メモリ → ディスクの順）。ロックを取った状態で呼ぶこと"""
+    cache = _brand_cache()
+    entry = cache["entries"].get(key)
+    if entry is None:
+        path = _brand_cache_path(key)
+        if path.exists():
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+                cache["entries"][key] = entry
+            except Exception:
+                entry = None
+    if entry is None:
+        return None
+    if time.time() - entry.get("saved_at", 0) > BRAND_CACHE_TTL_S:
+        cache["entries"].pop(key, None)
+        return None
+    return entry
+
+
+def _brand_cache_store(key: str, value: dict) -> dict:
+    entry = {"saved_at": time.time(), "value": value}
+    cache = _brand_cache()
+    with cache["lock"]:
+        cache["entries"][key] = entry
     try:
-        for paragraph in shape.text_frame.paragraphs:
-            paragraph.alignment = PP_ALIGN.LEFT
-            for run in paragraph.runs:
-                if run.font is None:
-                    continue
-                run.font.name = "Arial"
-                run.font.size = Pt(12)
-                run.font.color.rgb = RGBColor(0, 0, 0)
+        BRAND_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = _brand_cache_path(key)
+        tmp = path.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        tmp.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
     except Exception:
-        # 万一フォーマット構造が想定外でも、ここでは落とさない
+        # ディスクに書けなくてもメモリ上のキャッシュは使える
         pass
+    return entry
+
+
+def brand_cache_fetch(category: str, brand: str, fetch, control=None, is_valid=None, force: bool = False):
+    """
+    (カテゴリー, ブランド) の診断結果を共有キャッシュから返し、なければ fetch(control) で取得して保存する。
+    戻り値は (value, source, saved_at)。source は "cache"（保存済み）/ "shared"（他セッションの実行中の検索に相乗り）/ "fresh"。
+    - 同じキーの検索が実行中なら、新しく呼ばずにその完了を待つ
+    - is_valid(value) が False の結果（表を読み取れなかった等）は保存しない
+    - force=True なら保存済みの結果を使わずに検索する（実行中の検索への相乗りはする）。
+      保存済みのエントリは、新しい結果が得られたときにだけ上書きする（他のセッションからは消さない）
+    """
+    key = brand_cache_key(category, brand)
+    cache = _brand_cache()
+    while True:
+        with cache["lock"]:
+            entry = _brand_cache_lookup(key) if BRAND_CACHE_TTL_S > 0 and not force else None
+            if entry is not None:
+                return entry["value"], "cache", entry["saved_at"]
+            future = cache["inflight"].get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                cache["inflight"][key] = future
+
+        if owner:
+            break
+
+        # 他のセッションの検索を待つ（こちらのキャンセルには応じる）
+        while not future.done():
+            if control is not None:
+                control.raise_if_cancelled()
+            time.sleep(0.2)
+        error = future.exception()
+        if error is None:
+            return future.result(), "shared", time.time()
+        if isinstance(error, LLMCancelledError):
+            continue  # 相乗り先がキャンセルされたら、こちらが改めて検索する
+        raise error
+
+    try:
+        value = fetch(control)
+        saved_at = time.time()
+        if BRAND_CACHE_TTL_S > 0 and (is_valid is None or is_valid(value)):
+            saved_at = _brand_cache_store(key, value)["saved_at"]
+        future.set_result(value)
+        return value, "fresh", saved_at
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with cache["lock"]:
+            cache["inflight"].pop(key, None)
+
+
+# =========================
+# 完了したバックグラウンド生成ジョブの結果を取り込む
+# （どのモードを表示中でも、ウィジェット描画前に session_state へ反映する）
+# =========================
+harvest_llm_jobs()
+run_speculative_prefetch()
+
+# セッションの状態が消えていたら（プロセスの再起動後など）、テンプレートと反映履歴をディスクから読み込み直す
+if not st.session_state.get("pptx_path") and "template_restore_checked" not in st.session_state:
+    st.session_state["template_restore_checked"] = True
+    if restore_session_template():
+        st.session_state.setdefault("llm_job_notices", []).append(
+            ("info", "前回の作業内容（テンプレートと反映履歴）を読み込み直しました。", "")
+        )
 
 
 # =========================
@@ -711,17 +4609,85 @@ with left:
 
     # 初回アップロード時のみ pptx_path をセットする
     if uploaded_pptx and "template_loaded" not in st.session_state:
-        cache_dir = Path(tempfile.gettempdir()) / "pptx_cache"
-        cache_dir.mkdir(exist_ok=True)
-
-        target = cache_dir / uploaded_pptx.name
-        with open(target, "wb") as f:
-            f.write(uploaded_pptx.getbuffer())
+        # 同じ内容のテンプレートは全セッションで1ファイルを共有する（編集はメモリ上の作業中デッキで行う）
+        template_sha256, target = store_template(bytes(uploaded_pptx.getbuffer()))
+        acquire_template(template_sha256)
+        gc_template_store()
 
         st.session_state["pptx_path"] = str(target)
         st.session_state["template_loaded"] = True
+        discard_working_presentation()
+        reset_revision_log(template_sha256)
+
+        # 編集スロットを一度だけ洗い出し、各モードが必要とするスロットがそろっているか確認する
+        try:
+            manifest = compile_template(target, sha256=template_sha256)
+            st.session_state["template_manifest"] = manifest
+            st.session_state["template_problems"] = validate_template_manifest(manifest)
+        except Exception as e:
+            st.session_state["template_manifest"] = None
+            st.session_state["template_problems"] = {}
+            st.warning(f"テンプレートの編集スロットを読み取れませんでした（従来のスライド位置で反映します）: {e}")
         st.success(f"{uploaded_pptx.name} を読み込みました。")
 
+    if st.session_state.get("template_problems"):
+        with st.expander("⚠ テンプレートの編集スロットに不足があります", expanded=False):
+            for problem_mode, issues in st.session_state["template_problems"].items():
+                st.markdown(f"**{problem_mode}**：" + "、".join(issues))
+
+    # --- 反映履歴（元に戻す・やり直す・版を選んで戻す）---
+    history = revision_log()
+    if history["patches"]:
+        with st.expander(f"反映履歴（{history['head']} / {len(history['patches'])}）", expanded=False):
+            undo_col, redo_col = st.columns(2)
+            if undo_col.button("↶ 元に戻す", disabled=history["head"] == 0, use_container_width=True):
+                move_revision_head(history["head"] - 1)
+                st.rerun()
+            if redo_col.button("↷ やり直す", disabled=history["head"] == len(history["patches"]), use_container_width=True):
+                move_revision_head(history["head"] + 1)
+                st.rerun()
+
+            revision = st.selectbox(
+                "版を選ぶ",
+                list(range(len(history["patches"]) + 1)),
+                index=history["head"],
+                format_func=lambda r: "0：テンプレート" if r == 0
+                else f"{r}：{history['patches'][r - 1]['label']}（{history['patches'][r - 1]['slot']}）",
+            )
+            if revision != history["head"] and st.button("この版に戻す", use_container_width=True):
+                move_revision_head(revision)
+                st.rerun()
+
+    st.divider()
+    st.subheader("運用")
+
+    st.checkbox(
+        "次の工程を先読み生成する",
+        key="prefetch_enabled",
+        help="前の工程の生成が完了したとき、または入力が数秒変わらなかったときに、"
+        "次の工程（問いの分解・分析アプローチ）の下書きを裏で作っておきます。"
+        "同じ入力で『下書きを作成』を押すとすぐに表示されます。",
+    )
+    if st.session_state.get("prefetch_enabled"):
+        st.caption(
+            f"先読み：{st.session_state.get('prefetch_tokens_used', 0):,} / {LLM_PREFETCH_TOKEN_BUDGET:,} トークン"
+            f"・利用 {st.session_state.get('prefetch_hits', 0)} 回"
+        )
+
+    st.checkbox(
+        "類似の入力なら過去の下書きを再利用する",
+        key="semantic_cache_enabled",
+        value=LLM_SEMANTIC_CACHE,
+        help="資料名の違いや1文字の修正など、入力がほぼ同じ場合は過去の生成結果を使い、AI呼び出しを省きます。"
+        "再利用した下書きは右ペインに表示され、『新しく生成する』で作り直せます。",
+    )
+
+    if st.button("LLM診断", use_container_width=True):
+        st.session_state["selected_mode"] = "llm_diagnostics"
+        st.session_state["message_center"] = ""
+        st.session_state["message_right"] = ""
+        st.rerun()
+
 
 
 
@@ -824,59 +4790,60 @@ with center:
 
         pptx_path = st.session_state.get("pptx_path")
 
-        # 🧠 AIで顧客名・調査名を自動推測
+        # 🧠 AIで顧客名・調査名を自動推測（バックグラウンドで実行）
+        # 推測は資料1セットにつき1回まで：資料のハッシュで結果（成功／失敗）を覚えておき、
+        # 同じ資料では再実行のたびに呼び出さない
         ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
+        cover_key = doc_corpus_key(ori_texts)
+
+        # まずルール（社名の表記・調査名らしい見出し）で読み取り、見つかった項目はAIに聞かない
+        if ori_texts and st.session_state.get("cover_rules_key") != cover_key:
+            st.session_state["cover_rules_key"] = cover_key
+            rule_values = {
+                "client": (extract_company_names(ori_texts) or [""])[0],
+                "title": (extract_title_candidates(ori_texts) or [""])[0],
+            }
+            for field, ai_key, edit_key in [
+                ("client", "ai_client_name", "Edit_client"),
+                ("title", "ai_project_title", "Edit_title"),
+            ]:
+                if rule_values[field] and not st.session_state.get(ai_key):
+                    st.session_state[ai_key] = rule_values[field]
+                    if not st.session_state.get(edit_key):
+                        st.session_state[edit_key] = rule_values[field]
+
+        # ルールで埋まらなかった項目は、カテゴリー・ブランドと合わせて1回の呼び出しでAIに推測させる
+        # （同じ資料の抽出結果は共有キャッシュから即座に反映する）
+        cover_outcome = get_llm_job_outcome("資料の一括抽出", cover_key)
+        # 実行中のあいだは入らない（入ると再実行が連続し、プレビューが表示されなくなる）
         if ori_texts and (
             not st.session_state.get("ai_client_name")
             or not st.session_state.get("ai_project_title")
-        ):
-            with st.spinner("顧客名と調査名を推測中..."):
-                prompt = f"""
-    あなたは市場調査の専門家です。
-    以下のオリエン資料から、顧客企業名と調査タイトルを抽出・推定してください。
-
-    【出力形式】
-    顧客名：
-    調査名：
-
-    資料内容：
-    {ori_texts[:4000]}
-    """
-                try:
-                    response = client.chat.completions.create(
-                        model=DEPLOYMENT,
-                        messages=[
-                            {"role": "system", "content": "あなたは市場調査の専門家です。"},
-                            {"role": "user", "content": prompt},
-                        ],
-                        temperature=0.5,
-                        max_tokens=200,
-                    )
-                    ai_result = response.choices[0].message.content
-                    import re
-
-                    client_match = re.search(r"顧客名[:：]\s*(.*)", ai_result)
-                    title_match = re.search(r"調査名[:：]\s*(.*)", ai_result)
-
-                    st.session_state["ai_client_name"] = (
-                        client_match.group(1).strip() if client_match else ""
-                    )
-                    st.session_state["ai_project_title"] = (
-                        title_match.group(1).strip() if title_match else ""
-                    )
+        ) and cover_outcome is None and not find_running_job("資料の一括抽出"):
+            cached = cached_doc_extraction(cover_key)
+            if cached is not None:
+                apply_doc_extraction(cached)
+                # 取り出せなかった項目があっても、同じ資料では再実行のたびに呼び出さない
+                st.session_state.setdefault("llm_job_outcomes", {})[f"資料の一括抽出:{cover_key}"] = "ok"
+            else:
+                job = build_doc_extraction_job(ori_texts)
+                submit_llm_job("資料の一括抽出", job["label"], job["work"], job["on_done"], input_key=job["input_key"])
+            st.rerun()
 
-                    st.toast("顧客名・調査名を推測しました。", icon="🤖")
-                except Exception as e:
-                    st.error(f"AI呼び出しエラー: {e}")
+        if find_running_job("資料の一括抽出"):
+            st.caption("🤖 顧客名と調査名を推測中...（右ペインで進捗を確認できます）")
+        elif cover_outcome == "failed":
+            st.caption("⚠️ この資料からは顧客名・調査名を推測できませんでした。下の入力欄に直接入力してください。")
+            if st.button("もう一度推測する", key="cover_infer_retry"):
+                forget_llm_job_outcome("資料の一括抽出", cover_key)
+                st.rerun()
 
 
         # 🖼 PowerPointプレビュー表示
         if pptx_path:
-            from pptx import Presentation
-
             try:
-                prs = Presentation(pptx_path)
-                slide_index = 0
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("表紙")
 
                 if slide_index < len(prs.slides):
                     model = extract_slide_model(prs, slide_index=slide_index)
@@ -940,8 +4907,8 @@ with center:
             try:
                 from pathlib import Path
                 from datetime import datetime
-                prs = Presentation(st.session_state.pptx_path)
-                slide_index = 0
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("表紙")
                 if slide_index < len(prs.slides):
                     slide = prs.slides[slide_index]
                     mapping = {
@@ -951,17 +4918,9 @@ with center:
                     }
 
                     for shape_name, val in mapping.items():
-                        shape = next(
-                            (s for s in slide.shapes if s.name == shape_name), None
-                        )
-                        if shape:
-                            shape.text = val
+                        if apply_slot_text(prs, slide_index, shape_name, val, style="plain", label="表紙") is not None:
                             st.session_state.edited_texts[shape_name] = val
 
-                    SLIDES_DIR = get_session_dir()
-                    out_path = SLIDES_DIR / f"slide1_cover_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                    prs.save(out_path)
-                    st.session_state.pptx_path = out_path
                     st.success("スライド1（表紙）に反映しました！")
                     st.rerun()
                 else:
@@ -983,9 +4942,8 @@ with center:
         # 🖼 スライド2のPPTプレビュー
         # ===============================
         if pptx_path:
-            from pptx import Presentation
-            prs = Presentation(pptx_path)
-            slide_index = 1
+            prs = get_working_presentation()
+            slide_index = template_mode_slide("キックオフノート")
             if slide_index < len(prs.slides):
                 model = extract_slide_model(prs, slide_index=slide_index)
                 html = render_slide_html(model, st.session_state.edited_texts)
@@ -998,6 +4956,22 @@ with center:
 
         st.markdown("---")
 
+        # ===============================
+        # 🔀 複数案から選択（候補数を2以上にして生成した場合）
+        # ===============================
+        def _render_kickoff_candidate(sections):
+            for key, text in sections.items():
+                st.markdown(f"**{key}**")
+                st.caption(text or "（なし）")
+
+        def _pick_kickoff_candidate(sections):
+            for key, text in sections.items():
+                st.session_state[f"ai_{key}"] = text
+
+        render_candidate_picker(
+            "kickoff_candidates", "キックオフノートの候補", _render_kickoff_candidate, _pick_kickoff_candidate
+        )
+
         # ===============================
         # 🧾 AI出力 or 手入力フォーム
         # ===============================
@@ -1016,8 +4990,8 @@ with center:
         if st.button("📤 スライド2に反映（①〜⑥）", use_container_width=True):
             if pptx_path:
                 try:
-                    prs = Presentation(pptx_path)
-                    slide_index = 1
+                    prs = get_working_presentation()
+                    slide_index = template_mode_slide("キックオフノート")
                     if slide_index < len(prs.slides):
                         slide = prs.slides[slide_index]
 
@@ -1031,19 +5005,10 @@ with center:
                         }
 
                         for name, text in mapping.items():
-                            shp = next((s for s in slide.shapes if s.name == name), None)
-                            if shp:
-                                shp.text = text
-                                apply_text_format(shp)  # ← ← 書式統一を適用！
+                            # 書式統一（apply_text_format）も合わせて適用
+                            if apply_slot_text(prs, slide_index, name, text, label="キックオフノート") is not None:
                                 st.session_state.edited_texts[name] = text
 
-                        # 保存（別名保存でキャッシュ衝突回避）
-                        from datetime import datetime
-                        SLIDES_DIR = get_session_dir()
-                        out_path = SLIDES_DIR / f"kickoff_slide2_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                        prs.save(out_path)
-                        st.session_state["pptx_path"] = str(out_path)
-
                         st.success("スライド2（キックオフノート）に反映しました！")
                         st.rerun()
                     else:
@@ -1068,8 +5033,8 @@ with center:
             try:
                 from pptx import Presentation
 
-                prs = Presentation(pptx_path)
-                slide_index = 2  # スライド3（0始まり）
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("問いの分解")
 
                 if slide_index < len(prs.slides):
                     model = extract_slide_model(prs, slide_index=slide_index)
@@ -1085,6 +5050,23 @@ with center:
 
         st.markdown("---")
 
+        # =========================================
+        # 🔀 複数案から選択（候補数を2以上にして生成した場合）
+        # =========================================
+        def _render_subq_candidate(candidate):
+            for i, sq in enumerate(candidate["subq_list"], 1):
+                st.caption(f"SQ{i}: {sq.get('subq', '')}")
+            if not candidate["subq_list"]:
+                st.caption(candidate["ai_text"])
+
+        def _pick_subq_candidate(candidate):
+            st.session_state["ai_subquestions"] = candidate["ai_text"]
+            st.session_state["subq_list"] = candidate["subq_list"]
+
+        render_candidate_picker(
+            "subq_candidates", "サブクエスチョンの候補", _render_subq_candidate, _pick_subq_candidate
+        )
+
         # =========================================
         # ① 構造ビュー：目的 → メインクエスチョン → サブクエスチョン
         # =========================================
@@ -1196,8 +5178,9 @@ with center:
 
             st.code("\n".join(tree_lines), language="text")
 
-        # 構造ビューのテキスト（PPT反映用）
+        # 構造ビューのテキスト（PPT反映用。一括出力でも使う）
         tree_text = "\n".join(tree_lines) if tree_lines else ""
+        st.session_state["subq_tree_text"] = tree_text
 
         st.markdown("---")
 
@@ -1211,12 +5194,11 @@ with center:
                 st.warning("構造ビューの内容が空です。先に『問い』やサブクエスチョンを設定してください。")
             elif pptx_path:
                 try:
-                    from pptx import Presentation
                     from pathlib import Path
                     from datetime import datetime
 
-                    prs = Presentation(pptx_path)
-                    slide_index = 2  # スライド3（0始まり）
+                    prs = get_working_presentation()
+                    slide_index = template_mode_slide("問いの分解")
 
                     if slide_index < len(prs.slides):
                         slide = prs.slides[slide_index]
@@ -1224,28 +5206,15 @@ with center:
                         # 構造ビューのテキストをそのまま反映
                         text_to_apply = tree_text
 
-                        shp = next((s for s in slide.shapes if s.name == "EDIT1_subQ"), None)
+                        shp = find_named_shape(prs, slide_index, "EDIT1_subQ")
                         if shp and getattr(shp, "has_text_frame", False):
-                            shp.text = text_to_apply
-
                             # 共通フォーマット適用（黒・12pt・左寄せ・Arial）
-                            try:
-                                apply_text_style(shp)
-                            except Exception:
-                                # ヘルパー側でエラーになってもアプリが落ちないように
-                                pass
+                            apply_slot_text(prs, slide_index, "EDIT1_subQ", text_to_apply, style="style", label="問いの分解")
 
                             # プレビュー用キャッシュ
                             st.session_state.edited_texts["EDIT1_subQ"] = text_to_apply
                             st.session_state.edited_texts["EDIT1_QUESTION_FACTORS"] = text_to_apply
 
-                            # 保存（別名保存でキャッシュ衝突回避）
-                            SLIDES_DIR = get_session_dir()
-                            SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-                            out_path = SLIDES_DIR / f"question_factors_slide3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                            prs.save(out_path)
-                            st.session_state["pptx_path"] = str(out_path)
-
                             st.success("スライド3（問いの分解）に構造ビューの内容を反映しました！（EDIT1_subQ・書式統一）")
                             st.rerun()
                         else:
@@ -1275,7 +5244,7 @@ with center:
             try:
                 from pptx import Presentation
 
-                prs = Presentation(pptx_path)
+                prs = get_working_presentation()
                 edited_texts = st.session_state.get("edited_texts", {})
 
                 # SQ1〜SQ9としてタブ表示（スライド4〜12）
@@ -1284,7 +5253,7 @@ with center:
                 tabs = st.tabs(tab_labels)
 
                 for idx, tab in enumerate(tabs):
-                    slide_index = 3 + idx  # 0始まり → 3=スライド4
+                    slide_index = template_slot_slide(f"EDIT1_subQ{idx + 1}_1", 3 + idx)
                     with tab:
                         if slide_index < len(prs.slides):
                             model = extract_slide_model(prs, slide_index=slide_index)
@@ -1422,11 +5391,10 @@ with center:
                     st.warning("PPTテンプレートを先にアップロードしてください。")
                 else:
                     try:
-                        from pptx import Presentation
                         from pathlib import Path
                         from datetime import datetime
 
-                        prs = Presentation(pptx_path)
+                        prs = get_working_presentation()
 
                         max_slides = 9  # スライド4〜12 → 最大9サブクエスチョン
                         total_blocks = len(analysis_blocks)
@@ -1440,7 +5408,7 @@ with center:
                         applied_count = 0
 
                         for i in range(1, min(total_blocks, max_slides) + 1):
-                            slide_index = 3 + (i - 1)  # スライド4〜12 → index=3〜11
+                            slide_index = template_slot_slide(f"EDIT1_subQ{i}_1", 3 + (i - 1))
                             if slide_index >= len(prs.slides):
                                 st.warning(
                                     f"テンプレート内のスライド数が不足しているため、"
@@ -1468,13 +5436,9 @@ with center:
                                 if not text_val:
                                     continue
 
-                                ok = set_text_to_named_shape(slide, shape_name, text_val)
-
-                                if ok:
-                                    shp = next((s for s in slide.shapes if s.name == shape_name), None)
-                                    if shp and getattr(shp, "has_text_frame", False):
-                                        apply_text_format(shp)
+                                shp = apply_slot_text(prs, slide_index, shape_name, text_val, label=f"分析アプローチ SQ{i}")
 
+                                if shp is not None:
                                     # プレビュー用キャッシュも更新
                                     st.session_state.edited_texts[shape_name] = text_val
                                     applied_count += 1
@@ -1484,13 +5448,6 @@ with center:
                                     )
 
                         if applied_count > 0:
-                            SLIDES_DIR = get_session_dir()
-                            SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-                            out_path = SLIDES_DIR / f"analysis_approach_slide4to12_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                            prs.save(out_path)
-
-                            st.session_state["pptx_path"] = str(out_path)
-
                             st.success(
                                 f"スライド4〜12（分析アプローチ）にサブクエスチョン別・項目別の内容を反映しました！（{applied_count}箇所）"
                             )
@@ -1516,8 +5473,8 @@ with center:
             try:
                 from pptx import Presentation
 
-                prs = Presentation(pptx_path)
-                slide_index = 12  # スライド4（0始まり）
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("対象者条件を検討")
 
                 if slide_index < len(prs.slides):
                     # ★ 問いの要因分解と同じ：extract → render
@@ -1551,12 +5508,11 @@ with center:
 
                 if pptx_path:
                     try:
-                        from pptx import Presentation
                         from pathlib import Path
                         from datetime import datetime
 
-                        prs = Presentation(pptx_path)
-                        slide_index = 12  # スライド4（0始まり）
+                        prs = get_working_presentation()
+                        slide_index = template_mode_slide("対象者条件を検討")
 
                         if slide_index < len(prs.slides):
                             slide = prs.slides[slide_index]
@@ -1568,27 +5524,16 @@ with center:
                             )
 
                             # EDIT1_taisyosya を探す
-                            shp = next((s for s in slide.shapes if s.name == "EDIT1_taisyosya"), None)
+                            shp = find_named_shape(prs, slide_index, "EDIT1_taisyosya")
                             if shp and getattr(shp, "has_text_frame", False):
 
-                                # ★ テキストを反映
-                                shp.text = text_to_apply
-
-                                # ★ 統一書式を適用（Arial / 12pt / 左寄せ / 黒）
-                                apply_text_format(shp)
+                                # ★ テキストを反映し、統一書式を適用（Arial / 12pt / 左寄せ / 黒）
+                                apply_slot_text(prs, slide_index, "EDIT1_taisyosya", text_to_apply, label="対象者条件")
 
                                 # プレビュー用キャッシュ
                                 st.session_state.edited_texts["EDIT1_taisyosya"] = text_to_apply
                                 st.session_state.edited_texts["EDIT1_TARGET_CONDITION"] = text_to_apply
 
-                                # 保存（別名保存）
-                                SLIDES_DIR = get_session_dir()
-                                SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-                                out_path = SLIDES_DIR / f"target_condition_slide4_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-
-                                prs.save(out_path)
-                                st.session_state["pptx_path"] = str(out_path)
-
                                 st.success("スライド4（対象者条件）に反映しました！（フォント・色・左寄せを統一）")
                                 st.rerun()
 
@@ -1621,8 +5566,8 @@ with center:
             try:
                 from pptx import Presentation
 
-                prs = Presentation(pptx_path)
-                slide_index = 13  # スライド13（0始まり）
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("調査項目案")
 
                 if slide_index < len(prs.slides):
                     model = extract_slide_model(prs, slide_index=slide_index)
@@ -1644,6 +5589,23 @@ with center:
 
             items = st.session_state["ai_survey_items"]
 
+            master = st.session_state.get("ai_survey_items_master")
+            if master:
+                with st.expander("📋 マスターリスト（優先度・対応SQ）", expanded=False):
+                    import pandas as pd
+
+                    st.dataframe(
+                        pd.DataFrame(
+                            [
+                                {"No": i, "調査項目": m["item"], "優先度": m["priority"], "対応SQ": m["sq"]}
+                                for i, m in enumerate(master, 1)
+                            ]
+                        ),
+                        use_container_width=True,
+                        hide_index=True,
+                    )
+                    st.caption("優先度1＝10問、〜2＝20問、〜3＝30問、〜4＝40問バージョンに含まれます。")
+
             for ver in ["10問", "20問", "30問", "40問"]:
                 text_key = f"survey_items_{ver}"
                 default_val = items.get(ver, "")
@@ -1668,12 +5630,11 @@ with center:
                         pptx_path = st.session_state.get("pptx_path")
                         if pptx_path:
                             try:
-                                from pptx import Presentation
                                 from pathlib import Path
                                 from datetime import datetime
 
-                                prs = Presentation(pptx_path)
-                                slide_index = 13  # スライド13（0始まり）
+                                prs = get_working_presentation()
+                                slide_index = template_mode_slide("調査項目案")
 
                                 if slide_index < len(prs.slides):
                                     slide = prs.slides[slide_index]
@@ -1682,27 +5643,16 @@ with center:
                                     text_to_apply = st.session_state.get(text_key, default_val)
 
                                     # EDIT1_Qimg を直接探して text を代入
-                                    shp = next((s for s in slide.shapes if s.name == "EDIT1_Qimg"), None)
+                                    shp = find_named_shape(prs, slide_index, "EDIT1_Qimg")
                                     if shp and getattr(shp, "has_text_frame", False):
 
-                                        # ★ テキストを反映
-                                        shp.text = text_to_apply
-
-                                        # ★ 統一書式を適用（Arial / 12pt / 黒 / 左寄せ）
-                                        apply_text_format(shp)
+                                        # ★ テキストを反映し、統一書式を適用（Arial / 12pt / 黒 / 左寄せ）
+                                        apply_slot_text(prs, slide_index, "EDIT1_Qimg", text_to_apply, label=f"調査項目案（{ver}）")
 
                                         # プレビュー用にも保存
                                         st.session_state.edited_texts["EDIT1_Qimg"] = text_to_apply
                                         st.session_state.edited_texts["EDIT1_SURVEY_ITEMS"] = text_to_apply
 
-                                        # 保存（別名保存でキャッシュ衝突回避）
-                                        SLIDES_DIR = get_session_dir()
-                                        SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-
-                                        out_path = SLIDES_DIR / f"surveyitems_slide5_{ver}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                                        prs.save(out_path)
-                                        st.session_state["pptx_path"] = str(out_path)
-
                                         st.success(
                                             f"スライド5（調査項目案）に {ver} バージョンを反映しました！（フォント・サイズ・色を統一）"
                                         )
@@ -1733,8 +5683,8 @@ with center:
             try:
                 from pptx import Presentation
 
-                prs = Presentation(pptx_path)
-                slide_index = 14  # スライド14（0始まり）
+                prs = get_working_presentation()
+                slide_index = template_mode_slide("調査仕様案")
 
                 if slide_index < len(prs.slides):
                     model = extract_slide_model(prs, slide_index=slide_index)
@@ -1775,12 +5725,11 @@ with center:
                     st.warning("PPTテンプレートを先にアップロードしてください。")
                 else:
                     try:
-                        from pptx import Presentation
                         from pathlib import Path
                         from datetime import datetime
 
-                        prs = Presentation(pptx_path)
-                        slide_index = 14  # スライド14（0始まり）
+                        prs = get_working_presentation()
+                        slide_index = template_mode_slide("調査仕様案")
 
                         if slide_index < len(prs.slides):
                             slide = prs.slides[slide_index]
@@ -1794,18 +5743,10 @@ with center:
 
                                 if shape_name and text_val is not None:
 
-                                    # shape へ書き込む（set_text_to_named_shape: グループ対応）
-                                    ok = set_text_to_named_shape(slide, shape_name, text_val)
-
-                                    if ok:
-                                        # shape を再取得して書式を適用
-                                        shp = next((s for s in slide.shapes if s.name == shape_name), None)
-
-                                        if shp and getattr(shp, "has_text_frame", False):
-
-                                            # ★ 統一書式を適用（Arial / 12pt / 黒 / 左寄せ）
-                                            apply_text_format(shp)
+                                    # shape へ書き込み、統一書式を適用（Arial / 12pt / 黒 / 左寄せ）
+                                    shp = apply_slot_text(prs, slide_index, shape_name, text_val, label="調査仕様案")
 
+                                    if shp is not None:
                                         # プレビュー用キャッシュ
                                         st.session_state.edited_texts[shape_name] = text_val
 
@@ -1815,16 +5756,6 @@ with center:
                                 for label, key in SPEC_ITEMS
                             }
 
-                            # ==========================
-                            # 保存（別名保存）
-                            # ==========================
-                            SLIDES_DIR = get_session_dir()
-                            SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-
-                            out_path = SLIDES_DIR / f"spec_slide6_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-                            prs.save(out_path)
-
-                            st.session_state["pptx_path"] = str(out_path)
                             st.success("スライド6（調査仕様案）に調査仕様を反映しました！（フォント・色・左寄せを統一）")
                             st.rerun()
 
@@ -1847,7 +5778,7 @@ with center:
         if pptx_path:
             try:
                 # 他モードと同じ方式：PPTX → 画像化して表示
-                images = pptx_to_images(pptx_path)
+                images = pptx_to_images(get_working_presentation())
                 if len(images) > 15:  # スライド14は 0始まりで index=14
                     st.image(images[15], caption="スライド14：スケジュール案", use_container_width=True)
                 else:
@@ -1862,7 +5793,6 @@ with center:
         st.caption("『オリエン内容の整理』から抽出したマイルストンを起点に、工程ごとの日程を設定します。")
 
         # ====== ここからスケジュール計算ロジック ======
-        from pptx import Presentation  # 重複インポートOK
         from pptx.util import Inches, Pt
         from pptx.dml.color import RGBColor
         from pptx.enum.text import PP_ALIGN
@@ -1870,7 +5800,6 @@ with center:
         from datetime import datetime
         import pandas as pd
         import pytz
-        from io import BytesIO
         from pathlib import Path
 
         JST = pytz.timezone("Asia/Tokyo")
@@ -2011,155 +5940,31 @@ with center:
                 for p in cell.text_frame.paragraphs:
                     p.font.bold = True
                     p.font.size = Pt(11)
-                    p.alignment = PP_ALIGN.CENTER
-
-            for i in range(df.shape[0]):
-                for j, col in enumerate(headers):
-                    val = df.at[i, col]
-                    cell = table.cell(i + 1, j)
-                    cell.text = str(val) if val else ""
-                    for p in cell.text_frame.paragraphs:
-                        p.font.size = Pt(11)
-                    if df.at[i, "非営業日"]:
-                        cell.fill.solid()
-                        cell.fill.fore_color.rgb = RGBColor(220, 220, 220)
-                    else:
-                        cell.fill.solid()
-                        cell.fill.fore_color.rgb = RGBColor(255, 255, 255)
-
-            bio = BytesIO()
-            prs.save(bio)
-            bio.seek(0)
-            return bio.read()
-
-        # ------------------------------------------------
-        # 🔑 スライド7にスケジュール表を反映する関数
-        # ------------------------------------------------
-        from pptx import Presentation
-        from pptx.util import Inches, Pt
-        from pptx.dml.color import RGBColor
-        from pptx.enum.text import PP_ALIGN
-        import pandas as pd
-        import math
-
-        def reflect_schedule_to_slide7(prs, calendar_df: pd.DataFrame):
-            """
-            スライド7にスケジュール表を3分割して挿入
-            - calendar_df: 「日付」「曜日」「マイルストン」「非営業日」を含む DataFrame を想定
-            - スライド上の Shape名 schedule1 / schedule2 / schedule3 の位置・サイズに表を配置
-            - 非営業日(True)の行は薄いグレーでハイライト
-            """
-            slide_index = 15  # スライド7（0始まり）
-            if slide_index >= len(prs.slides):
-                st.error("スライド7がテンプレートに存在しません。")
-                return prs
-
-            slide = prs.slides[slide_index]
-
-            # 既存の Table/Schedule（先に作った表など）を削除
-            for shp in list(slide.shapes):
-                name = getattr(shp, "name", "")
-                # ここは Table*, Schedule*（大文字）だけ消すので、schedule1〜3 は消さない
-                if name.startswith("Table") or name.startswith("Schedule"):
-                    try:
-                        slide.shapes._spTree.remove(shp._element)
-                    except Exception:
-                        pass
-
-            # === schedule1 / schedule2 / schedule3 のプレースホルダ図形を取得 ===
-            placeholders = {}
-            for shp in slide.shapes:
-                name = getattr(shp, "name", "")
-                if name in ["schedule1", "schedule2", "schedule3"]:
-                    placeholders[name] = shp
-
-            # 3つともなくても動くようにする（ある分だけ使う）
-            # DataFrameインデックスを整理
-            df = calendar_df.reset_index(drop=True)
-            total_rows = len(df)
-            if total_rows == 0:
-                return prs
-
-            # 3ブロックに分割
-            rows_per_block = math.ceil(total_rows / 3)
-
-            # ===== カラー設定 =====
-            header_fill_color   = RGBColor(230, 230, 230)  # ヘッダー：薄いグレー
-            body_fill_color     = RGBColor(255, 255, 255)  # 平日：白
-            holiday_fill_color  = RGBColor(240, 240, 240)  # 非営業日：さらに薄いグレー
-            text_color          = RGBColor(0, 0, 0)        # 黒
-            headers = ["日付", "曜日", "マイルストン"]
-
-            # 各ブロック（1〜3）を、それぞれ schedule1〜3 の位置に描画
-            for block_idx in range(3):
-                start_idx = block_idx * rows_per_block
-                end_idx = min(start_idx + rows_per_block, total_rows)
-                block_df = df.iloc[start_idx:end_idx]
-
-                if block_df.empty:
-                    continue
-
-                placeholder_name = f"schedule{block_idx + 1}"
-                ph = placeholders.get(placeholder_name)
-                if ph is None:
-                    # schedule1/2/3 のどれかが無い場合、そのブロックはスキップ
-                    continue
-
-                # プレースホルダ図形の位置とサイズを取得
-                left   = ph.left
-                top    = ph.top
-                width  = ph.width
-                height = ph.height
-
-                # プレースホルダを削除（同じ位置に表を置く）
-                try:
-                    slide.shapes._spTree.remove(ph._element)
-                except Exception:
-                    pass
-
-                rows = len(block_df) + 1  # ヘッダー行 + データ行
-                cols = 3
-
-                table = slide.shapes.add_table(rows, cols, left, top, width, height).table
-
-                # --- ヘッダー行 ---
-                for j, h in enumerate(headers):
-                    cell = table.cell(0, j)
-                    cell.text = h
-
-                    cell.fill.solid()
-                    cell.fill.fore_color.rgb = header_fill_color
-
-                    for p in cell.text_frame.paragraphs:
-                        p.font.bold = True
-                        p.font.size = Pt(12)
-                        p.alignment = PP_ALIGN.CENTER
-                        p.font.name = "Meiryo UI"
-                        p.font.color.rgb = text_color
-
-                # --- データ行 ---
-                for i, (_, row) in enumerate(block_df.iterrows()):
-                    table.cell(i + 1, 0).text = str(row.get("日付", ""))
-                    table.cell(i + 1, 1).text = str(row.get("曜日", ""))
-                    table.cell(i + 1, 2).text = str(row.get("マイルストン", ""))
-
-                    is_holiday = bool(row.get("非営業日", False))
-
-                    for j in range(3):
-                        cell = table.cell(i + 1, j)
+                    p.alignment = PP_ALIGN.CENTER
 
-                        # 非営業日は薄いグレー、それ以外は白
+            for i in range(df.shape[0]):
+                for j, col in enumerate(headers):
+                    val = df.at[i, col]
+                    cell = table.cell(i + 1, j)
+                    cell.text = str(val) if val else ""
+                    for p in cell.text_frame.paragraphs:
+                        p.font.size = Pt(11)
+                    if df.at[i, "非営業日"]:
                         cell.fill.solid()
-                        cell.fill.fore_color.rgb = holiday_fill_color if is_holiday else body_fill_color
-
-                        for p in cell.text_frame.paragraphs:
-                            p.font.size = Pt(11)
-                            p.font.name = "Meiryo UI"
-                            p.font.color.rgb = text_color
-
-            return prs
+                        cell.fill.fore_color.rgb = RGBColor(220, 220, 220)
+                    else:
+                        cell.fill.solid()
+                        cell.fill.fore_color.rgb = RGBColor(255, 255, 255)
 
+            bio = BytesIO()
+            prs.save(bio)
+            bio.seek(0)
+            return bio.read()
 
+        from pptx.util import Inches, Pt
+        from pptx.dml.color import RGBColor
+        from pptx.enum.text import PP_ALIGN
+        import pandas as pd
 
         # ------------------------------------------------
         # Streamlit UI（ここで schedule_phase_draft を反映）
@@ -2234,6 +6039,8 @@ with center:
                 },
                 key="calendar_editor_v7"
             )
+            # 一括出力で使うため、編集後の表を残しておく
+            st.session_state["schedule_calendar"] = edited_cal
 
             st.markdown("---")
 
@@ -2244,9 +6051,8 @@ with center:
                     st.warning("PPTテンプレートを先にアップロードしてください。")
                 else:
                     try:
-                        prs = Presentation(pptx_path)
-                        prs = reflect_schedule_to_slide7(prs, edited_cal)
-                        prs.save(pptx_path)
+                        prs = get_working_presentation()
+                        prs = apply_schedule_table(prs, edited_cal)
 
                         st.success("スライド7（スケジュール案）にスケジュール表を反映しました！")
 
@@ -2275,7 +6081,7 @@ with center:
         # ---- PPTプレビュー表示（スライド8：画像プレビュー）----
         if pptx_path:
             try:
-                images = pptx_to_images(pptx_path)
+                images = pptx_to_images(get_working_presentation())
                 if len(images) > 16:  # スライド8は index=7（0始まり）…テンプレ側に合わせて調整
                     st.image(images[16], caption="スライド8：概算見積", use_container_width=True)
                 else:
@@ -2479,6 +6285,11 @@ with center:
         # ======================
         st.markdown("### 📊 5パターンの比較サマリー")
 
+        # オリエンで見積金額の上限が示されていれば、各パターンが収まるかを併記する
+        budget_cap = get_orien_record()["budget_cap_yen"]
+        if budget_cap:
+            st.caption(f"オリエンでの見積金額上限：{to_man_yen(budget_cap):,.1f} 万円")
+
         df_view = pd.DataFrame(
             [
                 {
@@ -2486,6 +6297,7 @@ with center:
                     "本調査質問数": p["q"],
                     "本調査サンプルサイズ": p["n"],
                     "概算合計（万円）": f"{to_man_yen(p['total_cost']):,.1f}",
+                    **({"上限内": "○" if p["total_cost"] <= budget_cap else "×"} if budget_cap else {}),
                 }
                 for p in patterns
             ]
@@ -2522,12 +6334,11 @@ with center:
                 st.warning("PPTテンプレートを先にアップロードしてください。")
             else:
                 try:
-                    from pptx import Presentation
                     from pathlib import Path
                     from datetime import datetime
 
-                    prs = Presentation(pptx_path)
-                    slide_index = 16  # スライド8（0始まり）
+                    prs = get_working_presentation()
+                    slide_index = template_mode_slide("概算見積")
 
                     if slide_index < len(prs.slides):
                         slide = prs.slides[slide_index]
@@ -2540,14 +6351,10 @@ with center:
                             if not text_to_apply:
                                 continue
 
-                            ok = set_text_to_named_shape(slide, shape_name, text_to_apply)
-
-                            if ok:
-                                shp = next((s for s in slide.shapes if s.name == shape_name), None)
-                                if shp and getattr(shp, "has_text_frame", False):
-                                    # ★ 概算見積だけフォントサイズ10ptに統一
-                                    apply_text_format(shp, font_size=10)
+                            # ★ 概算見積だけフォントサイズ10ptに統一
+                            shp = apply_slot_text(prs, slide_index, shape_name, text_to_apply, style="amount", label="概算見積")
 
+                            if shp is not None:
                                 # プレビュー用キャッシュ
                                 st.session_state.edited_texts[shape_name] = text_to_apply
                                 applied_count += 1
@@ -2555,13 +6362,6 @@ with center:
                                 st.warning(f"スライド8内に『{shape_name}』という名前のテキスト図形が見つかりませんでした。")
 
                         if applied_count > 0:
-                            SLIDES_DIR = get_session_dir()
-                            SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-                            out_path = SLIDES_DIR / f"estimate_slide8_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-
-                            prs.save(out_path)
-                            st.session_state["pptx_path"] = str(out_path)
-
                             # プレビュー更新のためのフラグ
                             st.session_state["estimate_applied"] = True
 
@@ -2603,15 +6403,10 @@ with center:
 
             if st.button("💾 現在の内容で最終版PowerPointを作成", use_container_width=True):
                 try:
-                    # 現在の pptx_path の内容をそのまま別名保存
-                    prs = Presentation(pptx_path)
-
-                    SLIDES_DIR = get_session_dir()
-                    SLIDES_DIR.mkdir(parents=True, exist_ok=True)
-                    out_path = SLIDES_DIR / f"proposal_final_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx"
-
-                    prs.save(out_path)
-                    st.session_state["final_pptx_path"] = str(out_path)
+                    # テンプレート + 反映履歴（現在の版）をここで初めてファイルにする
+                    out_path = export_presentation()
+                    st.session_state["final_pptx_path"] = out_path
+                    st.session_state["final_pptx_revision"] = revision_log()["version"]
 
                     st.success(
                         "現在のPPTビューアーに反映されている内容をもとに "
@@ -2621,6 +6416,94 @@ with center:
                 except Exception as e:
                     st.error(f"最終版PowerPoint作成中にエラーが発生しました: {e}")
 
+            st.markdown("---")
+            st.markdown("### 🧩 全工程をまとめて反映して出力")
+            st.caption(
+                "各モードの『…に反映』ボタンを押さなくても、現在の入力内容（表紙〜概算見積）をすべてのスロットに一度に反映し、"
+                "最終版PowerPointを1回で書き出します。"
+            )
+            available_versions = [
+                ver for ver in SURVEY_VERSION_LABELS
+                if st.session_state.get(f"survey_items_{ver}") or (st.session_state.get("ai_survey_items") or {}).get(ver)
+            ]
+            survey_version = st.selectbox(
+                "調査項目案のバージョン",
+                available_versions or SURVEY_VERSION_LABELS,
+                key="bulk_export_survey_version",
+            )
+
+            if st.button("🧩 全工程を反映して最終版を作成", use_container_width=True):
+                try:
+                    result = apply_project_and_export(survey_version)
+                    st.session_state["final_pptx_path"] = result["path"]
+                    st.session_state["final_pptx_revision"] = revision_log()["version"]
+                    st.session_state["bulk_export_report"] = result["report"]
+                except Exception as e:
+                    st.error(f"一括出力中にエラーが発生しました: {e}")
+
+            report = st.session_state.get("bulk_export_report")
+            if report:
+                import pandas as pd
+
+                counts = {status: sum(1 for r in report if r["状態"] == status) for status in ("反映", "はみ出し", "未入力", "スロットなし")}
+                st.success(
+                    f"反映 {counts['反映']} ・はみ出し {counts['はみ出し']} ・未入力 {counts['未入力']} ・スロットなし {counts['スロットなし']}"
+                    "（右ペインからダウンロードできます）"
+                )
+                problems = [r for r in report if r["状態"] != "反映"]
+                if problems:
+                    st.dataframe(pd.DataFrame(problems), use_container_width=True, hide_index=True)
+                with st.expander("すべてのスロット", expanded=False):
+                    st.dataframe(pd.DataFrame(report), use_container_width=True, hide_index=True)
+
+
+    # =========================
+    # 中央ペイン
+    # === LLM診断 ===
+    elif mode == "llm_diagnostics":
+        st.markdown("## LLM診断")
+        st.caption("LLM呼び出しごとの所要時間・トークン数・費用・結果をモード別に集計しています。")
+
+        import pandas as pd
+
+        records = get_telemetry_records()
+        if st.session_state.get("diag_exclude_replayed"):
+            records = [r for r in records if not r.get("replayed")]
+
+        if not records:
+            st.info("まだLLM呼び出しの記録がありません。各モードで下書きを作成すると、ここに集計が表示されます。")
+        else:
+            st.markdown("### モード別サマリー（p50 / p95）")
+            st.dataframe(pd.DataFrame(summarize_telemetry(records)), hide_index=True, use_container_width=True)
+
+            st.markdown("### 直近の呼び出し")
+            recent = list(reversed(records))[:50]
+            st.dataframe(
+                pd.DataFrame(
+                    [
+                        {
+                            "時刻": r.get("ts"),
+                            "モード": r.get("mode"),
+                            "モデル": r.get("model"),
+                            "エンドポイント": r.get("endpoint") or "-",
+                            "ヘッジ": "あり" if r.get("hedged") else "",
+                            "結果": r.get("outcome"),
+                            "入力トークン": r.get("prompt_tokens"),
+                            "出力トークン": r.get("completion_tokens"),
+                            "TTFT(秒)": round(r["ttft_s"], 2) if r.get("ttft_s") is not None else None,
+                            "所要時間(秒)": round(r["latency_s"], 2) if r.get("latency_s") is not None else None,
+                            "リトライ": r.get("retries"),
+                            "finish_reason": r.get("finish_reason"),
+                            "パース": {True: "成功", False: "失敗"}.get(r.get("parse_ok"), "-"),
+                            "エラー": r.get("error", ""),
+                        }
+                        for r in recent
+                    ]
+                ),
+                hide_index=True,
+                use_container_width=True,
+            )
+
 
 
 
@@ -2630,6 +6513,9 @@ with center:
 # =========================
 # =========================
 with right:
+    # 実行中の生成ジョブ（進捗・中止ボタン）と完了メッセージ
+    render_llm_job_panel()
+
     mode = st.session_state.get("selected_mode")
 
     # =========================
@@ -2645,8 +6531,7 @@ with right:
             if not ori_texts.strip():
                 st.warning("オリエン資料をアップロードしてください。")
             else:
-                with st.spinner("オリエン資料から項目を抽出中..."):
-                    prompt = f"""
+                prompt = f"""
 あなたは市場調査の専門家です。
 以下のオリエン資料から以下のことをまとめてください。
 特に言及がなければ項目ごとに「なし」と記載してください。
@@ -2686,32 +6571,38 @@ with right:
 オリエン資料：
 {ori_texts[:4000]}
 """
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.3,
-                            max_tokens=900,  # ★長めに確保
-                        )
-                        ai_result = response.choices[0].message.content.strip()
-
-                        # ★全文をセッションに保存（中央ペインで表示する用）
-                        st.session_state["orien_outline_text"] = ai_result
-                        st.session_state["orien_outline_editor"] = ai_result
-                        # ★企業名だけも別途保存（表紙などと連携したい場合用）
-                        # import re
-                        # m = re.search(r"企業名[:：]\s*(.*)", ai_result)
-                        # company = m.group(1).strip() if m else ""
-                        # st.session_state["orien_company_text"] = company
-
-                        st.success("オリエン内容の下書きを作成しました。中央ペインに表示します。")
-                        st.rerun()
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                def _work(control, prompt=prompt):
+                    response = call_llm(
+                        "オリエン内容の整理",
+                        messages=[
+                            {"role": "system", "content": "あなたは市場調査の専門家です。"},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.3,
+                        max_tokens=900,  # ★長めに確保
+                        control=control,
+                    )
+                    return response["content"].strip()
+
+                def _apply(ai_result):
+                    # ★全文をセッションに保存（中央ペインで表示する用）
+                    st.session_state["orien_outline_text"] = ai_result
+                    st.session_state["orien_outline_editor"] = ai_result
+                    # ★企業名・ブランド・カテゴリーは構造化した結果から、未入力の欄だけ埋める
+                    # （企業名は資料の一括抽出 build_doc_extraction_job でも orien_company_text に保存している）
+                    record = get_orien_record()
+                    for field, key in [
+                        ("company", "orien_company_text"),
+                        ("category", "target_category"),
+                        ("brand", "target_brand"),
+                    ]:
+                        if record[field] and not st.session_state.get(key):
+                            st.session_state[key] = record[field]
+                    return "オリエン内容の下書きを作成しました。中央ペインに表示します。"
+
+                submit_llm_job("オリエン内容の整理", "オリエン内容の下書き", _work, _apply, input_key=llm_input_key(prompt))
+                st.rerun()
 
 
     # =========================
@@ -2727,47 +6618,21 @@ with right:
 
         ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
 
-        # カテゴリー・ブランドを推測
+        # カテゴリー・ブランドを推測（表紙の顧客名・調査名と同じ一括抽出。抽出済みの資料なら呼び出さない）
         if st.button("📘 カテゴリー・ブランドを推測", use_container_width=True):
             if not ori_texts.strip():
                 st.warning("オリエン資料をアップロードしてください。")
             else:
-                with st.spinner("カテゴリーとブランドを推測中..."):
-                    prompt = f"""
-    あなたは市場調査の専門家です。
-    以下のオリエン資料から、今回の調査対象となるカテゴリー（市場）とブランド名を推定してください。
-
-    【出力形式】
-    カテゴリー（市場）:
-    ブランド:
-
-    資料:
-    {ori_texts[:4000]}
-    """
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.5,
-                            max_tokens=200,
-                        )
-                        ai_result = response.choices[0].message.content
-
-                        import re
-                        cat_match = re.search(r"カテゴリー（市場）[:：]\s*(.*)", ai_result)
-                        brand_match = re.search(r"ブランド[:：]\s*(.*)", ai_result)
-
-                        st.session_state["target_category"] = cat_match.group(1).strip() if cat_match else ""
-                        st.session_state["target_brand"] = brand_match.group(1).strip() if brand_match else ""
-
-                        st.success("カテゴリーとブランドを抽出しました。下の欄で確認・編集できます。")
-                        st.rerun()
-
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                cached = cached_doc_extraction(doc_corpus_key(ori_texts))
+                if cached is not None:
+                    apply_doc_extraction(cached, overwrite_brand=True)
+                    st.session_state["llm_job_notices"].append(
+                        ("success", "抽出済みの結果からカテゴリーとブランドを反映しました。下の欄で確認・編集できます。", "")
+                    )
+                else:
+                    job = build_doc_extraction_job(ori_texts, overwrite_brand=True)
+                    submit_llm_job("資料の一括抽出", job["label"], job["work"], job["on_done"], input_key=job["input_key"])
+                st.rerun()
 
 
         # 手動編集欄
@@ -2788,14 +6653,18 @@ with right:
         # カテゴリー・ブランドについて検索
         st.markdown("カテゴリー・ブランドについて検索")
 
+        st.checkbox(
+            "共有キャッシュを使わずに検索し直す",
+            key="brand_cache_bypass",
+            help="同じカテゴリー・ブランドは他の担当者の検索結果を再利用します（有効期限内のみ）。最新の情報で作り直す場合はチェックしてください。",
+        )
         if st.button("カテゴリー・ブランドについて検索", use_container_width=True):
             cat = st.session_state.get("target_category", "")
             brand = st.session_state.get("target_brand", "")
             if not cat:
                 st.warning("カテゴリーを入力してください。")
             else:
-                with st.spinner("市場特性を検索中..."):
-                    prompt = f"""
+                prompt = f"""
     あなたは市場分析の専門家です。
     次のカテゴリーとブランドに関する市場構造と消費行動特性を整理してください。
 
@@ -2829,47 +6698,8 @@ with right:
 
 
 """
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場分析の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=900,
-                        )
-                        result = response.choices[0].message.content
-
-                        import pandas as pd, re
-
-                        def extract_md_table(md_text, header):
-                            if header in md_text:
-                                section = md_text.split(header, 1)[1]
-                                table_part = section.split("#")[0]
-                                rows = [
-                                    ln.strip()
-                                    for ln in table_part.splitlines()
-                                    if "|" in ln and not ln.startswith("|項目|----|")
-                                ]
-                                data = []
-                                for ln in rows:
-                                    cols = [c.strip() for c in ln.strip("|").split("|")]
-                                    if len(cols) >= 2:
-                                        data.append(cols[:2])
-                                if data:
-                                    df = pd.DataFrame(data[1:], columns=data[0])
-                                    return df
-                            return pd.DataFrame(columns=["項目", "内容"])
-
-                        st.session_state["df_category_structure"] = extract_md_table(result, "# カテゴリーに関する検索項目")
-                        st.session_state["df_behavior_traits"] = extract_md_table(result, "# カテゴリーの消費行動特性")
-
-                        st.success("市場特性を整理しました。中央ペインに表示されます。")
-
-                        # ---- 追加：マーケティングファネル生成 ----
-                        with st.spinner("マーケティングファネルを生成中..."):
-                            prompt_funnel = f"""
+                # ---- 追加：マーケティングファネル生成（検索と同じジョブで続けて実行） ----
+                prompt_funnel = f"""
 あなたはブランドマーケティングの専門家であり、人の思考を支援するアシスタントです。
 以下のカテゴリーとブランドについて、消費者が「認知」から「再接点・ロイヤリティ」に至るまでの
 マーケティングファネルをツリー構造で整理してください。
@@ -2903,22 +6733,73 @@ with right:
     - 利用メリットが伝わらない
 ...
     """
-                            response_funnel = client.chat.completions.create(
-                                model=DEPLOYMENT,
-                                messages=[
-                                    {"role": "system", "content": "あなたはブランドマーケティングの専門家です。"},
-                                    {"role": "user", "content": prompt_funnel},
-                                ],
-                                temperature=0.6,
-                                max_tokens=1800,
-                            )
-                            st.session_state["funnel_text"] = response_funnel.choices[0].message.content
 
-                        st.success("マーケティングファネルを生成しました。中央ペインに表示されます。")
-                        st.rerun()
+                def _fetch(control, prompt=prompt, prompt_funnel=prompt_funnel):
+                    response = call_llm(
+                        "brand_diagnosis/search",
+                        messages=[
+                            {"role": "system", "content": "あなたは市場分析の専門家です。"},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.6,
+                        max_tokens=900,
+                        control=control,
+                    )
+                    result = response["content"]
+                    record_parse_outcome(response, _brand_tables_found(result))
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                    response_funnel = call_llm(
+                        "brand_diagnosis/funnel",
+                        messages=[
+                            {"role": "system", "content": "あなたはブランドマーケティングの専門家です。"},
+                            {"role": "user", "content": prompt_funnel},
+                        ],
+                        temperature=0.6,
+                        max_tokens=1800,
+                        control=control,
+                    )
+                    # キャッシュには JSON で保存できる生テキストを持ち、表は取り出すたびに読み取る
+                    return {"search_text": result, "funnel_text": response_funnel["content"]}
+
+                force = bool(st.session_state.get("brand_cache_bypass"))
+
+                def _work(control, cat=cat, brand=brand, force=force):
+                    value, source, saved_at = brand_cache_fetch(
+                        cat,
+                        brand,
+                        _fetch,
+                        control=control,
+                        is_valid=lambda v: _brand_tables_found(v["search_text"]),
+                        force=force,
+                    )
+                    return {
+                        "df_category_structure": extract_md_table(value["search_text"], "# カテゴリーに関する検索項目"),
+                        "df_behavior_traits": extract_md_table(value["search_text"], "# カテゴリーの消費行動特性"),
+                        "funnel_text": value["funnel_text"],
+                        "source": source,
+                        "saved_at": saved_at,
+                    }
+
+                def _apply(result):
+                    st.session_state["df_category_structure"] = result["df_category_structure"]
+                    st.session_state["df_behavior_traits"] = result["df_behavior_traits"]
+                    st.session_state["funnel_text"] = result["funnel_text"]
+                    if result["source"] == "cache":
+                        saved = datetime.fromtimestamp(result["saved_at"]).strftime("%Y/%m/%d %H:%M")
+                        return f"共有キャッシュ（{saved} に検索した結果）から市場特性とマーケティングファネルを読み込みました。"
+                    if result["source"] == "shared":
+                        return "同じカテゴリー・ブランドを検索中の他のセッションの結果を受け取りました。中央ペインに表示されます。"
+                    return "市場特性とマーケティングファネルを整理しました。中央ペインに表示されます。"
+
+                submit_llm_job(
+                    "brand_diagnosis/search",
+                    "市場特性・ファネルの検索",
+                    _work,
+                    _apply,
+                    # 検索し直しの依頼が、キャッシュを使う実行中のジョブに合流しないように分ける
+                    input_key=f"{brand_cache_key(cat, brand)}:force" if force else brand_cache_key(cat, brand),
+                )
+                st.rerun()
 
     # =========================
     # 右ペイン
@@ -2965,329 +6846,95 @@ with right:
 
         st.divider()
 
+        n_candidates = st.selectbox(
+            "候補数（1回の生成で複数案を作成）", LLM_CANDIDATE_CHOICES, key="kickoff_n_candidates"
+        )
+
         # ------------------------------------------------------------
         # 🪄 AI下書き生成（①〜⑥）
         # ------------------------------------------------------------
+        job = build_kickoff_job(selected_purpose, PURPOSE_MATRIX.get(selected_purpose, ""), n_candidates)
+        if "forecast" in job:
+            st.caption(format_forecast(job["forecast"]))
         if st.button("下書きを生成", use_container_width=True):
-            ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
-            orien_outline_text = st.session_state.get("orien_outline_text", "")
-            cat_df = st.session_state.get("df_category_structure")
-            beh_df = st.session_state.get("df_behavior_traits")
-            funnel_text = st.session_state.get("funnel_text", "")
-
-            if not ori_texts.strip():
-                st.warning("オリエン資料をアップロードしてください。")
+            if "warning" in job:
+                st.warning(job["warning"])
             else:
-                with st.spinner("キックオフノートの下書きを作成中..."):
-                    matrix_text = PURPOSE_MATRIX.get(selected_purpose, "")
-                    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
-                    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
-
-                    prompt = f"""
-    あなたは市場調査設計の専門家です。
-    以下のオリエン資料、ブランド診断結果、調査目的マトリクスをもとに、
-    調査設計の初期段階で用いる「キックオフノート」を作成してください。
-
-    【出力形式】
-    【目標】
-    【現状】
-    【ビジネス課題】
-    【調査目的】
-    【問い】
-    【仮説】
-    【ポイント】
-
-    
-    【条件】
-    - 各項目は80〜120字以内
-    - オリエン資料にある固有名詞や文脈を十分に生かしてください。
-    - 【目標】や【現状】は経営課題や社会問題など、調査では解決できない抽象課題は避けてください。
-      あくまで「消費者・市場・ブランド・広告・顧客体験」など、市場調査で仮説検証できる範囲に課題を限定してください。
-    - 【問い】はオリエンシートやブランド診断を踏まえた現在の対象ブランドの"リサーチクエスチョン"のことです。
-      ブランド全体について問う場合と広告やプロダクト/サービス、顧客接点など施策について問う場合があります。
-    - 【ポイント】にはなぜキックオフノートの各項目にそう記載したのか、特に注意すべき点や補足説明を簡潔に記載してください。
-      
-    【入力データ】
-    ▼オリエン内容の整理（抜粋）
-    {orien_outline_text[:2000]}
-
-    ▼ブランド診断：カテゴリー構造
-    {cat_text}
-
-    ▼ブランド診断：消費行動特性
-    {beh_text}
-
-    ▼マーケティングファネル
-    {funnel_text}
-
-    ▼選択した調査目的
-    {selected_purpose}：{matrix_text}
-
-
-    【禁止事項】
-    - ###、** などの記号は使わないでください。
-    """
-
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=900,
-                        )
-
-                        result = response.choices[0].message.content
-                        sections = parse_ai_output(result)
-
-                        # セッションに保存
-                        for key in sections:
-                            st.session_state[f"ai_{key}"] = sections[key]
-
-                        st.success("キックオフノートの下書きを生成しました！中央ペインに反映されます。")
-                        st.rerun()
+                # 項目ごとの再生成で共通の前提として使い回す
+                st.session_state["kickoff_messages"] = job["messages"]
+                submit_llm_job(
+                    "キックオフノート", job["label"], job["work"], job["on_done"],
+                    input_key=job["input_key"], forecast=job["forecast"],
+                )
+                st.rerun()
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+        st.divider()
+        render_field_regenerator(
+            "キックオフノート",
+            [(key, f"ai_{key}") for key in ["目標", "現状", "ビジネス課題", "調査目的", "問い", "仮説"]],
+            context_key="kickoff_messages",
+            max_tokens=300,
+        )
 
 
     # =========================
     # 右ペイン
     # === 問いの分解 ===
     elif mode == "問いの分解":
-        st.subheader("問いの分解")
-        st.caption("『問い』を検証するためのサブクエスチョンを生成します。")
-
-        if st.button("下書きを生成", use_container_width=True):
-            ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
-            orien_outline_text = st.session_state.get("orien_outline_text", "")
-            cat_df = st.session_state.get("df_category_structure")
-            beh_df = st.session_state.get("df_behavior_traits")
-            main_question = st.session_state.get("ai_問い", "")
-
-            if not main_question.strip():
-                st.warning("キックオフノート⑤『問い』が生成または入力されていません。")
-            elif not ori_texts.strip():
-                st.warning("オリエン資料をアップロードしてください。")
-            else:
-                with st.spinner("サブクエスチョンとアンケート項目を検討中..."):
-                    cat_text = (
-                        cat_df.to_markdown(index=False)
-                        if cat_df is not None and not cat_df.empty
-                        else ""
-                    )
-                    beh_text = (
-                        beh_df.to_markdown(index=False)
-                        if beh_df is not None and not beh_df.empty
-                        else ""
-                    )
-
-                    prompt = f"""
-あなたは市場調査設計の専門家です。
-以下の情報をもとに、キックオフノート⑤『問い』（リサーチクエスチョン）を深掘りするための
-【サブクエスチョン】を提案してください。サブクエスチョンへのアプローチは分析軸、評価項目、主な分析アプローチ、
-読み方・示唆例を含めて具体的に示してください。
-
-クロス集計分析の場合の例を示します。
-【出力形式】
-- サブクエスチョン1：認知度に影響を与える要因は何か？   
-  - 分析軸：性年代など
-  - 評価項目：認知度、利用率など
-  - 主な分析アプローチ：性年代ごとに認知度の違いを比較する
-  - 読み方・示唆例：若年層で認知度が低い場合、若年層向けの広告強化が必要など
-- サブクエスチョン2：購入者タイプごとに主に利用する情報源は何か？
-  - 分析軸：ヘビー層、ライト層など
-  - 評価項目：購入タイプ
-  - 主な分析アプローチ：ヘビー層ライト層ごとに情報源の違いを比較する
-  - 読み方・示唆例：ヘビー層はSNS、ライト層は店頭広告が主な情報源など
-
-
-【キックオフノート⑤ 問い】
-{main_question}
-
-▼オリエン内容の整理（抜粋）
- {orien_outline_text[:2000]}
-
-【ブランド診断：カテゴリー構造】
-{cat_text}
-
-【ブランド診断：消費行動特性】
-{beh_text}
-
-【禁止事項】
- - ###、** などの記号は使わないでください。
- - サブクエスチョンはどの問い（リサーチクエスチョン）にも対応しているのかが分かるように具体的に記載してください。
- - 1つの問いに対して、最大3つのサブクエスチョンを提案してください。
-"""
-
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=2000,
-                        )
-                        ai_text = response.choices[0].message.content
-
-                        # ★ 生テキストを保存（中央ペインのテキストエリア用）
-                        st.session_state["ai_subquestions"] = ai_text
-
-                        # ★ パースして構造化データも保存（問いの分解ビュー & 分析アプローチ用）
-                        st.session_state["subq_list"] = parse_subquestions(ai_text)
-
-                        st.success("下書きを生成しました！中央ペインおよび分析アプローチで利用できます。")
-                        st.rerun()
-
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
-
-
-    # =========================
-    # 右ペイン
-    # === 分析アプローチ ===
-    elif mode == "分析アプローチ":
-        st.subheader("分析アプローチ")
-        st.caption("『問いの分解』で作成したサブクエスチョンを、分析アプローチ視点で項目に整理します。")
-
-        # 『問いの分解』で保存した構造化データ
-        subq_list = st.session_state.get("subq_list", [])
-
-        if not subq_list:
-            st.info("先に『問いの分解』モードでサブクエスチョンを生成してください。")
-        else:
-
-            # 🔽 ここから新機能：AIで6項目に分解した下書きを作成
-            if st.button("下書きを作成", use_container_width=True):
-                ori_texts = "\n".join(st.session_state.get("uploaded_docs", []))
-                orien_outline_text = st.session_state.get("orien_outline_text", "")
-                cat_df = st.session_state.get("df_category_structure")
-                beh_df = st.session_state.get("df_behavior_traits")
-
-                kickoff = {
-                    "目標": st.session_state.get("ai_目標", ""),
-                    "現状": st.session_state.get("ai_現状", ""),
-                    "ビジネス課題": st.session_state.get("ai_ビジネス課題", ""),
-                    "調査目的": st.session_state.get("ai_調査目的", ""),
-                    "問い": st.session_state.get("ai_問い", ""),
-                    "仮説": st.session_state.get("ai_仮説", ""),
-                }
-
-                # サブクエスチョン一覧（AIに渡す用）
-                subq_text_lines = []
-                for i, sq in enumerate(subq_list, 1):
-                    subq_text_lines.append(f"SQ{i}: {sq.get('subq', '')}")
-                subq_text = "\n".join(subq_text_lines)
-
-                # 参考情報
-                cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
-                beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
-
-                import json
-
-                with st.spinner("サブクエスチョンごとの分析アプローチ案を検討中..."):
-                    prompt = f"""
-あなたは市場調査設計の専門家です。
-以下のサブクエスチョンそれぞれについて、次の6項目の観点から分析アプローチの下書きを作成してください。
-
-【対象となる6項目】
-- id: "SQ1" のようなID
-- subq: サブクエスチョン本文
-- axis: 分析軸（セグメント）
-- metric: 評価項目
-- approach: 主な分析アプローチ（どのような切り口で分析するか）
-- hypothesis: 検証する仮説（どのような結果が出ると何が言えるのか）
-
-▼オリエン内容の整理（抜粋）
- {orien_outline_text[:2000]}
-
-▼ブランド診断：カテゴリー構造
-{cat_text}
-
-▼ブランド診断：消費行動特性
-{beh_text}
+        st.subheader("問いの分解")
+        st.caption("『問い』を検証するためのサブクエスチョンを生成します。")
 
-▼キックオフノート
-{kickoff}
+        n_candidates = st.selectbox(
+            "候補数（1回の生成で複数案を作成）", LLM_CANDIDATE_CHOICES, key="subq_n_candidates"
+        )
 
-【サブクエスチョン一覧】
-{subq_text}
+        job = build_subquestion_job(n_candidates)
+        if "forecast" in job:
+            st.caption(format_forecast(job["forecast"]))
+        if st.button("下書きを生成", use_container_width=True):
+            if "warning" in job:
+                st.warning(job["warning"])
+            else:
+                submit_llm_job(
+                    "問いの分解", job["label"], job["work"], job["on_done"],
+                    input_key=job["input_key"], forecast=job["forecast"],
+                )
+                st.rerun()
 
-【出力形式】
-- 必ず JSON 配列のみを出力してください（余計な文章やコードブロックは書かないこと）
-- 形式の例：
 
-[
-  {{
-    "id": "SQ1",
-    "subq": "・・・",
-    "axis": "・・・",
-    "metric": "・・・",
-    "approach": "・・・",
-    "hypothesis": "・・・"
-  }},
-  {{
-    "id": "SQ2",
-    "subq": "・・・",
-    "axis": "・・・",
-    "metric": "・・・",
-    "approach": "・・・",
-    "hypothesis": "・・・"
-  }}
-]
+    # =========================
+    # 右ペイン
+    # === 分析アプローチ ===
+    elif mode == "分析アプローチ":
+        st.subheader("分析アプローチ")
+        st.caption("『問いの分解』で作成したサブクエスチョンを、分析アプローチ視点で項目に整理します。")
 
-- 配列の要素数は、入力されたサブクエスチョンの数と同じにしてください。
-- axis: 分析軸（セグメント）の案が複数ある場合は最も優先度の高いもの1つを提示してください。　
-  また、分析軸案の後に（）で具体的な項目を記載してください。
-- metric: 評価項目の案が複数ある場合は最も重要なもの1つを提示してください。
-- metric: 評価項目案の後に（）で具体的な項目を記載してください。
-  例：評価指標の場合は（あてはまる、ややあてはまる）など尺度の項目、イメージ項目の場合は（自分らしい、新しい）など
-- approach: 主な分析アプローチ（どのような切り口で分析するか）は、以下の形式で記載してください。
-  例：「性年代ごとに認知度の違いを比較する」「購入タイプ別に情報源の違いを分析する」など
-- hypothesis: 検証する仮説（どのような結果が出ると何が言えるのか）の語尾に「～の可能性が高い（ある）」を用いないでください。
-"""
+        # 『問いの分解』で保存した構造化データ
+        subq_list = st.session_state.get("subq_list", [])
 
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=2000,
-                        )
-                        ai_text = response.choices[0].message.content.strip()
-
-                        # ```json ... ``` で返ってきた場合のガード
-                        if ai_text.startswith("```"):
-                            ai_text = ai_text.strip("`")
-                            ai_text = ai_text.replace("json", "", 1).strip()
-
-                        try:
-                            blocks = json.loads(ai_text)
-                            if not isinstance(blocks, list):
-                                raise ValueError("JSON配列ではありません。")
-
-                        except Exception:
-                            st.error("AI出力をJSON配列として解釈できませんでした。出力内容を確認してください。")
-                            st.code(ai_text)
-                        else:
-                            # セッションに保存：中央ペインで参照する
-                            st.session_state["analysis_blocks"] = blocks
-                            # 以前の表示テキストもリセットしておく
-                            if "analysis_block_texts" in st.session_state:
-                                del st.session_state["analysis_block_texts"]
+        if not subq_list:
+            st.info("先に『問いの分解』モードでサブクエスチョンを生成してください。")
+        else:
 
-                            st.success("サブクエスチョン別の分析アプローチ案を作成しました。中央ペインに表示します。")
-                            st.rerun()
+            fanout = st.checkbox(
+                "サブクエスチョンごとに並列で生成する（高速・失敗したSQだけ再試行）",
+                value=True,
+                key="analysis_fanout",
+            )
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+            # 🔽 ここから新機能：AIで6項目に分解した下書きを作成
+            job = build_analysis_job(fanout)
+            if "forecast" in job:
+                st.caption(format_forecast(job["forecast"]))
+            if st.button("下書きを作成", use_container_width=True):
+                if "warning" in job:
+                    st.warning(job["warning"])
+                else:
+                    submit_llm_job(
+                        "分析アプローチ", job["label"], job["work"], job["on_done"],
+                        input_key=job["input_key"], forecast=job["forecast"],
+                    )
+                    st.rerun()
 
 
 
@@ -3317,11 +6964,10 @@ with right:
             if not ori_texts.strip():
                 st.warning("オリエン資料をアップロードしてください。")
             else:
-                with st.spinner("調査対象者条件を検討中..."):
-                    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
-                    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
+                cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
+                beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
 
-                    prompt = f"""
+                prompt = f"""
     あなたは市場調査設計の専門家です。
     以下の情報をもとに、この調査の「対象者条件」を検討してください。
 
@@ -3355,24 +7001,25 @@ with right:
     - 「補足」や「説明文」も不要です。
     """
 
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=500,
-                        )
-                        ai_text = response.choices[0].message.content.strip()
-
-                        st.session_state["ai_target_condition"] = ai_text
-                        st.success("調査対象者条件を生成しました！中央ペインに反映されます。")
-                        st.rerun()
+                def _work(control, prompt=prompt):
+                    response = call_llm(
+                        "対象者条件を検討",
+                        messages=[
+                            {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.6,
+                        max_tokens=500,
+                        control=control,
+                    )
+                    return response["content"].strip()
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                def _apply(ai_text):
+                    st.session_state["ai_target_condition"] = ai_text
+                    return "調査対象者条件を生成しました！中央ペインに反映されます。"
+
+                submit_llm_job("対象者条件を検討", "対象者条件案", _work, _apply, input_key=llm_input_key(prompt))
+                st.rerun()
 
 
 
@@ -3384,111 +7031,18 @@ with right:
         st.subheader("調査項目案")
         st.caption("調査項目案を作成します。")
 
+        job = build_survey_items_job()
+        if "forecast" in job:
+            st.caption(format_forecast(job["forecast"]))
         if st.button("下書きを作成", use_container_width=True):
-            # 「オリエン内容の整理」で作成したテキストを参照
-            orien_outline_text = st.session_state.get("orien_outline_text", "")
-
-            cat_df = st.session_state.get("df_category_structure")
-            beh_df = st.session_state.get("df_behavior_traits")
-            kickoff = {
-                "目標": st.session_state.get("ai_目標", ""),
-                "現状": st.session_state.get("ai_現状", ""),
-                "ビジネス課題": st.session_state.get("ai_ビジネス課題", ""),
-                "調査目的": st.session_state.get("ai_調査目的", ""),
-                "問い": st.session_state.get("ai_問い", ""),
-                "仮説": st.session_state.get("ai_仮説", ""),
-            }
-            subquestions = st.session_state.get("ai_subquestions", "")
-            target_condition = st.session_state.get("ai_target_condition", "")
-
-            if not orien_outline_text.strip():
-                st.warning("先に『オリエン内容の整理』で下書きを作成してください。")
+            if "warning" in job:
+                st.warning(job["warning"])
             else:
-                with st.spinner("調査項目案を検討中..."):
-                    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
-                    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
-
-                    prompt = f"""
-    あなたは市場調査設計の専門家です。
-    以下の情報をもとに、この調査で実施すべき調査項目案を提案してください。
-
-    【出力条件】
-    - 選択肢は不要（設問文のみ）
-    - 設問文は質問文形式でなく、調査項目名として簡潔に表現する
-      例：過去3年以内にキッザニアを訪れた経験はありますか？の場合、「キッザニア訪問経験」など
-    - 各バージョンで網羅性と実務的な順序を意識する
-    - 各バージョンは下記の見出しごとに分けて出力する
-    - 各バージョンで「ちょうど」下記の問数になるようにする（10問／20問／30問／40問）
-    - 各設問は1行で簡潔に（目安：全角60文字以内）
-    - 見出しと設問リスト以外の説明文は出力しない
-
-    【出力形式】
-    # 10問バージョン
-    1. ...
-    2. ...
-    （10問まで）
-
-    # 20問バージョン
-    1. ...
-    （20問まで）
-
-    # 30問バージョン
-    1. ...
-    （30問まで）
-
-    # 40問バージョン
-    1. ...
-    （40問まで）
-
-    【オリエン内容の整理（抜粋）】
-    {orien_outline_text[:2000]}
-
-    【ブランド診断：カテゴリー構造】
-    {cat_text}
-
-    【ブランド診断：消費行動特性】
-    {beh_text}
-
-    【キックオフノート】
-    {kickoff}
-
-    【問いの要因分解】
-    {subquestions}
-
-    【対象者条件】
-    {target_condition}
-
-   """
-
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.6,
-                            max_tokens=3200,  # かなり余裕を持たせる
-                        )
-                        ai_text = response.choices[0].message.content.strip()
-
-                        # デバッグ用に生テキストも一応保存しておくと便利
-                        st.session_state["ai_survey_items_raw"] = ai_text
-
-                        # ---- 出力を分割して辞書に格納 ----
-                        import re
-                        versions = {}
-                        for ver in ["10問", "20問", "30問", "40問"]:
-                            pattern = rf"#\s*{ver}バージョン(.*?)(?=#\s*\d+問バージョン|$)"
-                            m = re.search(pattern, ai_text, re.DOTALL)
-                            versions[ver] = m.group(1).strip() if m else ""
-
-                        st.session_state["ai_survey_items"] = versions
-                        st.success("調査項目案を生成しました！中央ペインに反映されます。")
-                        st.rerun()
-
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                submit_llm_job(
+                    "調査項目案", job["label"], job["work"], job["on_done"],
+                    input_key=job["input_key"], forecast=job["forecast"],
+                )
+                st.rerun()
 
 
 
@@ -3500,126 +7054,23 @@ with right:
         st.subheader("調査仕様案")
         st.caption("『調査仕様の下書きを作成します。")
 
+        job = build_spec_job()
+        if "forecast" in job:
+            st.caption(format_forecast(job["forecast"]))
         if st.button("下書きを作成", use_container_width=True):
-            # 入力ソースを取得
-            orien_outline_text = st.session_state.get("orien_outline_text", "")
-            target_condition = st.session_state.get("ai_target_condition", "")
-            survey_items_selected = st.session_state.edited_texts.get("EDIT1", "")
-
-            if not orien_outline_text.strip():
-                st.warning("先に『オリエン内容の整理』で下書きを作成してください。")
+            if "warning" in job:
+                st.warning(job["warning"])
             else:
-                with st.spinner("調査仕様の下書きを作成中..."):
-                    cat_df = st.session_state.get("df_category_structure")
-                    beh_df = st.session_state.get("df_behavior_traits")
-
-                    cat_text = cat_df.to_markdown(index=False) if cat_df is not None and not cat_df.empty else ""
-                    beh_text = beh_df.to_markdown(index=False) if beh_df is not None and not beh_df.empty else ""
-
-                    # JSON形式で返すように指示してパースしやすくする
-                    import json
-
-                    prompt = f"""
-    あなたは市場調査設計の専門家です。
-    以下の情報をもとに、この調査の「調査仕様案」を項目ごとに整理してください。
-
-    【入力情報】
-    ▼オリエン内容の整理
-    {orien_outline_text[:2000]}
-
-    ▼対象者条件
-    {target_condition}
-
-    ▼調査項目案（採用版：PPT EDIT1に反映した内容）
-    {survey_items_selected}
-
-    ▼参考情報：カテゴリー構造
-    {cat_text}
-
-    ▼参考情報：消費行動特性
-    {beh_text}
-
-    【出力する項目】
-    - 調査手法
-    - 抽出方法
-    - 調査地域
-    - 対象者条件
-    - サンプルサイズ
-    - 調査ボリューム
-    - 提示物
-    - 集計・分析仕様
-    - 自由回答データの処理
-    - 業務範囲
-    - 納品物
-    - インスペクションの方法
-    - 謝礼の種類
-    - 備考
-
-    【出力形式】
-    次のキーを持つ JSON オブジェクト「だけ」を出力してください。
-    余計な説明文やコードブロック（```）は出力しないでください。
-
-    {{
-      "調査手法": "...",
-      "抽出方法": "...",
-      "調査地域": "...",
-      "対象者条件": "...",
-      "サンプルサイズ": "...",
-      "調査ボリューム": "...",
-      "提示物": "...",
-      "集計・分析仕様": "...",
-      "自由回答データの処理": "...",
-      "業務範囲": "...",
-      "納品物": "...",
-      "インスペクションの方法": "...",
-      "謝礼の種類": "...",
-      "備考": "..."
-    }}
-
-    - 調査手法は特に明記がなければ「インターネット調査」を基本としてください。
-      対象者条件の検討の中で、属性以外の条件がある場合は（スクリーニングあり）と付記してください。
-    - 抽出方法は特に明記がなければ「割付抽出」としてください。
-    - 対象者条件は、前述の対象者条件案を参考に、調査仕様として適切な形式に整えてください。
-    - 調査ボリュームはスクリーニング調査と本調査を2行に分けて記載してください。
-      本調査のボリュームは、調査項目案の選択結果を記載してください。
-    - 自由回答データの処理は、オリエン内容のテキストに記載がなければ「なし」を基本としてください。
-    - インスペクションの方法は、オリエン内容のテキストに記載がなければ「性別・年齢（2歳以上）のアンマッチの場合は、対象除外とする。」を基本としてください。
-    - 謝礼の種類は、オリエン内容のテキストに記載がなければ「ポイント謝礼」を基本としてください。
-    """
-
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査設計の専門家です。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.5,
-                            max_tokens=1000,
-                        )
-
-                        ai_text = response.choices[0].message.content.strip()
-
-                        # 念のため ```json ... ``` で返ってきた場合も対応
-                        if ai_text.startswith("```"):
-                            ai_text = ai_text.strip("`")
-                            ai_text = ai_text.replace("json", "", 1).strip()
-
-                        try:
-                            spec_obj = json.loads(ai_text)
-                        except Exception:
-                            st.error("AI出力をJSONとして解釈できませんでした。出力内容を確認してください。")
-                            st.code(ai_text)
-                        else:
-                            # SPEC_ITEMS に従って session_state に保存
-                            for label, key in SPEC_ITEMS:
-                                st.session_state[key] = spec_obj.get(label, "")
-
-                            st.success("調査仕様の下書きを作成しました。中央ペインに表示します。")
-                            st.rerun()
+                # 項目ごとの再生成で共通の前提として使い回す
+                st.session_state["spec_messages"] = job["messages"]
+                submit_llm_job(
+                    "調査仕様案", job["label"], job["work"], job["on_done"],
+                    input_key=job["input_key"], forecast=job["forecast"],
+                )
+                st.rerun()
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+        st.divider()
+        render_field_regenerator("調査仕様案", SPEC_ITEMS, context_key="spec_messages", max_tokens=250)
 
 
     # =========================
@@ -3633,21 +7084,48 @@ with right:
         orien_outline_text = st.session_state.get("orien_outline_text", "")
 
         # ▼ 下書き作成ボタン
+        need_ai_draft = False
         if st.button("下書きを作成", use_container_width=True):
             if not orien_outline_text.strip():
                 st.warning("先に『オリエン内容の整理』で下書きを作成してください。")
             else:
-                with st.spinner("オリエン内容からマイルストン案を抽出中..."):
-                    import json
+                # まずオリエンのスケジュール要望・資料中の日付表現をルールで読み取り、見つからなかった場合だけAIに依頼する
+                phases = (
+                    schedule_phases_from_record(get_orien_record())
+                    or extract_schedule_dates(orien_outline_text)
+                    or extract_schedule_dates("\n".join(st.session_state.get("uploaded_docs", [])))
+                )
+                if phases:
+                    import pandas as pd
+
+                    st.session_state["schedule_phase_draft"] = phases
+                    st.session_state["schedule_phase_draft_df"] = pd.DataFrame(phases)
+                    st.session_state["schedule_draft_source"] = "rules"
+                    st.session_state.setdefault("llm_job_notices", []).append(
+                        ("success", f"資料中の日付から {len(phases)} 件のマイルストンを読み取りました。", "")
+                    )
+                    st.rerun()
+                else:
+                    need_ai_draft = True
+
+        if st.session_state.get("schedule_draft_source") == "rules" and orien_outline_text.strip():
+            st.caption("※ 日付表現からルールで読み取った下書きです。工程名や順序を整えたい場合はAIで作成し直せます。")
+            if st.button("AIで下書きを作成し直す", use_container_width=True, key="schedule_ai_redraft"):
+                need_ai_draft = True
+
+        if need_ai_draft:
+            import json
 
-                    # オリエン整理テキストの「スケジュールに関する要望」部分から
-                    # マイルストン名と固定日（ある場合）をJSON配列で返すようにAIに指示
-                    prompt = f"""
+            # オリエン整理テキストの「スケジュールに関する要望」部分から
+            # マイルストン名と固定日（ある場合）をJSON配列で返すようにAIに指示
+            # （構造化できていれば要望の項目だけを渡す）
+            schedule_input = format_orien_requests(get_orien_record()["schedule_requests"]) or orien_outline_text[:2000]
+            prompt = f"""
 あなたは市場調査プロジェクトのプロジェクトマネージャーです。
 以下の「オリエン内容の整理」テキストの中から、スケジュールに関する項目と日付情報を整理してください。
 
 【入力テキスト（オリエン内容の整理）】
-{orien_outline_text[:2000]}
+{schedule_input}
 
 特に、次のような項目を優先して確認してください：
 - 企画提案予定日
@@ -3681,49 +7159,52 @@ with right:
   もしすべての項目を実行するのために十分な日程がない場合は、1営業日に複数の項目が入ってもよい。
 """
 
-                    try:
-                        response = client.chat.completions.create(
-                            model=DEPLOYMENT,
-                            messages=[
-                                {"role": "system", "content": "あなたは市場調査プロジェクトのPMとして、実務で使えるスケジュール案を作るアシスタントです。"},
-                                {"role": "user", "content": prompt},
-                            ],
-                            temperature=0.4,
-                            max_tokens=800,
-                        )
-
-                        ai_text = response.choices[0].message.content.strip()
-
-                        # ```json ... ``` で返ってきた場合のガード
-                        if ai_text.startswith("```"):
-                            ai_text = ai_text.strip("`")
-                            ai_text = ai_text.replace("json", "", 1).strip()
-
-                        try:
-                            phases = json.loads(ai_text)
-                        except Exception:
-                            st.error("AI出力をJSONとして解釈できませんでした。出力内容を確認してください。")
-                            st.code(ai_text)
-                        else:
-                            if not isinstance(phases, list):
-                                st.error("JSON配列ではありません。出力形式を確認してください。")
-                                st.code(ai_text)
-                            else:
-                                # 中央ペイン（スケジュール案）で利用するためにセッションに保存
-                                st.session_state["schedule_phase_draft"] = phases
+            def _work(control, prompt=prompt):
+                response = call_llm(
+                    "スケジュール案",
+                    messages=[
+                        {"role": "system", "content": "あなたは市場調査プロジェクトのPMとして、実務で使えるスケジュール案を作るアシスタントです。"},
+                        {"role": "user", "content": prompt},
+                    ],
+                    temperature=0.4,
+                    max_tokens=800,
+                    control=control,
+                )
 
-                                # プレビュー用に DataFrame も保持（任意）
-                                try:
-                                    import pandas as pd
-                                    st.session_state["schedule_phase_draft_df"] = pd.DataFrame(phases)
-                                except Exception:
-                                    st.session_state["schedule_phase_draft_df"] = None
+                ai_text = response["content"].strip()
 
-                                st.success("スケジュールの下書きを作成しました。中央ペインのスケジュール案から参照できるように保存しました。")
-                                st.rerun()
+                # ```json ... ``` で返ってきた場合のガード
+                if ai_text.startswith("```"):
+                    ai_text = ai_text.strip("`")
+                    ai_text = ai_text.replace("json", "", 1).strip()
 
-                    except Exception as e:
-                        st.error(f"AI呼び出しエラー: {e}")
+                try:
+                    phases = json.loads(ai_text)
+                except Exception:
+                    record_parse_outcome(response, False)
+                    raise LLMOutputError(
+                        "AI出力をJSONとして解釈できませんでした。出力内容を確認してください。", ai_text
+                    )
+                record_parse_outcome(response, isinstance(phases, list))
+                if not isinstance(phases, list):
+                    raise LLMOutputError("JSON配列ではありません。出力形式を確認してください。", ai_text)
+                return phases
+
+            def _apply(phases):
+                # 中央ペイン（スケジュール案）で利用するためにセッションに保存
+                st.session_state["schedule_phase_draft"] = phases
+                st.session_state["schedule_draft_source"] = "ai"
+
+                # プレビュー用に DataFrame も保持（任意）
+                try:
+                    import pandas as pd
+                    st.session_state["schedule_phase_draft_df"] = pd.DataFrame(phases)
+                except Exception:
+                    st.session_state["schedule_phase_draft_df"] = None
+                return "スケジュールの下書きを作成しました。中央ペインのスケジュール案から参照できるように保存しました。"
+
+            submit_llm_job("スケジュール案", "スケジュールの下書き", _work, _apply, input_key=llm_input_key(prompt))
+            st.rerun()
 
         # ▼ 既に下書きがあればプレビュー表示
         if "schedule_phase_draft" in st.session_state:
@@ -3755,6 +7236,8 @@ with right:
         # セッション状態の初期値を設定
         # （すでに値があればそのまま維持）
         # -------------------------
+        # 本調査の質問数・サンプルサイズは、オリエンで指定があればその値から始める
+        orien_record = get_orien_record()
         default_values = {
             "hours_plan": 0.0,
             "hours_field": 0.0,
@@ -3762,13 +7245,26 @@ with right:
             "hours_analysis": 0.0,
             "scr_q": 5,
             "scr_n": 10000,
-            "main_q": 20,
-            "main_n": 300,
+            "main_q": orien_record["question_count"] or 20,
+            "main_n": orien_record["sample_size"] or 300,
         }
         for k, v in default_values.items():
             if k not in st.session_state:
                 st.session_state[k] = v
 
+        orien_notes = [
+            f"{label}：{value}"
+            for label, value in [
+                ("質問数", orien_record["spec_requests"]["質問数"]),
+                ("サンプルサイズ", orien_record["spec_requests"]["サンプルサイズ"]),
+                ("見積金額上限", orien_record["budget_cap_text"]),
+                ("複数パターンの見積", orien_record["multiple_estimates"]),
+            ]
+            if value
+        ]
+        if orien_notes:
+            st.caption("オリエンでの要望　" + "／".join(orien_notes))
+
         # -------------------------
         # ① 企画費用（人件費）
         # -------------------------
@@ -3857,29 +7353,76 @@ with right:
 
         from pathlib import Path
 
-        pptx_path = st.session_state.get("pptx_path")
         final_path = st.session_state.get("final_pptx_path")
+        # 最終版を作ったあとに反映・元に戻すをしていなければ最終版を渡す
+        final_is_current = (
+            final_path
+            and Path(final_path).is_file()
+            and st.session_state.get("final_pptx_revision") == revision_log()["version"]
+        )
 
-        # final があればそれを、なければ現時点のpptxを候補にする
-        candidate_path = pptx_path
+        if final_is_current:
+            with open(final_path, "rb") as f:
+                st.download_button(
+                    "📥 最終版PowerPointをダウンロード",
+                    f,
+                    file_name=Path(final_path).name,
+                    use_container_width=True,
+                )
+        elif get_working_presentation() is not None:
+            # 作業中の内容はファイルにせず、メモリ上で書き出して渡す
+            bio = BytesIO()
+            get_working_presentation().save(bio)
+            st.download_button(
+                "📥 現在のPowerPointをダウンロード",
+                bio.getvalue(),
+                file_name=f"proposal_current_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pptx",
+                use_container_width=True,
+            )
+            if final_path:
+                st.info("最終版を作成したあとに内容が変わっています。中央ペインで最終版を作り直してください。")
+            else:
+                st.info("まだ最終版は作成していません。中央ペインの『💾 現在の内容で最終版PowerPointを作成』を押すと、ファイル名付きで確定保存されます。")
+        else:
+            st.info("中央ペインで最終版を作成すると、ここからダウンロードできるようになります。")
 
-        #st.write("DEBUG_pptx_path:", st.session_state.get("pptx_path"))
-        #st.write("DEBUG_final_path:", st.session_state.get("final_pptx_path"))
 
+    # =========================
+    # 右ペイン
+    # === LLM診断 ===
+    elif mode == "llm_diagnostics":
+        st.subheader("LLM診断")
+        st.caption("計測ログは JSON Lines 形式で保存されています。")
+        st.code(str(LLM_TELEMETRY_LOG), language="text")
 
-        if candidate_path and Path(candidate_path).is_file():
-            label = "📥 最終版PowerPointをダウンロード" if final_path else "📥 現在のPowerPointをダウンロード"
+        st.checkbox("カセット再生（replay）の記録を除外する", key="diag_exclude_replayed")
 
-            with open(candidate_path, "rb") as f:
+        if LLM_TELEMETRY_LOG.exists():
+            with open(LLM_TELEMETRY_LOG, "rb") as f:
                 st.download_button(
-                    label,
+                    "📥 計測ログをダウンロード",
                     f,
-                    file_name=Path(candidate_path).name,
+                    file_name=LLM_TELEMETRY_LOG.name,
                     use_container_width=True,
                 )
 
-            if not final_path:
-                st.info("まだ最終版は作成していません。中央ペインの『💾 現在の内容で最終版PowerPointを作成』を押すと、ファイル名付きで確定保存されます。")
-        else:
-            st.info("中央ペインで最終版を作成すると、ここからダウンロードできるようになります。")
+        # エンドポイントごとのサーキットブレーカーの状態
+        endpoints = _llm_endpoints()
+        if len(endpoints) > 1:
+            st.markdown("#### エンドポイント")
+            breakers = _llm_runtime()["breakers"]
+            for ep in endpoints:
+                state = breakers.get(ep["name"], {})
+                remaining = state.get("open_until", 0) - time.time()
+                if remaining > 0:
+                    st.caption(f"⛔ {ep['name']}：停止中（あと{remaining:.0f}秒）")
+                else:
+                    st.caption(f"✅ {ep['name']}：利用可（連続失敗 {state.get('failures', 0)} 回）")
+
 
+# =========================
+# 実行中ジョブのポーリング（st.fragment がない版の代替）
+# =========================
+if not LLM_POLL_WITH_FRAGMENT and st.session_state.get("llm_jobs"):
+    time.sleep(1.0)
+    st.rerun()
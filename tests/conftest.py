@@ -0,0 +1,29 @@
+"""
+アプリ本体は import すると Streamlit の画面を組み立てるため、
+テストでは必要な定義（関数・定数）だけをソースから取り出して実行する。
+"""
+import ast
+from pathlib import Path
+
+import pytest
+
+APP = Path(__file__).resolve().parents[1] / "ResearchPlanning3_forAuzure.py"
+
+
+def _load_app_defs(names, namespace):
+    tree = ast.parse(APP.read_text(encoding="utf-8"))
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(getattr(t, "id", None) in names for t in node.targets):
+            body.append(node)
+    ns = dict(namespace)
+    exec(compile(ast.Module(body=body, type_ignores=[]), str(APP), "exec"), ns)
+    return ns
+
+
+@pytest.fixture(scope="module")
+def load_app_defs():
+    """load_app_defs({"名前", ...}, {"依存モジュール名": モジュール}) で定義の名前空間を返す"""
+    return _load_app_defs
@@ -0,0 +1,45 @@
+"""
+max_tokens で打ち切られた出力と続きの出力のつなぎ合わせ（stitch_continuation）のテスト。
+"""
+import json
+import re
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def stitch(load_app_defs):
+    ns = load_app_defs({"stitch_continuation", "_json_body", "_json_state"}, {"json": json, "re": re})
+    return ns["stitch_continuation"]
+
+
+@pytest.mark.parametrize(
+    "head, tail, expected",
+    [
+        # 短い重複（1〜5文字）
+        ('[{"a":1},{"b":', '{"b":2}]', '[{"a":1},{"b":2}]'),
+        ('[{"a":1},', ',{"b":2}]', '[{"a":1},{"b":2}]'),
+        ('{"items":["x","y"', '"y","z"]}', '{"items":["x","y","z"]}'),
+        # 長い重複
+        ('[{"item":"ブランド認知","p":1},{"item":"購入', '{"item":"購入頻度","p":2}]', '[{"item":"ブランド認知","p":1},{"item":"購入頻度","p":2}]'),
+        # 重複なし
+        ('[{"a":1},{"b"', ':2}]', '[{"a":1},{"b":2}]'),
+        # コードブロックで包み直した続き
+        ('[{"a":1},', '```json\n{"b":2}]\n```', '[{"a":1},{"b":2}]'),
+    ],
+)
+def test_stitch_json_parses(stitch, head, tail, expected):
+    stitched = stitch(head, tail)
+    assert stitched == expected
+    json.loads(stitched)
+
+
+def test_stitch_json_intermediate_segment_stays_valid_prefix(stitch):
+    # さらに続きがある途中の段階でも、壊れたつなぎ方を選ばない
+    assert stitch('[{"a":1},{"b":', '{"b":2},{"c":') == '[{"a":1},{"b":2},{"c":'
+
+
+def test_stitch_text_removes_only_long_overlap(stitch):
+    assert stitch("調査の目的は、購入実態を把握すること", "購入実態を把握することである。") == "調査の目的は、購入実態を把握することである。"
+    # 短い一致は偶然の可能性が高いので残す
+    assert stitch("目標：売上の拡大。", "。次に現状") == "目標：売上の拡大。。次に現状"
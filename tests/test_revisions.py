@@ -0,0 +1,116 @@
+"""
+反映履歴の追記のみのログ（revisions.jsonl）のテスト：追記 → 読み込み → 当て直しで同じデッキになること。
+"""
+import json
+import os
+import time
+import uuid
+import types
+from pathlib import Path
+
+import pytest
+
+NAMES = {
+    "REVISION_LOG_FILE",
+    "REVISION_CHECKPOINT_FILE",
+    "REVISION_CHECKPOINT_EVERY",
+    "SCHEDULE_SLOT",
+    "revision_log",
+    "load_revision_log",
+    "_append_revision_record",
+    "reset_revision_log",
+    "_record_patch",
+    "replay_revisions",
+    "move_revision_head",
+}
+
+
+class FakeDeck(dict):
+    """(スライド, スロット) → テキスト。テンプレートの値は空とする"""
+
+
+def _write_slot_text(prs, slide_index, slot, text, style):
+    prs[(slide_index, slot)] = text
+    return object()
+
+
+@pytest.fixture
+def app(load_app_defs, tmp_path):
+    st = types.SimpleNamespace(session_state={})
+    return load_app_defs(
+        NAMES,
+        {
+            "json": json,
+            "os": os,
+            "time": time,
+            "uuid": uuid,
+            "Path": Path,
+            "st": st,
+            "get_session_dir": lambda: tmp_path,
+            "_write_slot_text": _write_slot_text,
+            "discard_working_presentation": lambda: st.session_state.pop("working_deck", None),
+        },
+    )
+
+
+def _patch(slot, old, new):
+    return {"slot": slot, "slide": 1, "old": old, "new": new, "style": "format", "label": "キックオフノート"}
+
+
+def test_append_load_replay_round_trip(app, tmp_path):
+    app["reset_revision_log"]("sha-a")
+    app["_record_patch"](_patch("EDIT_TO_BE", "", "目標1"))
+    app["_record_patch"](_patch("EDIT_AS_IS", "", "現状1"))
+    app["_record_patch"](_patch("EDIT_TO_BE", "目標1", "目標2"))
+    # 2つ元に戻してから別の変更を加える（戻した版より後ろは捨てられる）
+    app["move_revision_head"](1)
+    app["_record_patch"](_patch("EDIT_PROBLEM", "", "課題1"))
+    app["move_revision_head"](1)
+    app["move_revision_head"](2)
+
+    memory = app["st"].session_state["revision_log"]
+    loaded = app["load_revision_log"](tmp_path / app["REVISION_LOG_FILE"])
+    assert loaded["patches"] == memory["patches"]
+    assert loaded["head"] == memory["head"] == 2
+    assert loaded["version"] == memory["version"]
+    assert loaded["base"] == "sha-a"
+
+    expected, replayed = FakeDeck(), FakeDeck()
+    app["replay_revisions"](expected, memory["head"])
+    app["st"].session_state.clear()  # プロセスの再起動でセッションの状態が消えた想定
+    app["replay_revisions"](replayed, app["revision_log"]()["head"])
+    assert replayed == expected == {(1, "EDIT_TO_BE"): "目標1", (1, "EDIT_PROBLEM"): "課題1"}
+
+
+def test_load_skips_partial_lines_and_resets(app, tmp_path):
+    path = tmp_path / app["REVISION_LOG_FILE"]
+    app["reset_revision_log"]("sha-a")
+    app["_record_patch"](_patch("EDIT_TO_BE", "", "目標1"))
+    app["reset_revision_log"]("sha-b")
+    app["_record_patch"](_patch("EDIT_AS_IS", "", "現状1"))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"op": "patch", "rev": 2, "slot"')  # 書きかけの行
+
+    loaded = app["load_revision_log"](path)
+    assert loaded["base"] == "sha-b"
+    assert [p["new"] for p in loaded["patches"]] == ["現状1"]
+    assert loaded["head"] == 1
+
+
+def test_load_missing_file_is_empty(app, tmp_path):
+    assert app["load_revision_log"](tmp_path / "none.jsonl") == {"patches": [], "head": 0, "version": 0, "base": None}
+
+
+def test_load_from_checkpoint_and_following_lines(app, tmp_path):
+    app["REVISION_CHECKPOINT_EVERY"] = 3
+    app["reset_revision_log"]("sha-a")
+    for i in range(4):
+        app["_record_patch"](_patch(f"EDIT{i}", "", f"値{i}"))
+    app["move_revision_head"](3)
+    assert (tmp_path / app["REVISION_CHECKPOINT_FILE"]).is_file()
+
+    memory = app["st"].session_state["revision_log"]
+    loaded = app["load_revision_log"](tmp_path / app["REVISION_LOG_FILE"])
+    assert loaded["patches"] == memory["patches"]
+    assert loaded["head"] == memory["head"] == 3
+    assert loaded["version"] == memory["version"]
@@ -0,0 +1,77 @@
+"""
+ルールベースの事前抽出（社名・日付）のテスト。
+"""
+import os
+import re
+from datetime import date
+
+import pytest
+
+NAMES = {
+    "SELF_COMPANY_NAMES",
+    "_COMPANY_SUFFIX",
+    "_COMPANY_BODY",
+    "_COMPANY_PATTERNS",
+    "_COMPANY_NON_NAME",
+    "_normalize_company",
+    "extract_company_names",
+    "_TITLE_LABEL",
+    "_TITLE_HEADING",
+    "extract_title_candidates",
+    "_ERA_BASE",
+    "_DATE_PATTERNS",
+    "_WEEKDAY_AFTER",
+    "_DATE_CONTEXT",
+    "parse_japanese_dates",
+}
+
+
+@pytest.fixture(scope="module")
+def app(load_app_defs):
+    return load_app_defs(NAMES, {"os": os, "re": re, "_date": date})
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("サントリー食品インターナショナル株式会社 御中", ["サントリー食品インターナショナル株式会社"]),
+        ("トヨタ自動車株式会社様と株式会社デンソー", ["トヨタ自動車株式会社", "株式会社デンソー"]),
+        ("株式会社リクルートの調査について", ["株式会社リクルート"]),
+        ("（株）ニトリ 御中", ["株式会社ニトリ"]),
+    ],
+)
+def test_extract_company_names_skips_honorifics_and_particles(app, text, expected):
+    assert app["extract_company_names"](text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("調査名：新商品受容性調査\n\n実施概要", ["新商品受容性調査"]),
+        ("■件名：ブランドイメージ調査のご依頼\n\n【ブランドイメージ調査のご依頼】", ["ブランドイメージ調査のご依頼"]),
+        ("飲料カテゴリーの購買実態調査\n\n背景", ["飲料カテゴリーの購買実態調査"]),
+    ],
+)
+def test_extract_title_candidates_does_not_repeat_labelled_lines(app, text, expected):
+    assert app["extract_title_candidates"](text) == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("回答者の1/3が購入経験あり", []),
+        ("3/4は未回答", []),
+        ("2/10（月）キックオフ", [date(2025, 2, 10)]),
+        ("納品 3/15", [date(2025, 3, 15)]),
+        ("3月4日 報告会", [date(2025, 3, 4)]),
+        ("2025/3/4", [date(2025, 3, 4)]),
+    ],
+)
+def test_parse_japanese_dates_ignores_fractions(app, text, expected):
+    found = app["parse_japanese_dates"](text, date(2025, 1, 1))
+    assert [d for d, _, _ in found] == expected
+
+
+def test_parse_japanese_dates_with_date_context(app):
+    found = app["parse_japanese_dates"]("3/15", date(2025, 1, 1), date_context=True)
+    assert [d for d, _, _ in found] == [date(2025, 3, 15)]